@@ -0,0 +1,82 @@
+from argparse import ArgumentParser
+import sys
+
+from nwsynth.apu import ENGINES, Apu
+from nwsynth.config import settings
+from nwsynth.mixer import Mixer
+from nwsynth.output import NullWriter
+from nwsynth.sound_generator import SoundGenerator
+from nwsynth.tracker import Sequencer, parse_song
+from nwsynth.waveform import samples_dir
+
+from .common import print_table, summarize, time_calls
+from .tracker import song
+
+
+CHANNEL_COUNTS = [4, 8]
+ROWS_PER_SECOND = 10
+
+class CoreScenario:
+    # The APU alone with every channel busy: both pulses sweeping, the triangle, noise and a looping DMC sample
+    def __init__(self):
+        self.apu = Apu()
+        sample = samples_dir.joinpath('Snare.dmc').read_bytes()
+        self.apu.load(0xC000, sample)
+        for address, value in [
+            (0x4015, 0x1F), (0x4017, 0x40),
+            (0x4000, 0xBF), (0x4001, 0xF9), (0x4002, 0xFD), (0x4003, 0x00),
+            (0x4004, 0x7F), (0x4005, 0xF1), (0x4006, 0x40), (0x4007, 0x01),
+            (0x4008, 0xFF), (0x400A, 0xC8), (0x400B, 0x00),
+            (0x400C, 0x3F), (0x400E, 0x03), (0x400F, 0x00),
+            (0x4010, 0x4F), (0x4012, 0x00), (0x4013, (len(sample) - 1) // 16), (0x4015, 0x1F),
+        ]:
+            self.apu.write(address, value)
+
+    def tick(self):
+        self.apu.render(settings.block_size)
+
+class EngineScenario:
+    # A tracker song played block by block against a null sink, on one engine or the other
+    def __init__(self, engine: str, channels: int):
+        self.sg = SoundGenerator(Mixer(NullWriter()), engine=engine)
+        self.events = self.sg.open_events(1 << 16)
+        self._events = Sequencer(parse_song(song(channels, ROWS_PER_SECOND))).events(loop=True)
+        self._next = next(self._events)
+        self._block = 0
+
+    def tick(self):
+        self._block += 1
+        until = self._block * settings.block_duration
+        while self._next[0] < until:
+            time, type_, vk, value = self._next
+            self.events.put(type_, vk, time, value)
+            self._next = next(self._events)
+        self.sg.tick(until)
+
+def run(ticks: int, channel_counts: list[int]) -> list[dict]:
+    budget_ms = settings.block_duration * 1000
+    rows = [{'scenario': 'apu core', 'channels': 5, **summarize(time_calls(CoreScenario().tick, ticks), budget_ms)}]
+    for channels in channel_counts:
+        for engine in ENGINES:
+            scenario = EngineScenario(engine, channels)
+            times = time_calls(scenario.tick, ticks)
+            rows.append({'scenario': f'{engine} engine', 'channels': channels, **summarize(times, budget_ms)})
+            scenario.sg.close()
+    return rows
+
+def main(argv: list[str] = None):
+    parser = ArgumentParser(description='Render time of the cycle-accurate APU engine against the wavetable engine')
+    parser.add_argument('--ticks', type=int, default=300)
+    parser.add_argument('--channels', type=int, nargs='+', default=CHANNEL_COUNTS, help='tracker song channels')
+    args = parser.parse_args(argv)
+    rows = run(args.ticks, args.channels)
+    print_table(rows, ['scenario', 'channels', 'p50_ms', 'p99_ms', 'max_ms', 'headroom', 'realtime_factor'])
+    # Fails when the APU cannot keep up with real time at p99
+    slow = [row for row in rows if row['scenario'] != 'wavetable engine' and row['headroom'] < 0]
+    for row in slow:
+        print(f'TOO SLOW {row["scenario"]}, channels={row["channels"]}: p99 {row["p99_ms"]:.3f} ms of {row["budget_ms"]:.3f} ms')
+    if slow:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
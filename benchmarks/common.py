@@ -0,0 +1,107 @@
+import json
+import tracemalloc
+from pathlib import Path
+from time import perf_counter, thread_time
+
+import numpy as np
+
+
+BASELINE_DIR = Path(__file__).parent.joinpath('baselines')
+# The reference block of calibrated_time(): a voice count's worth of interpolated table lookups, sines and a mix
+_REFERENCE_TABLE = np.sin(np.linspace(0, 2 * np.pi, 2048, endpoint=False)).astype(np.float32)
+_REFERENCE_PHASE = np.random.default_rng(0).random((32, 735))
+
+def time_calls(function, count: int, warmup: int = 10) -> np.ndarray:
+    # Wall time of each call, in milliseconds
+    for _ in range(warmup):
+        function()
+    times = np.zeros(count)
+    for index in range(count):
+        start = perf_counter()
+        function()
+        times[index] = perf_counter() - start
+    return times * 1000
+
+def allocated_per_call(function, count: int) -> float:
+    # Peak bytes allocated by one call (temporary arrays included), averaged over the calls
+    function()
+    tracemalloc.start()
+    total = 0
+    for _ in range(count):
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+        total += peak - before
+    tracemalloc.stop()
+    return total / count
+
+def _reference_block() -> float:
+    position = _REFERENCE_PHASE * (_REFERENCE_TABLE.size - 1)
+    index = position.astype(np.int64)
+    samples = _REFERENCE_TABLE[index] + (_REFERENCE_TABLE[index + 1] - _REFERENCE_TABLE[index]) * (position - index)
+    samples *= np.sin(position, dtype=np.float32)
+    return float(samples.sum(axis=0).max())
+
+def calibrated_time(function, count: int, warmup: int = 10) -> float:
+    # Median CPU time of a call in units of a fixed reference block, the two timed in turn so that both
+    # see the same host: how fast the machine is, and how busy, divides out of the result
+    for _ in range(warmup):
+        function()
+        _reference_block()
+    reference, times = np.zeros(count), np.zeros(count)
+    for index in range(count):
+        start = thread_time()
+        _reference_block()
+        middle = thread_time()
+        function()
+        reference[index], times[index] = middle - start, thread_time() - middle
+    return float(np.median(times) / np.median(reference))
+
+def summarize(times: np.ndarray, budget_ms: float) -> dict:
+    p99 = float(np.percentile(times, 99))
+    return {
+        'p50_ms': float(np.percentile(times, 50)),
+        'p99_ms': p99,
+        'max_ms': float(times.max()),
+        'budget_ms': budget_ms,
+        # Share of the block time left over at p99
+        'headroom': 1 - p99 / budget_ms,
+        'realtime_factor': budget_ms / float(times.mean()),
+    }
+
+def print_table(rows: list[dict], columns: list[str]):
+    widths = [max(len(column), *(len(_format(row[column])) for row in rows)) for column in columns]
+    print('  '.join(column.rjust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(_format(row[column]).rjust(width) for column, width in zip(columns, widths)))
+
+def _format(value) -> str:
+    if isinstance(value, float):
+        return f'{value:.3f}'
+    return str(value)
+
+def save_baseline(name: str, rows: list[dict]):
+    BASELINE_DIR.mkdir(exist_ok=True)
+    with BASELINE_DIR.joinpath(f'{name}.json').open('w') as f:
+        json.dump(rows, f, indent=4)
+
+def compare_baseline(name: str, rows: list[dict], keys: list[str], metric: str = 'cpu_units', tolerance: float = 1.25) -> list[str]:
+    # Returns a description of every row whose metric got worse than the stored baseline by more than tolerance,
+    # and of every row the baseline has no entry for, so that new scenarios are not skipped unnoticed.
+    # The default metric is calibrated_time(), which holds across hosts and load; wall times such as p99_ms
+    # are mostly the host's scheduling and are not a portable gate
+    path = BASELINE_DIR.joinpath(f'{name}.json')
+    if not path.exists():
+        return [f'no baseline {path}; store one with --save']
+    with path.open() as f:
+        baseline = {tuple(row[key] for key in keys): row for row in json.load(f)}
+    regressions = []
+    for row in rows:
+        old = baseline.get(tuple(row[key] for key in keys))
+        label = ', '.join(f'{key}={row[key]}' for key in keys)
+        if old is None or metric not in old:
+            regressions.append(f'{label}: not in the baseline; store a new one with --save')
+        elif row[metric] > old[metric] * tolerance:
+            regressions.append(f'{label}: {metric} {old[metric]:.3f} -> {row[metric]:.3f}')
+    return regressions
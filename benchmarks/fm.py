@@ -0,0 +1,84 @@
+from argparse import ArgumentParser
+import sys
+
+from nwsynth.config import settings
+from nwsynth.constants import *
+
+from .common import allocated_per_call, print_table, summarize, time_calls
+from .tick import Scenario
+
+
+VOICE_COUNTS = [8, 16, 32, 48, 64]
+OPERATOR_COUNTS = [2, 4, 6]
+ALGORITHMS = {2: 'pair', 4: 'stack', 6: 'stack6'}
+# None, mild, and strong enough to be solved sample by sample
+FEEDBACKS = [0.0, 0.5, 0.9]
+# The voice count that has to fit in the block time
+REQUIRED_VOICES = 32
+
+def patch(operators: int, feedback: float) -> dict:
+    # A sustained fm instrument: every operator at a different ratio, the last one fed back into itself
+    return {
+        'type': 'fm',
+        'name': f'bench{operators}',
+        'algorithm': ALGORITHMS.get(operators, 'parallel'),
+        'operators': [
+            {
+                'ratio': index + 1,
+                'level': 1.0,
+                'feedback': feedback if index == operators - 1 else 0.0,
+                'adsr': {'type': 'linear', 'args': [1, 0, 0, 1, 0]},
+            }
+            for index in range(operators)
+        ],
+    }
+
+def run(
+    ticks: int,
+    alloc_ticks: int,
+    voice_counts: list[int],
+    tick_sizes: list[int],
+    operator_counts: list[int],
+    feedbacks: list[float]
+) -> list[dict]:
+    rows = []
+    for operators in operator_counts:
+        for feedback in feedbacks:
+            for tick_size in tick_sizes:
+                for voices in voice_counts:
+                    scenario = Scenario('fm', voices, tick_size, instrument=patch(operators, feedback))
+                    times = time_calls(scenario.tick, ticks)
+                    rows.append({
+                        'operators': operators,
+                        'feedback': feedback,
+                        'tick_size': tick_size,
+                        'voices': voices,
+                        **summarize(times, tick_size / settings.sample_rate * 1000),
+                        'alloc_kib': allocated_per_call(scenario.tick, alloc_ticks) / 1024,
+                    })
+                    scenario.sg.close()
+    return rows
+
+def main(argv: list[str] = None):
+    parser = ArgumentParser(description='Per-tick render time of fm voices against a null sink')
+    parser.add_argument('--ticks', type=int, default=300)
+    parser.add_argument('--alloc-ticks', type=int, default=20)
+    parser.add_argument('--voices', type=int, nargs='+', default=VOICE_COUNTS)
+    parser.add_argument('--tick-sizes', type=int, nargs='+', default=[SAMPLE_COUNT_IN_A_TICK])
+    parser.add_argument('--operators', type=int, nargs='+', default=OPERATOR_COUNTS)
+    parser.add_argument('--feedback', type=float, nargs='+', default=FEEDBACKS)
+    args = parser.parse_args(argv)
+    rows = run(args.ticks, args.alloc_ticks, args.voices, args.tick_sizes, args.operators, args.feedback)
+    print_table(
+        rows, ['operators', 'feedback', 'tick_size', 'voices', 'p50_ms', 'p99_ms', 'max_ms', 'headroom', 'alloc_kib']
+    )
+    # Fails when the required polyphony does not render within the block time at p99
+    over = [row for row in rows if row['voices'] <= REQUIRED_VOICES and row['headroom'] < 0]
+    for row in over:
+        print(f'OVER BUDGET operators={row["operators"]}, feedback={row["feedback"]}, voices={row["voices"]}: '
+              f'p99 {row["p99_ms"]:.3f} ms of {row["budget_ms"]:.3f} ms')
+    if over:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
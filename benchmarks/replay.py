@@ -0,0 +1,126 @@
+from argparse import ArgumentParser
+from threading import Thread
+from time import perf_counter
+import random
+import sys
+
+import numpy as np
+
+from nwsynth.config import main_config, settings
+from nwsynth.constants import *
+from nwsynth.keyboard_listener import KeyboardListener, ReplaySource
+from nwsynth.metrics import TIME_BUCKETS_MS, Histogram, metrics
+from nwsynth.mixer import Mixer
+from nwsynth.output import NullBackend, NullWriter, OutputEngine
+from nwsynth.sound_generator import SoundGenerator
+
+from .common import print_table
+
+
+KEY_RATES = [10, 50, 200]
+OFFLINE_KEY_RATES = [10, 100, 1000]
+
+def recording(keys_per_second: float, seconds: float, seed: int = 0) -> list[tuple[float, bool, int]]:
+    # Key strokes at random times: mostly tone keys held for a while, some percussion, and now and then
+    # an octave or instrument change
+    generator = random.Random(seed)
+    events = []
+    for _ in range(int(keys_per_second * seconds)):
+        time = generator.uniform(0, seconds)
+        choice = generator.random()
+        if choice < 0.05:
+            vk = generator.choice(OCTAVE_SELECTION_KEYS[2:6])
+        elif choice < 0.08:
+            vk = generator.choice(INSTRUMEMT_SELECTION_KEYS[:5])
+        elif choice < 0.2:
+            vk = generator.choice(PERCUSSION_INSTRUMENT_KEYS[:3])
+        else:
+            vk = generator.choice(TONE_KEYS)
+        events.append((time, True, vk))
+        events.append((min(time + generator.uniform(0.02, 0.5), seconds), False, vk))
+    events.sort(key=lambda event: event[0])
+    return events
+
+def run_realtime(keys_per_second: float, seconds: float) -> dict:
+    # The whole chain as it runs live: the recording replayed in this thread through the keyboard
+    # listener, the generator in its own, and a sink pulling blocks at the pace of a sound card
+    output = OutputEngine(NullBackend(realtime=True), main_config.get('bufferTicks', 4))
+    sg = SoundGenerator(Mixer(output))
+    source = ReplaySource(recording(keys_per_second, seconds))
+
+    enabled, metrics.enabled = metrics.enabled, True
+    metrics.event_latency_ms = latency = Histogram(TIME_BUCKETS_MS)
+    thread = Thread(target=sg.generate, daemon=True)
+    thread.start()
+    try:
+        KeyboardListener(sg, source).listen()
+    finally:
+        sg.stop()
+        thread.join()
+        output.close()
+        sg.close()
+        metrics.enabled = enabled
+    late = np.array(source.late) * 1000
+    return {
+        'keys_per_s': keys_per_second,
+        'events': latency.count,
+        'late_p99_ms': float(np.percentile(late, 99)) if late.size else 0.0,
+        'latency_p50_ms': latency.quantile(0.5),
+        'latency_p99_ms': latency.quantile(0.99),
+        'latency_max_ms': latency.max,
+        'dropped': sg.events.dropped,
+        'underruns': output.underruns,
+    }
+
+def run_offline(keys_per_second: float, seconds: float) -> dict:
+    # The same chain as fast as it goes: the recording is fed a block at a time on its own timeline
+    sg = SoundGenerator(Mixer(NullWriter()))
+    events = recording(keys_per_second, seconds)
+    source = ReplaySource(events)
+    listener = KeyboardListener(sg, source)
+    ticks = int(seconds / settings.block_duration)
+    times = np.zeros(ticks)
+    for tick in range(ticks):
+        until = (tick + 1) * settings.block_duration
+        start = perf_counter()
+        source.feed(listener, until)
+        sg.tick(until)
+        times[tick] = perf_counter() - start
+    sg.close()
+    return {
+        'keys_per_s': keys_per_second,
+        'key_events': len(events),
+        'p50_ms': float(np.percentile(times, 50) * 1000),
+        'p99_ms': float(np.percentile(times, 99) * 1000),
+        'realtime_factor': seconds / times.sum(),
+        'dropped': sg.events.dropped,
+    }
+
+def main(argv: list[str] = None):
+    parser = ArgumentParser(description='Latency and throughput of replayed key input through listener, generator and mixer')
+    parser.add_argument('--seconds', type=float, default=5.0, help='length of each recording')
+    parser.add_argument('--key-rates', type=float, nargs='+', default=KEY_RATES, help='key strokes a second, live')
+    parser.add_argument('--offline-key-rates', type=float, nargs='+', default=OFFLINE_KEY_RATES)
+    args = parser.parse_args(argv)
+    live = [run_realtime(rate, args.seconds) for rate in args.key_rates]
+    print_table(live, [
+        'keys_per_s', 'events', 'late_p99_ms', 'latency_p50_ms', 'latency_p99_ms', 'latency_max_ms', 'dropped', 'underruns'
+    ])
+    offline = [run_offline(rate, args.seconds) for rate in args.offline_key_rates]
+    print_table(offline, ['keys_per_s', 'key_events', 'p50_ms', 'p99_ms', 'realtime_factor', 'dropped'])
+    # Fails on lost events or output, or when a key takes longer than two blocks to sound at p99:
+    # one block waiting for the next tick, and its place in that block
+    budget_ms = 2 * settings.block_duration * 1000
+    failures = [
+        f'keys_per_s={row["keys_per_s"]}: {row["dropped"]} dropped events, {row["underruns"]} underruns, '
+        f'latency p99 {row["latency_p99_ms"]:.1f} ms of {budget_ms:.1f} ms'
+        for row in live if row['dropped'] or row['underruns'] or row['latency_p99_ms'] > budget_ms
+    ]
+    failures += [f'offline keys_per_s={row["keys_per_s"]}: {row["dropped"]} dropped events' for row in offline if row['dropped']]
+    for failure in failures:
+        print(f'FAILED {failure}')
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+from argparse import ArgumentParser
+import sys
+
+from nwsynth.config import settings
+from nwsynth.constants import *
+from nwsynth.mixer import Mixer
+from nwsynth.output import NullWriter
+from nwsynth.sound_generator import SoundGenerator
+
+from .common import allocated_per_call, calibrated_time, compare_baseline, print_table, save_baseline, summarize, time_calls
+
+
+VOICE_COUNTS = [1, 2, 4, 8, 16, 32, 64, 128]
+TICK_SIZES = [128, 256, SAMPLE_COUNT_IN_A_TICK, 2048]
+INSTRUMENT_TYPES = ['builtin', 'custom', 'percussion', 'fm', 'modulated']
+# Ticks timed in CPU time for the baseline comparison
+CPU_TICKS = 100
+# Voices are keyed by ids outside the virtual-key range, so that more voices than keys can sound
+VOICE_ID_BASE = 1 << 16
+
+class Scenario:
+    # Keeps `voices` voices of one instrument type sounding;
+    # one-shot voices that finish are pressed again, as a player hammering the keys would.
+    # instrument: plays this one instead of the first of instrument_type in the config
+    def __init__(
+        self, instrument_type: str, voices: int, tick_size: int, workers: int = 0, output=None, instrument: dict = None
+    ):
+        self.sg = SoundGenerator(Mixer(output or NullWriter(), tick_size), polyphony=voices, workers=workers)
+        instruments = self.sg.index
+        if instrument_type == 'percussion':
+            keys = list(instruments.percussion_keys)
+            self._get_key = self.sg._get_percussion_key
+        else:
+            if instrument is not None:
+                self.sg.instrument = instruments.compile_instrument(instrument)
+            elif instrument_type == 'modulated':
+                # The first instrument with a modulation matrix
+                self.sg.instrument = next(
+                    compiled for compiled in instruments.instruments
+                    if next(iter(compiled.keys.values())).modulation is not None
+                )
+            else:
+                self.sg.instrument = next(
+                    compiled for compiled in instruments.instruments if compiled.type == instrument_type
+                )
+            keys = [vk for vk in TONE_KEYS if (vk, 1) in self.sg.instrument.keys]
+            self._get_key = self.sg._get_key
+        self._voices = [(VOICE_ID_BASE + index, keys[index % len(keys)]) for index in range(voices)]
+        self._press_finished()
+
+    def _press_finished(self):
+        for voice_id, vk in self._voices:
+            if voice_id not in self.sg._activated_keys:
+                self.sg.octave = 1 + voice_id % 8
+                self.sg._press(voice_id, self._get_key(vk))
+
+    def tick(self):
+        self._press_finished()
+        self.sg.tick()
+
+def run(
+    ticks: int,
+    alloc_ticks: int,
+    voice_counts: list[int],
+    tick_sizes: list[int],
+    instrument_types: list[str],
+    workers: int = 0
+) -> list[dict]:
+    rows = []
+    for instrument_type in instrument_types:
+        for tick_size in tick_sizes:
+            for voices in voice_counts:
+                scenario = Scenario(instrument_type, voices, tick_size, workers)
+                times = time_calls(scenario.tick, ticks)
+                row = {
+                    'instrument': instrument_type,
+                    'tick_size': tick_size,
+                    'voices': voices,
+                    **summarize(times, tick_size / settings.sample_rate * 1000),
+                    'alloc_kib': allocated_per_call(scenario.tick, alloc_ticks) / 1024,
+                    # What the baseline comparison goes by
+                    'cpu_units': calibrated_time(scenario.tick, CPU_TICKS),
+                }
+                rows.append(row)
+                scenario.sg.close()
+    return rows
+
+def main(argv: list[str] = None):
+    parser = ArgumentParser(description='Per-tick render time of SoundGenerator.tick against a null sink')
+    parser.add_argument('--ticks', type=int, default=300)
+    parser.add_argument('--alloc-ticks', type=int, default=20)
+    parser.add_argument('--voices', type=int, nargs='+', default=VOICE_COUNTS)
+    parser.add_argument('--tick-sizes', type=int, nargs='+', default=TICK_SIZES)
+    parser.add_argument('--instruments', nargs='+', choices=INSTRUMENT_TYPES, default=INSTRUMENT_TYPES)
+    parser.add_argument('--workers', type=int, default=0, help='render with this many worker processes')
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='allowed CPU time slowdown against the baseline')
+    args = parser.parse_args(argv)
+    rows = run(args.ticks, args.alloc_ticks, args.voices, args.tick_sizes, args.instruments, args.workers)
+    print_table(rows, ['instrument', 'tick_size', 'voices', 'p50_ms', 'p99_ms', 'max_ms', 'headroom', 'alloc_kib'])
+    if args.workers:
+        # The baseline is single-process
+        return
+    if args.save:
+        save_baseline('tick', rows)
+        return
+    regressions = compare_baseline('tick', rows, ['instrument', 'tick_size', 'voices'], tolerance=args.tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    if regressions:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
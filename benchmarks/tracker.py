@@ -0,0 +1,110 @@
+from argparse import ArgumentParser
+from time import perf_counter
+import random
+import sys
+
+import numpy as np
+
+from nwsynth.config import settings
+from nwsynth.mixer import Mixer
+from nwsynth.output import NullWriter
+from nwsynth.sound_generator import SoundGenerator
+from nwsynth.tracker import Sequencer, parse_song
+
+from .common import print_table, summarize, time_calls
+
+
+ROW_RATES = [10, 50, 100, 250, 500, 1000]
+CHANNEL_COUNTS = [4, 8, 16]
+SPEED = 6
+ROWS = 64
+# Share of the block time that scheduling may take at p99, up to the row rate that has to fit in it
+SCHEDULE_BUDGET = 0.1
+REQUIRED_ROW_RATE = 250
+CELLS = ['{note} 01 .. 037', '{note} .. 30 4A6', '{note} .. .. EC3', '===', '{note} 05', '.. .. 20 048', '^^^', '']
+
+def song(channels: int, rows_per_second: float) -> dict:
+    # Every channel busy on every row: notes, arpeggios, vibratos, volume changes, releases and cuts
+    generator = random.Random(channels)
+    notes = [f'{name}{octave}' for name in ('C-', 'D#', 'F-', 'G-', 'A#') for octave in (3, 4, 5)]
+    rows = [
+        [generator.choice(CELLS).format(note=generator.choice(notes)) for _ in range(channels)]
+        for _ in range(ROWS)
+    ]
+    return {
+        'channels': channels,
+        # A row lasts SPEED ticks of 2.5 / tempo seconds
+        'tempo': rows_per_second * 2.5 * SPEED,
+        'speed': SPEED,
+        'patterns': {'bench': rows},
+        'order': ['bench'],
+        'restart': 0,
+    }
+
+class Scenario:
+    # Plays a looping song block by block against a null sink, the way the live player does, but in this
+    # thread: the events due in the block are put in the ring, then the block is rendered
+    def __init__(self, channels: int, rows_per_second: float):
+        self.sg = SoundGenerator(Mixer(NullWriter()))
+        self.events = self.sg.open_events(1 << 16)
+        self._events = Sequencer(parse_song(song(channels, rows_per_second))).events(loop=True)
+        self._next = next(self._events)
+        self._block = 0
+        self.schedule_times = []
+        self.count = 0
+
+    def tick(self):
+        self._block += 1
+        until = self._block * settings.block_duration
+        start = perf_counter()
+        while self._next[0] < until:
+            time, type_, vk, value = self._next
+            self.events.put(type_, vk, time, value)
+            self._next = next(self._events)
+            self.count += 1
+        self.schedule_times.append(perf_counter() - start)
+        self.sg.tick(until)
+
+def run(ticks: int, row_rates: list[float], channel_counts: list[int]) -> list[dict]:
+    rows = []
+    budget_ms = settings.block_duration * 1000
+    for channels in channel_counts:
+        for rows_per_second in row_rates:
+            scenario = Scenario(channels, rows_per_second)
+            times = time_calls(scenario.tick, ticks)
+            schedule = np.array(scenario.schedule_times[-ticks:]) * 1000
+            rows.append({
+                'channels': channels,
+                'rows_per_s': rows_per_second,
+                'events_per_block': scenario.count / len(scenario.schedule_times),
+                'schedule_p50_ms': float(np.percentile(schedule, 50)),
+                'schedule_p99_ms': float(np.percentile(schedule, 99)),
+                'schedule_share': float(np.percentile(schedule, 99)) / budget_ms,
+                **summarize(times, budget_ms),
+            })
+            scenario.sg.close()
+    return rows
+
+def main(argv: list[str] = None):
+    parser = ArgumentParser(description='Scheduling overhead of the tracker sequencer at high row rates')
+    parser.add_argument('--ticks', type=int, default=300)
+    parser.add_argument('--row-rates', type=float, nargs='+', default=ROW_RATES, help='rows a second')
+    parser.add_argument('--channels', type=int, nargs='+', default=CHANNEL_COUNTS)
+    args = parser.parse_args(argv)
+    rows = run(args.ticks, args.row_rates, args.channels)
+    print_table(rows, [
+        'channels', 'rows_per_s', 'events_per_block', 'schedule_p50_ms', 'schedule_p99_ms', 'schedule_share',
+        'p50_ms', 'p99_ms', 'headroom'
+    ])
+    # Fails when making and queueing the events takes more than its share of the block time at p99
+    over = [
+        row for row in rows if row['rows_per_s'] <= REQUIRED_ROW_RATE and row['schedule_share'] > SCHEDULE_BUDGET
+    ]
+    for row in over:
+        print(f'OVER BUDGET channels={row["channels"]}, rows_per_s={row["rows_per_s"]}: '
+              f'scheduling p99 {row["schedule_p99_ms"]:.3f} ms of {row["budget_ms"]:.3f} ms')
+    if over:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
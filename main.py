@@ -1,9 +1,67 @@
+from argparse import ArgumentParser
 from threading import Thread
+from time import sleep
 
 from nwsynth import KeyboardListener, Mixer, SoundGenerator
+from nwsynth.apu import ENGINES
+from nwsynth.config import Settings, main_config, settings
+from nwsynth.keyboard_listener import Recorder, ReplaySource, load_recording
+from nwsynth.metrics import metrics
+from nwsynth.output import OutputEngine, open_backend
 
-mixer = Mixer()
-sg = SoundGenerator(mixer)
-kl = KeyboardListener(sg)
-Thread(target=sg.generate, daemon=True).start()
-kl.listen()
+
+# Seconds the last notes of a replay get to ring out before exiting
+REPLAY_TAIL = 1.0
+
+def main():
+    parser = ArgumentParser(description='The New World Synthesizer')
+    Settings.add_arguments(parser)
+    parser.add_argument('--midi-input', nargs='?', const='', metavar='PORT', help='play a MIDI input port (default port if no name)')
+    parser.add_argument('--midi-file', metavar='PATH', help='play a MIDI file')
+    parser.add_argument('--tracker', metavar='PATH', help='play a tracker module')
+    parser.add_argument('--replay', metavar='PATH', help='play a key recording instead of listening to the keyboard, then exit')
+    parser.add_argument('--record', metavar='PATH', help='save the keys played as a recording on exit')
+    parser.add_argument('--output', default='device', metavar='SINK', help='device (default), null, or a .wav path')
+    parser.add_argument('--engine', choices=ENGINES, help='sound engine (default: main.engine in config.json)')
+    parser.add_argument('--workers', type=int, help='render processes besides this one (default: parallel.workers in config.json)')
+    args = parser.parse_args()
+    settings.apply_arguments(args)
+    metrics.configure(main_config.get('metrics', {}))
+    mixer = Mixer(OutputEngine(open_backend(args.output), main_config.get('bufferTicks', 4)))
+    sg = SoundGenerator(mixer, workers=args.workers, engine=args.engine)
+    source = ReplaySource(load_recording(args.replay)) if args.replay else None
+    recorder = Recorder() if args.record else None
+    kl = KeyboardListener(sg, source, recorder)
+    midi_input = None
+    if main_config.get('hotReload', False):
+        from nwsynth.instruments import ConfigReloader
+        ConfigReloader(sg).start()
+    if args.midi_input is not None or args.midi_file:
+        from nwsynth.midi import MidiFilePlayer, MidiInput
+        if args.midi_input is not None:
+            midi_input = MidiInput(sg, args.midi_input or None)
+        if args.midi_file:
+            MidiFilePlayer(sg, args.midi_file).start()
+    if args.tracker:
+        from nwsynth.tracker import TrackerPlayer, load_song
+        TrackerPlayer(sg, load_song(args.tracker)).start()
+    generator = Thread(target=sg.generate, daemon=True)
+    generator.start()
+    try:
+        kl.listen()
+        if args.replay:
+            sleep(REPLAY_TAIL)
+    finally:
+        # The generator stops before the output closes, so that it does not open it again
+        sg.stop()
+        generator.join()
+        if midi_input is not None:
+            midi_input.close()
+        if recorder is not None:
+            recorder.save(args.record)
+        mixer.output.close()
+        sg.close()
+
+# Worker processes import this module again when they are spawned
+if __name__ == '__main__':
+    main()
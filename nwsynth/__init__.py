@@ -1,3 +1,8 @@
-from .keyboard_listener import KeyboardListener
+from .apu import Apu
+from .events import EventRing
+from .keyboard_listener import KeyboardListener, Recorder, ReplaySource
+from .midi import MidiFilePlayer, MidiInput, MidiPort
 from .mixer import Mixer
-from .sound_generator import SoundGenerator
\ No newline at end of file
+from .output import NpyWriter, NullBackend, NullWriter, OutputEngine, PyAudioBackend, WaveFileBackend, WaveWriter
+from .sound_generator import SoundGenerator
+from .tracker import Sequencer, TrackerPlayer
@@ -0,0 +1,788 @@
+import json
+from functools import lru_cache
+from operator import itemgetter
+from typing import NamedTuple
+
+import numpy as np
+from numpy import float32, float64, int32, int64, ndarray, uint8
+
+from .config import settings
+from .effects import StateSpaceFilter
+from .envelope import Envelope, EnvelopeBank
+from .mixer import Strips
+from .modulation import Modulation, ModulationBank
+from .waveform import lfsr_sequence, samples_dir
+
+
+# NTSC 2A03, CPU cycles a second; every timer below counts these
+CPU_CLOCK = 1789773
+LENGTH_TABLE = [
+    10, 254, 20, 2, 40, 4, 80, 6, 160, 8, 60, 10, 14, 12, 26, 14,
+    12, 16, 24, 18, 48, 20, 96, 22, 192, 24, 72, 26, 16, 28, 32, 30,
+]
+# In the order they are heard
+DUTY_SEQUENCES = np.array([
+    [0, 1, 0, 0, 0, 0, 0, 0],
+    [0, 1, 1, 0, 0, 0, 0, 0],
+    [0, 1, 1, 1, 1, 0, 0, 0],
+    [1, 0, 0, 1, 1, 1, 1, 1],
+], int32)
+DUTY_CYCLES = [0.125, 0.25, 0.5, 0.75]
+TRIANGLE_SEQUENCE = np.array([*range(15, -1, -1), *range(16)], int32)
+NOISE_PERIODS = [4, 8, 16, 32, 64, 96, 128, 160, 202, 254, 380, 508, 762, 1016, 2034, 4068]
+DMC_RATES = [428, 380, 340, 320, 286, 254, 226, 214, 190, 160, 142, 128, 106, 84, 72, 54]
+# Frame counter: (cycle, quarter frame, half frame) of each step, and the length of the sequence
+FRAME_SEQUENCES = (
+    ([(7457, True, False), (14913, True, True), (22371, True, False), (29829, True, True)], 29830),
+    ([(7457, True, False), (14913, True, True), (22371, True, False), (37281, True, True)], 37282),
+)
+# The nonlinear mixer as lookup tables: pulse1 + pulse2, and 3 triangle + 2 noise + dmc
+PULSE_TABLE = np.array([0.0, *(95.52 / (8128 / n + 100) for n in range(1, 31))])
+TND_TABLE = np.array([0.0, *(163.67 / (24329 / n + 100) for n in range(1, 203))])
+# DMC samples live from $C000, at multiples of 64 bytes, up to 4081 bytes long
+DMC_MEMORY_START = 0xC000
+DMC_MAX_LENGTH = 0xFF * 16 + 1
+# Full scale of the mixer output (0 to 1) on the int16 scale of the bus: a pulse at full volume
+# comes out about as loud as a squarewave of amplitude 2048
+OUTPUT_GAIN = 1 << 15
+PULSE, TRIANGLE, NOISE, DMC = range(4)
+ENGINES = ('wavetable', 'apu')
+
+@lru_cache(maxsize=None)
+def lfsr_orbits(short_period: bool = False) -> tuple[ndarray, ndarray, ndarray, ndarray]:
+    # The noise shift register steps through a one-to-one map of its 2^15 states, so every state lies
+    # on a cycle. Returns the states cycle after cycle, and for every state the start and length of
+    # its cycle in there and its position in it; k steps on from state s is
+    #   orbit[start[s] + (position[s] + k) % length[s]]
+    tap = 6 if short_period else 1
+    states = np.arange(1 << 15)
+    following = (states >> 1 | ((states ^ states >> tap) & 1) << 14).tolist()
+    orbit, start, length, position = [], [0] * (1 << 15), [0] * (1 << 15), [0] * (1 << 15)
+    visited = [False] * (1 << 15)
+    for state in range(1 << 15):
+        if visited[state]:
+            continue
+        cycle = []
+        while not visited[state]:
+            visited[state] = True
+            cycle.append(state)
+            state = following[state]
+        for index, member in enumerate(cycle):
+            start[member], length[member], position[member] = len(orbit), len(cycle), index
+        orbit.extend(cycle)
+    return np.array(orbit, int32), np.array(start, int32), np.array(length, int32), np.array(position, int32)
+
+
+class Timer:
+    # A divider that clocks its channel's sequencer every period CPU cycles. countdown: cycles until the
+    # next clock. A new period takes effect at the next reload, as on the chip
+    def __init__(self):
+        self.period = 1
+        self.countdown = 1
+
+    def run(self, cycles: ndarray) -> ndarray:
+        # cycles: 1, 2, ..., n. The number of clocks after each of the next n cycles
+        clocks = (cycles - self.countdown) // self.period + 1
+        np.maximum(clocks, 0, out=clocks)
+        if clocks.size:
+            self.countdown += int(clocks[-1]) * self.period - cycles.size
+        return clocks
+
+
+class EnvelopeUnit:
+    # Volume envelope of the pulse and noise channels, clocked every quarter frame
+    def __init__(self):
+        self.constant = False
+        self.loop = False
+        self.volume = 0
+        self.start = False
+        self.divider = 0
+        self.decay = 0
+
+    def write(self, value: int):
+        self.loop = bool(value & 0x20)
+        self.constant = bool(value & 0x10)
+        self.volume = value & 0x0F
+
+    def clock(self):
+        if self.start:
+            self.start = False
+            self.decay = 15
+            self.divider = self.volume
+        elif self.divider == 0:
+            self.divider = self.volume
+            if self.decay > 0:
+                self.decay -= 1
+            elif self.loop:
+                self.decay = 15
+        else:
+            self.divider -= 1
+
+    @property
+    def output(self) -> int:
+        return self.volume if self.constant else self.decay
+
+
+class PulseChannel:
+    def __init__(self, second: bool):
+        # The sweep of pulse 1 negates in ones' complement, that of pulse 2 in two's complement
+        self.second = second
+        self.enabled = False
+        self.duty = 0
+        self.envelope = EnvelopeUnit()
+        self.length = 0
+        self.period = 0
+        self.step = 0
+        self.timer = Timer()
+        self.sweep_enabled = False
+        self.sweep_period = 0
+        self.sweep_negate = False
+        self.sweep_shift = 0
+        self.sweep_reload = False
+        self.sweep_divider = 0
+
+    def write(self, register: int, value: int):
+        if register == 0:
+            self.duty = value >> 6
+            self.envelope.write(value)
+        elif register == 1:
+            self.sweep_enabled = bool(value & 0x80)
+            self.sweep_period = value >> 4 & 7
+            self.sweep_negate = bool(value & 0x08)
+            self.sweep_shift = value & 7
+            self.sweep_reload = True
+        elif register == 2:
+            self.period = self.period & 0x700 | value
+        else:
+            self.period = self.period & 0xFF | (value & 7) << 8
+            if self.enabled:
+                self.length = LENGTH_TABLE[value >> 3]
+            self.step = 0
+            self.envelope.start = True
+
+    def _target(self) -> int:
+        change = self.period >> self.sweep_shift
+        if self.sweep_negate:
+            return self.period - change - (0 if self.second else 1)
+        return self.period + change
+
+    def _muted(self) -> bool:
+        return self.period < 8 or self._target() > 0x7FF
+
+    def quarter_frame(self):
+        self.envelope.clock()
+
+    def half_frame(self):
+        if not self.envelope.loop and self.length > 0:
+            self.length -= 1
+        if self.sweep_divider == 0 and self.sweep_enabled and self.sweep_shift > 0 and not self._muted():
+            self.period = max(self._target(), 0)
+        if self.sweep_divider == 0 or self.sweep_reload:
+            self.sweep_divider = self.sweep_period
+            self.sweep_reload = False
+        else:
+            self.sweep_divider -= 1
+
+    def run(self, cycles: ndarray) -> ndarray | int:
+        # The timer counts APU cycles, two CPU cycles each
+        self.timer.period = 2 * (self.period + 1)
+        clocks = self.timer.run(cycles)
+        volume = self.envelope.output
+        step = self.step
+        self.step = (step + int(clocks[-1])) & 7
+        if self.length == 0 or volume == 0 or self._muted():
+            return 0
+        return DUTY_SEQUENCES[self.duty][(step + clocks) & 7] * volume
+
+
+class TriangleChannel:
+    def __init__(self):
+        self.enabled = False
+        self.control = False
+        self.linear_period = 0
+        self.linear = 0
+        self.linear_reload = False
+        self.length = 0
+        self.period = 0
+        self.step = 0
+        self.timer = Timer()
+
+    def write(self, register: int, value: int):
+        if register == 0:
+            self.control = bool(value & 0x80)
+            self.linear_period = value & 0x7F
+        elif register == 2:
+            self.period = self.period & 0x700 | value
+        elif register == 3:
+            self.period = self.period & 0xFF | (value & 7) << 8
+            if self.enabled:
+                self.length = LENGTH_TABLE[value >> 3]
+            self.linear_reload = True
+
+    def quarter_frame(self):
+        if self.linear_reload:
+            self.linear = self.linear_period
+        elif self.linear > 0:
+            self.linear -= 1
+        if not self.control:
+            self.linear_reload = False
+
+    def half_frame(self):
+        if not self.control and self.length > 0:
+            self.length -= 1
+
+    def run(self, cycles: ndarray) -> ndarray | int:
+        # A silenced triangle stops where it is and keeps outputting that step. Periods under 2 are
+        # ultrasonic, and hold their step too rather than alias
+        self.timer.period = self.period + 1
+        clocks = self.timer.run(cycles)
+        if self.linear == 0 or self.length == 0 or self.period < 2:
+            return int(TRIANGLE_SEQUENCE[self.step])
+        step = self.step
+        self.step = (step + int(clocks[-1])) & 31
+        return TRIANGLE_SEQUENCE[(step + clocks) & 31]
+
+
+class NoiseChannel:
+    def __init__(self):
+        self.enabled = False
+        self.envelope = EnvelopeUnit()
+        self.length = 0
+        self.short_period = False
+        self.timer = Timer()
+        self.timer.period = NOISE_PERIODS[0]
+        # On power-up, the shift register is loaded with the value 1
+        self.lfsr = 1
+
+    def write(self, register: int, value: int):
+        if register == 0:
+            self.envelope.write(value)
+        elif register == 2:
+            self.short_period = bool(value & 0x80)
+            self.timer.period = NOISE_PERIODS[value & 0x0F]
+        elif register == 3:
+            if self.enabled:
+                self.length = LENGTH_TABLE[value >> 3]
+            self.envelope.start = True
+
+    def quarter_frame(self):
+        self.envelope.clock()
+
+    def half_frame(self):
+        if not self.envelope.loop and self.length > 0:
+            self.length -= 1
+
+    def run(self, cycles: ndarray) -> ndarray | int:
+        clocks = self.timer.run(cycles)
+        orbit, start, length, position = lfsr_orbits(self.short_period)
+        lfsr = self.lfsr
+        first, cycle, at = int(start[lfsr]), int(length[lfsr]), int(position[lfsr])
+        self.lfsr = int(orbit[first + (at + int(clocks[-1])) % cycle])
+        volume = self.envelope.output
+        if self.length == 0 or volume == 0:
+            return 0
+        # Muted while bit 0 is set
+        states = orbit[first + (at + clocks) % cycle]
+        return (~states & 1) * volume
+
+
+class DmcChannel:
+    # Delta modulation: every clock moves the 7-bit output level up or down by 2 (if that stays in
+    # range) for each bit of the sample, read from memory a byte at a time, lowest bit first.
+    # The one-byte sample buffer between the memory reader and the output unit is folded into the
+    # reader, and IRQs are not raised since there is no CPU to take them
+    def __init__(self, memory: ndarray):
+        self.memory = memory
+        self.enabled = False
+        self.loop = False
+        self.timer = Timer()
+        self.timer.period = DMC_RATES[0]
+        self.level = 0
+        self.sample_address = DMC_MEMORY_START
+        self.sample_length = 1
+        self.address = DMC_MEMORY_START
+        self.remaining = 0
+        # Bits of the current byte not played yet
+        self.shift = 0
+        self.bits = 0
+
+    def write(self, register: int, value: int):
+        if register == 0:
+            self.loop = bool(value & 0x40)
+            self.timer.period = DMC_RATES[value & 0x0F]
+        elif register == 1:
+            self.level = value & 0x7F
+        elif register == 2:
+            self.sample_address = DMC_MEMORY_START + value * 64
+        else:
+            self.sample_length = value * 16 + 1
+
+    def restart(self):
+        self.address = self.sample_address
+        self.remaining = self.sample_length
+
+    @property
+    def playing(self) -> bool:
+        return self.remaining > 0 or self.bits > 0
+
+    def _take(self, count: int) -> ndarray:
+        # Up to count next bits of the sample, fewer if it runs out
+        pieces = []
+        taken = 0
+        while taken < count:
+            if self.bits:
+                take = min(self.bits, count - taken)
+                pieces.append(self.shift >> np.arange(take) & 1)
+                self.shift >>= take
+                self.bits -= take
+            elif self.remaining:
+                byte_count = min(self.remaining, -(-(count - taken) // 8))
+                # The address wraps from $FFFF to $8000
+                offsets = (self.address - 0x8000 + np.arange(byte_count)) % 0x8000
+                data = self.memory[offsets]
+                bits = np.unpackbits(data, bitorder='little')
+                take = min(bits.size, count - taken)
+                pieces.append(bits[:take])
+                self.bits = bits.size - take
+                self.shift = int(data[-1]) >> 8 - self.bits
+                self.address = 0x8000 + (int(offsets[-1]) + 1) % 0x8000
+                self.remaining -= byte_count
+                if self.remaining == 0 and self.loop:
+                    self.restart()
+            else:
+                break
+            taken += take
+        return np.concatenate(pieces) if pieces else np.zeros(0, uint8)
+
+    def run(self, cycles: ndarray) -> ndarray | int:
+        clocks = self.timer.run(cycles)
+        level = self.level
+        bits = self._take(int(clocks[-1]))
+        if bits.size == 0:
+            return level
+        levels = level + np.cumsum(np.where(bits, 2, -2))
+        if levels.min() < 0 or levels.max() > 127:
+            # A step that would leave 0 to 127 is skipped, which the running sum above does not know about
+            levels = levels.tolist()
+            current = level
+            for index, bit in enumerate(bits.tolist()):
+                if bit:
+                    if current <= 125:
+                        current += 2
+                elif current >= 2:
+                    current -= 2
+                levels[index] = current
+            levels = np.array(levels, int64)
+        self.level = int(levels[-1])
+        # Level after each clock; once the sample has run out, it holds
+        after = np.empty(int(clocks[-1]) + 1, int32)
+        after[0] = level
+        after[1:levels.size + 1] = levels
+        after[levels.size + 1:] = self.level
+        return after[clocks]
+
+
+class OutputFilter(StateSpaceFilter):
+    # The first-order high-pass filters after the NES mixer, at 90 and 440 Hz, as one state-space filter:
+    #   y1 = x + s1,  s1' = a1 s1 + (a1 - 1) x
+    #   y2 = y1 + s2, s2' = a2 s2 + (a2 - 1) y1
+    # Its 14 kHz low-pass is left to the averaging of each sample's cycles
+    def __init__(self, block_size: int, sample_rate: int = None):
+        super().__init__({'type': 'apu'}, 1, block_size)
+        sample_rate = sample_rate or settings.sample_rate
+        a1, a2 = (1 / (1 + 2 * np.pi * cutoff / sample_rate) for cutoff in (90, 440))
+        self.set_coefficients(
+            np.array([[a1, 0.0], [a2 - 1, a2]]),
+            np.array([a1 - 1, a2 - 1]),
+            np.array([1.0, 1.0]),
+            1.0
+        )
+
+
+class Apu:
+    # The 2A03's sound channels at the register level, run a CPU cycle at a time: pulse 1 and 2
+    # ($4000-$4007), triangle ($4008-$400B), noise ($400C-$400F), DMC ($4010-$4013), status ($4015)
+    # and the frame counter ($4017). Writes are timestamped in CPU cycles from the start of the next
+    # block. A block is cut into spans at the writes and frame counter steps, inside which no
+    # register changes, so every channel's timer and sequencer have a closed form that is evaluated
+    # for all the span's cycles at once. The channels go through the nonlinear mixer every cycle,
+    # and each output sample is the average of its cycles.
+    def __init__(self, sample_rate: int = None):
+        self.sample_rate = sample_rate or settings.sample_rate
+        self.cycles_per_sample = CPU_CLOCK / self.sample_rate
+        # CPU address space $8000-$FFFF, where the DMC reads samples from
+        self.memory = np.zeros(0x8000, uint8)
+        self.pulses = [PulseChannel(False), PulseChannel(True)]
+        self.triangle = TriangleChannel()
+        self.noise = NoiseChannel()
+        self.dmc = DmcChannel(self.memory)
+        self.five_step = False
+        self.frame_cycle = 0
+        self.frame_step = 0
+        # Fraction of a CPU cycle the next block starts into
+        self.phase = 0.0
+        self._writes: list[tuple[int, int, int]] = []
+        self._cycles = np.arange(1, 2, dtype=int32)
+
+    def load(self, address: int, data: bytes):
+        offset = address - 0x8000
+        assert 0 <= offset and offset + len(data) <= self.memory.size
+        self.memory[offset:offset + len(data)] = np.frombuffer(data, uint8)
+
+    def cycle(self, offset: int) -> int:
+        # The CPU cycle of the next block that sample offset falls on
+        return int(self.phase + offset * self.cycles_per_sample)
+
+    def write(self, address: int, value: int, cycle: int = 0):
+        self._writes.append((cycle, address, value & 0xFF))
+
+    def _apply(self, address: int, value: int):
+        if 0x4000 <= address <= 0x4007:
+            self.pulses[address >> 2 & 1].write(address & 3, value)
+        elif 0x4008 <= address <= 0x400B:
+            self.triangle.write(address & 3, value)
+        elif 0x400C <= address <= 0x400F:
+            self.noise.write(address & 3, value)
+        elif 0x4010 <= address <= 0x4013:
+            self.dmc.write(address & 3, value)
+        elif address == 0x4015:
+            for bit, channel in enumerate((*self.pulses, self.triangle, self.noise)):
+                channel.enabled = bool(value >> bit & 1)
+                if not channel.enabled:
+                    channel.length = 0
+            self.dmc.enabled = bool(value & 0x10)
+            if not self.dmc.enabled:
+                self.dmc.remaining = 0
+            elif self.dmc.remaining == 0:
+                self.dmc.restart()
+        elif address == 0x4017:
+            self.five_step = bool(value & 0x80)
+            self.frame_cycle = 0
+            self.frame_step = 0
+            if self.five_step:
+                self._clock_frame(True, True)
+
+    def _clock_frame(self, quarter: bool, half: bool):
+        channels = (*self.pulses, self.triangle, self.noise)
+        if quarter:
+            for channel in channels:
+                channel.quarter_frame()
+        if half:
+            for channel in channels:
+                channel.half_frame()
+
+    def _next_frame(self) -> int:
+        # Cycles until the frame counter's next step
+        steps, _ = FRAME_SEQUENCES[self.five_step]
+        return steps[self.frame_step][0] - self.frame_cycle
+
+    def _run(self, pulse: ndarray, tnd: ndarray):
+        # Fills the outputs of one span in which no register changes
+        cycles = self._cycles[:pulse.size]
+        pulse[:] = self.pulses[0].run(cycles)
+        pulse += self.pulses[1].run(cycles)
+        tnd[:] = self.dmc.run(cycles)
+        tnd += 3 * self.triangle.run(cycles)
+        tnd += 2 * self.noise.run(cycles)
+        self.frame_cycle += pulse.size
+
+    def render(self, samples: int) -> ndarray:
+        # The next samples samples of the mixer output, from 0 to 1
+        edges = (self.phase + np.arange(samples + 1) * self.cycles_per_sample).astype(int64)
+        count = int(edges[-1])
+        self.phase += samples * self.cycles_per_sample - count
+        if self._cycles.size < count:
+            self._cycles = np.arange(1, count + 1, dtype=int32)
+        self._writes.sort(key=itemgetter(0))
+        due = [write for write in self._writes if write[0] < count]
+        self._writes = [(cycle - count, address, value) for cycle, address, value in self._writes[len(due):]]
+        pulse = np.empty(count, int32)
+        tnd = np.empty(count, int32)
+        position = 0
+        next_write = 0
+        while position < count:
+            while next_write < len(due) and due[next_write][0] <= position:
+                self._apply(*due[next_write][1:])
+                next_write += 1
+            frame = position + self._next_frame()
+            end = min(frame, due[next_write][0] if next_write < len(due) else count, count)
+            if end > position:
+                self._run(pulse[position:end], tnd[position:end])
+                position = end
+            if position == frame:
+                steps, length = FRAME_SEQUENCES[self.five_step]
+                _, quarter, half = steps[self.frame_step]
+                self._clock_frame(quarter, half)
+                self.frame_step += 1
+                if self.frame_step == len(steps):
+                    self.frame_step = 0
+                    self.frame_cycle -= length
+        mixed = PULSE_TABLE[pulse] + TND_TABLE[tnd]
+        return np.add.reduceat(mixed, edges[:-1]) / np.diff(edges)
+
+
+class ApuVoice(NamedTuple):
+    # How a voice template plays on the APU: the kind of channel, and what it needs besides a pitch
+    kind: int
+    duty: int = 2
+    short_period: bool = False
+    # DMC only: the DPCM data, and whether it loops
+    sample: bytes = None
+    loop: bool = False
+    # Sequencer steps (or DMC bits) in one cycle of the template's waveform, to turn freq into a period
+    steps: int = 8
+
+
+def apu_voice(table_key: tuple, play_once: bool) -> ApuVoice | None:
+    # The channel for a wavetable or streamed template: squarewaves on the pulses, trianglewaves on the
+    # triangle, noisewaves on the noise and DPCM samples on the DMC. None for anything else, which
+    # the other engines keep playing
+    if table_key is None:
+        return None
+    if table_key[0] == 'builtin':
+        name, args = table_key[1], table_key[3:]
+    else:
+        info = json.loads(table_key[2])
+        if info['type'] == 'dpcm':
+            sample = samples_dir.joinpath(info['path']).read_bytes()[:DMC_MAX_LENGTH]
+            return ApuVoice(DMC, sample=sample, loop=not play_once, steps=len(sample) * 8)
+        if info['type'] != 'builtin':
+            return None
+        name, args = info['name'], info.get('args', [])
+    if name == 'squarewave':
+        duty = int(np.abs(np.array(DUTY_CYCLES) - args[1]).argmin()) if len(args) > 1 else 2
+        return ApuVoice(PULSE, duty=duty, steps=8)
+    if name == 'trianglewave':
+        return ApuVoice(TRIANGLE, steps=32)
+    if name == 'noisewave':
+        short_period = bool(args[1]) if len(args) > 1 else False
+        return ApuVoice(NOISE, short_period=short_period, steps=lfsr_sequence(short_period).size)
+    return None
+
+def _nearest(periods: list[int], period: float) -> int:
+    # Index of the closest of periods, by pitch
+    return int(np.abs(np.log(periods) - np.log(max(period, 1))).argmin())
+
+
+class ApuBank:
+    # The voices of one kind of APU channel, one voice a channel, with the same interface as the other
+    # banks so that the voice pool allocates and steals them. Like a sound driver running once a frame,
+    # it writes its channels' registers at the start of every block from the voices' envelopes, pitch
+    # and modulation; a note starts with writes at its own sample of the block. The APU is mono,
+    # so voices have no pan or sends, and their strip's gain is folded into their volume
+    def __init__(self, engine: 'ApuEngine', kind: int, channels: list[int], block_size: int = None):
+        self.engine = engine
+        self.kind = kind
+        self.channels = channels
+        self.capacity = len(channels)
+        block_size = block_size or settings.block_size
+        self.active = np.zeros(self.capacity, bool)
+        self.finished = np.zeros(self.capacity, bool)
+        self.freq = np.zeros(self.capacity, float64)
+        self.ratio = np.ones(self.capacity, float64)
+        self.volume = np.zeros(self.capacity, float64)
+        self.strip = np.zeros(self.capacity, int64)
+        self.duty = np.zeros(self.capacity, float64)
+        self.steps = np.zeros(self.capacity, float64)
+        # Sample of this block the voice starts at, -1 once it has started; and the channels to silence
+        self.onset = np.full(self.capacity, -1, int64)
+        self.silence = np.zeros(self.capacity, bool)
+        self.voices: list[ApuVoice | None] = [None] * self.capacity
+        # High bits of the period last written: writing them again would restart the pulse's phase
+        self._high = np.full(self.capacity, -1, int64)
+        self.envelopes = EnvelopeBank(self.capacity, block_size, [0])
+        self.modulators = ModulationBank(self.capacity, block_size)
+
+    def levels(self) -> ndarray:
+        return self.envelopes.level * self.volume
+
+    def start(
+        self,
+        voice: int,
+        apu: ApuVoice,
+        freq: float,
+        envelope: Envelope,
+        volume: float = 1.0,
+        offset: int = 0,
+        strip: int = 0,
+        modulation: Modulation = None
+    ):
+        self.voices[voice] = apu
+        self.freq[voice] = freq
+        self.ratio[voice] = 1.0
+        self.volume[voice] = volume
+        self.strip[voice] = strip
+        self.duty[voice] = DUTY_CYCLES[apu.duty]
+        self.steps[voice] = apu.steps
+        self.onset[voice] = offset
+        self.silence[voice] = False
+        self.finished[voice] = False
+        self.active[voice] = True
+        self.envelopes.start(voice, envelope, offset)
+        self.modulators.start(voice, modulation)
+
+    def bend(self, voice: int, ratio: float):
+        self.ratio[voice] = ratio
+
+    def release(self, voice: int, offset: int = 0):
+        self.envelopes.release(voice, offset)
+        self.modulators.release(voice, offset)
+
+    def stop(self, voice: int):
+        self.active[voice] = False
+        self.silence[voice] = True
+
+    def sounding(self) -> ndarray:
+        return np.flatnonzero(self.active & ~self.finished)
+
+    def drive(self, apu: Apu, strips: Strips):
+        # Writes the registers of the channels for the next block
+        for voice in np.flatnonzero(self.silence):
+            self._silence(apu, self.channels[voice])
+            self._high[voice] = -1
+        self.silence[:] = False
+        voices = self.sounding()
+        if voices.size == 0:
+            return
+        envelope = self.envelopes.render(voices)[:, 0]
+        self.finished[voices] = self.envelopes.finished[voices]
+        onsets = self.onset[voices]
+        self.onset[voices] = -1
+        # A note starting in the block sounds at its envelope's initial level from its own sample
+        starting = onsets >= 0
+        envelope[starting] = self.envelopes.on_levels[voices[starting], 0]
+        gains = envelope * self.volume[voices] * strips.gain[self.strip[voices]]
+        freqs = self.freq[voices] * self.ratio[voices]
+        duty = self.duty[voices]
+        modulation = self.modulators.render(voices)
+        if modulation is not None:
+            gains[modulation.rows] *= modulation.gain[:, 0]
+            freqs[modulation.rows] *= modulation.ratio
+            duty = duty.copy()
+            duty[modulation.rows] += modulation.duty
+        levels = np.clip(np.round(gains * 15), 0, 15).astype(int64).tolist()
+        # CPU cycles a sequencer step (or DMC bit) lasts
+        periods = (CPU_CLOCK / (freqs * self.steps[voices])).tolist()
+        for index, voice in enumerate(voices.tolist()):
+            start = bool(starting[index])
+            cycle = apu.cycle(int(onsets[index])) if start else 0
+            self._write(apu, self.channels[voice], voice, levels[index], periods[index], duty[index], start, cycle)
+
+    def _silence(self, apu: Apu, channel: int):
+        if self.kind == PULSE:
+            apu.write(0x4000 + 4 * channel, 0x30)
+        elif self.kind == TRIANGLE:
+            apu.write(0x4008, 0x80)
+        elif self.kind == NOISE:
+            apu.write(0x400C, 0x30)
+        else:
+            apu.write(0x4015, 0x0F)
+
+    def _write(
+        self, apu: Apu, channel: int, voice: int, level: int, period: float, duty: float, start: bool, cycle: int
+    ):
+        if self.kind == PULSE:
+            # Timer period in APU cycles: a step lasts 2 (t + 1) CPU cycles
+            timer = min(max(round(period / 2) - 1, 0), 0x7FF)
+            duty_register = int(np.abs(np.array(DUTY_CYCLES) - np.clip(duty, 0, 1)).argmin())
+            base = 0x4000 + 4 * channel
+            # Halted length counter and constant volume; the sweep unit off, with negate set so that it
+            # never mutes low notes
+            apu.write(base, duty_register << 6 | 0x30 | level, cycle)
+            apu.write(base + 1, 0x08, cycle)
+            apu.write(base + 2, timer & 0xFF, cycle)
+            if start or timer >> 8 != self._high[voice]:
+                apu.write(base + 3, timer >> 8, cycle)
+                self._high[voice] = timer >> 8
+        elif self.kind == TRIANGLE:
+            timer = min(max(round(period) - 1, 0), 0x7FF)
+            # With the control flag set, the linear counter holds its reload value: 127 to sound, 0 to stop
+            apu.write(0x4008, 0xFF if level > 0 else 0x80, cycle)
+            apu.write(0x400A, timer & 0xFF, cycle)
+            if start or timer >> 8 != self._high[voice]:
+                apu.write(0x400B, timer >> 8, cycle)
+                self._high[voice] = timer >> 8
+        elif self.kind == NOISE:
+            short_period = self.voices[voice].short_period
+            apu.write(0x400C, 0x30 | level, cycle)
+            apu.write(0x400E, short_period << 7 | _nearest(NOISE_PERIODS, period), cycle)
+            if start:
+                apu.write(0x400F, 0, cycle)
+        else:
+            apu_voice = self.voices[voice]
+            apu.write(0x4010, apu_voice.loop << 6 | _nearest(DMC_RATES, period), cycle)
+            if start:
+                address, length = self.engine.sample(apu_voice.sample)
+                apu.write(0x4011, 64, cycle)
+                apu.write(0x4012, address, cycle)
+                apu.write(0x4013, length, cycle)
+                # Stopping first restarts a sample that is still playing
+                apu.write(0x4015, 0x0F, cycle)
+                apu.write(0x4015, 0x1F, cycle)
+            elif level == 0 and apu.dmc.playing:
+                # The DMC has no volume: a voice that has faded out stops
+                apu.write(0x4015, 0x0F, cycle)
+
+    def update(self, apu: Apu):
+        # After the block: a one-shot sample is finished once the DMC has played it
+        if self.kind == DMC:
+            if not apu.dmc.playing:
+                self.finished[self.sounding()] = True
+
+
+class ApuEngine:
+    # The APU as an alternative to the wavetable engine (main.engine = "apu" in config.json): two
+    # pulse voices, a triangle, a noise and a DMC voice, with the voice pool stealing within each.
+    # Instruments with no matching channel keep playing on the other engines
+    def __init__(self, block_size: int = None, strips: Strips = None, sample_rate: int = None):
+        self.block_size = block_size or settings.block_size
+        self.strips = strips if strips is not None else Strips(1, settings.channels)
+        self.apu = Apu(sample_rate)
+        self.banks = [
+            ApuBank(self, PULSE, [0, 1], self.block_size),
+            ApuBank(self, TRIANGLE, [0], self.block_size),
+            ApuBank(self, NOISE, [0], self.block_size),
+            ApuBank(self, DMC, [0], self.block_size),
+        ]
+        self.filter = OutputFilter(self.block_size, sample_rate)
+        self._voices: dict[tuple, ApuVoice | None] = {}
+        self._samples: dict[bytes, tuple[int, int]] = {}
+        self._next_address = DMC_MEMORY_START
+        self.apu.write(0x4015, 0x0F)
+        self.apu.write(0x4017, 0x40)
+
+    def voice(self, table_key: tuple, play_once: bool) -> ApuVoice | None:
+        key = (table_key, play_once)
+        if key not in self._voices:
+            self._voices[key] = apu_voice(table_key, play_once)
+        return self._voices[key]
+
+    def bank(self, voice: ApuVoice) -> ApuBank:
+        return self.banks[voice.kind]
+
+    def sample(self, data: bytes) -> tuple[int, int]:
+        # $4012 and $4013 values of a DPCM sample, placed in DMC memory on first use. When memory runs
+        # out, placing starts over from $C000, over the samples loaded first
+        registers = self._samples.get(data)
+        if registers is None:
+            length = max(-(-(len(data) - 1) // 16), 0)
+            size = length * 16 + 1
+            if self._next_address + size > 0x10000:
+                self._next_address = DMC_MEMORY_START
+                self._samples.clear()
+            address = self._next_address
+            # Padded with alternating bits, which keep the level where it is
+            self.apu.load(address, data.ljust(size, b'\x55'))
+            registers = self._samples[data] = ((address - DMC_MEMORY_START) // 64, length)
+            self._next_address = address + -(-size // 64) * 64
+        return registers
+
+    def render(self, out: ndarray):
+        for bank in self.banks:
+            bank.drive(self.apu, self.strips)
+        samples = self.apu.render(self.block_size)
+        wave = self.filter.process((samples * OUTPUT_GAIN).astype(float32)[None])
+        # The main mix only: the APU's one channel goes to every output channel
+        out[:self.strips.channels] += wave
+        for bank in self.banks:
+            bank.update(self.apu)
@@ -1,13 +1,66 @@
 import json
 
+from argparse import ArgumentParser, Namespace
 from pathlib import Path
 
-_config_path = Path(__file__).parent.parent.joinpath('config.json')
-with _config_path.open() as f:
-    config = json.load(f)
+from .constants import SAMPLE_COUNT_IN_A_TICK, SAMPLE_RATE, TICK
+
+config_path = Path(__file__).parent.parent.joinpath('config.json')
+
+def load_config(path: Path = config_path) -> dict:
+    with path.open(encoding='utf-8') as f:
+        return json.load(f)
+
+# The config as loaded at startup; only the instrument sections can be reloaded later (see instruments.py)
+config = load_config()
 main_config = config['main']
 custom_waveforms = config['customWaveforms']
 custom_instruments = config['customInstruments']
 instrument_lists = config['instrumentLists']
 default_instrument = config['defaultInstrument']
 percussion_instrument = config['percussionInstrument']
+
+
+class Settings:
+    # Audio settings that are read when the mixer, voices and outputs are created,
+    # so they can be changed from the command line before that happens.
+    # sample_rate: output samples per second
+    # block_size: samples rendered per block; the output latency is a few blocks
+    # control_rate: envelope steps per second; ADSR times in config.json count these steps
+    # channels: 1 for mono or 2 for stereo output; blocks are interleaved frames
+    def __init__(self, main_config: dict):
+        self.sample_rate = int(main_config.get('sampleRate', SAMPLE_RATE))
+        self.block_size = int(main_config.get('blockSize', SAMPLE_COUNT_IN_A_TICK))
+        self.control_rate = float(main_config.get('controlRate', 1 / TICK))
+        self.channels = int(main_config.get('channels', 2))
+
+    @property
+    def block_duration(self) -> float:
+        return self.block_size / self.sample_rate
+
+    def update(self, sample_rate: int = None, block_size: int = None, control_rate: float = None, channels: int = None):
+        if sample_rate is not None:
+            assert sample_rate > 0
+            self.sample_rate = sample_rate
+        if block_size is not None:
+            assert block_size > 0
+            self.block_size = block_size
+        if control_rate is not None:
+            assert control_rate > 0
+            self.control_rate = control_rate
+        if channels is not None:
+            assert channels in (1, 2)
+            self.channels = channels
+
+    @staticmethod
+    def add_arguments(parser: ArgumentParser):
+        parser.add_argument('--sample-rate', type=int, help='output sample rate in Hz, e.g. 44100 or 48000')
+        parser.add_argument('--block-size', type=int, help='samples rendered per block')
+        parser.add_argument('--control-rate', type=float, help='envelope steps per second')
+        parser.add_argument('--channels', type=int, choices=(1, 2), help='1 for mono, 2 for stereo output')
+
+    def apply_arguments(self, args: Namespace):
+        self.update(args.sample_rate, args.block_size, args.control_rate, args.channels)
+
+
+settings = Settings(main_config)
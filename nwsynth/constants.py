@@ -1,6 +1,7 @@
 from enum import IntEnum
 
 
+# Defaults only; the values in use are config.settings
 SAMPLE_RATE = 44100
 TICK = 1 / 60
 SAMPLE_COUNT_IN_A_TICK = int(SAMPLE_RATE * TICK)  # 735
@@ -10,8 +11,8 @@ TONE_KEYS = [ord(char) for char in 'QAWSEDFTGYHJIKOLP'] + [186, 222]
 MIDDLE_C_INDEX = 6
 # [123456789], key 4 is the default octave
 OCTAVE_SELECTION_KEYS = [vk for vk in range(49, 58)]
-# [zxcvbnm]
-INSTRUMEMT_SELECTION_KEYS = [ord(char) for char in 'ZXCVBNM']
+# [zxcvbnm,]
+INSTRUMEMT_SELECTION_KEYS = [ord(char) for char in 'ZXCVBNM'] + [188]
 # Numpad 0 to numpad 9
 PERCUSSION_INSTRUMENT_KEYS = [vk for vk in range(96, 106)]
 
@@ -19,3 +20,26 @@ class KeyStatus(IntEnum):
     PRESSED = 1
     RELEASED = 2
     FINISHED = 3
+
+class EventType(IntEnum):
+    PRESS = 1
+    RELEASE = 2
+    OCTAVE = 3
+    INSTRUMENT = 4
+    # MIDI events: vk is channel << 7 | note (or controller number), value is the data that goes with it
+    NOTE_ON = 5
+    NOTE_OFF = 6
+    PITCH_BEND = 7
+    CONTROL_CHANGE = 8
+    PROGRAM_CHANGE = 9
+    # Tracker pitch effects: vk is channel << 7, value is the detune of the channel's notes in cents
+    DETUNE = 10
+
+# Keys of MIDI notes are MIDI_KEY_BASE + (channel << 7 | note), above every virtual-key code
+MIDI_KEY_BASE = 0x100
+MIDI_MIDDLE_C = 60
+MIDI_MIDDLE_A = 69
+# General MIDI drums are on channel 10; from C1 on, notes play the percussion instruments in order
+MIDI_PERCUSSION_CHANNEL = 9
+MIDI_PERCUSSION_BASE_NOTE = 36
+MIDI_PITCH_BEND_CENTER = 8192
@@ -0,0 +1,165 @@
+import wave
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from numpy import int16, int32, ndarray
+
+
+# The output level moves in steps of 2 and stays within these bounds (0 to 126 on the real DMC, centered here)
+LEVEL_MIN = -64
+LEVEL_MAX = 62
+LEVEL_STEP = 2
+# Playback rate of the fastest NES DMC rate index, used as the default encoding rate
+NES_DMC_RATE = 33143.9
+DECODE_CHUNK = 1 << 14
+
+def decode_reference(data: bytes) -> list[int]:
+    # The bit-by-bit decoder, kept to validate decode() against
+    sample = []
+    frame = 0
+    for byte in data:
+        for bit_position in range(8):
+            value = byte & 1 << bit_position
+            # If the bit is 1, add 2; otherwise, subtract 2.
+            # But if adding or subtracting 2 would cause the output level to leave the 0-127 range,
+            # （注：此处初始值是0，那么范围为-64 ~ 63）
+            # leave the output level unchanged.
+            # This means subtract 2 only if the current level is at least 2,（也就是-62）
+            # or add 2 only if the current level is at most 125.（也就是61）
+            if value:
+                if frame <= 61:
+                    frame += 2
+            else:
+                if frame >= -62:
+                    frame -= 2
+            sample.append(frame * 256)
+    return sample
+
+def decode(data: bytes) -> ndarray:
+    # Each bit maps the level x to clip(x ± 2, LEVEL_MIN, LEVEL_MAX).
+    # Such clamped shifts compose into another clamped shift:
+    #   clip(clip(x + a1, l1, h1) + a2, l2, h2) == clip(x + a1 + a2, clip(l1 + a2, l2, h2), clip(h1 + a2, l2, h2))
+    # so the saturating running sum is an associative prefix scan, done here a chunk at a time in log2(chunk) steps.
+    bits = np.unpackbits(np.frombuffer(data, np.uint8), bitorder='little')
+    deltas = np.where(bits, LEVEL_STEP, -LEVEL_STEP).astype(int32)
+    levels = np.empty(deltas.size, int32)
+    level = 0
+    for start in range(0, deltas.size, DECODE_CHUNK):
+        shift = deltas[start:start + DECODE_CHUNK].copy()
+        low = np.full(shift.size, LEVEL_MIN, int32)
+        high = np.full(shift.size, LEVEL_MAX, int32)
+        distance = 1
+        while distance < shift.size:
+            # Compose every element with the one `distance` before it (which is applied first)
+            later_shift, later_low, later_high = shift[distance:], low[distance:], high[distance:]
+            new_shift = shift[:-distance] + later_shift
+            new_low = np.clip(low[:-distance] + later_shift, later_low, later_high)
+            new_high = np.clip(high[:-distance] + later_shift, later_low, later_high)
+            shift[distance:] = new_shift
+            low[distance:] = new_low
+            high[distance:] = new_high
+            distance *= 2
+        chunk = np.clip(level + shift, low, high)
+        levels[start:start + chunk.size] = chunk
+        level = int(chunk[-1])
+    return (levels * 256).astype(int16)
+
+def encode(sample: ndarray) -> bytes:
+    # Greedy delta modulation: step towards each input sample, clamped like the decoder.
+    # This is inherently sequential, so it runs as a plain loop over Python ints.
+    targets = np.clip(np.asarray(sample, np.float64) / 256, LEVEL_MIN, LEVEL_MAX).tolist()
+    bits = np.zeros(-(-len(targets) // 8) * 8, np.uint8)
+    level = 0
+    for index, target in enumerate(targets):
+        if target > level:
+            bits[index] = 1
+            if level <= LEVEL_MAX - LEVEL_STEP:
+                level += LEVEL_STEP
+        elif level >= LEVEL_MIN + LEVEL_STEP:
+            level -= LEVEL_STEP
+    # Padding bits alternate so that the tail stays around the last level
+    bits[len(targets)::2] = 1
+    return np.packbits(bits, bitorder='little').tobytes()
+
+def read_wav(path: Path, rate: float = None) -> tuple[ndarray, float]:
+    # Mono float samples on the int16 scale, optionally resampled to rate
+    with wave.open(str(path), 'rb') as f:
+        width, channels, frame_rate = f.getsampwidth(), f.getnchannels(), f.getframerate()
+        data = f.readframes(f.getnframes())
+    if width == 1:
+        sample = (np.frombuffer(data, np.uint8).astype(np.float64) - 128) * 256
+    elif width == 2:
+        sample = np.frombuffer(data, '<i2').astype(np.float64)
+    else:
+        raise ValueError(f'{path}: only 8-bit and 16-bit PCM WAV files are supported')
+    sample = sample.reshape(-1, channels).mean(axis=1)
+    if rate is not None and rate != frame_rate:
+        length = int(sample.size * rate / frame_rate)
+        sample = np.interp(np.arange(length) * frame_rate / rate, np.arange(sample.size), sample)
+        frame_rate = rate
+    return sample, frame_rate
+
+def convert(wav_path: Path, dmc_path: Path, rate: float = NES_DMC_RATE) -> dict:
+    sample, rate = read_wav(wav_path, rate)
+    data = encode(sample)
+    dmc_path.write_bytes(data)
+    decoded = decode(data)[:sample.size].astype(np.float64)
+    error = np.sqrt(np.mean((decoded - sample) ** 2)) if sample.size else 0.0
+    return {
+        'path': str(dmc_path),
+        'bytes': len(data),
+        # Whole-sample playback frequency for config.json that keeps the original speed
+        'freq': rate / (len(data) * 8),
+        'rms_error': float(error),
+    }
+
+def validate(dmc_path: Path) -> dict:
+    data = dmc_path.read_bytes()
+    reference = np.array(decode_reference(data), int16)
+    decoded = decode(data)
+    mismatches = int(np.count_nonzero(reference != decoded))
+    return {'path': str(dmc_path), 'samples': decoded.size, 'mismatches': mismatches}
+
+def _collect(paths: list[Path], suffix: str) -> list[Path]:
+    files = []
+    for path in paths:
+        if path.is_dir():
+            files.extend(sorted(path.glob(f'*{suffix}')))
+        else:
+            files.append(path)
+    return files
+
+def main(argv: list[str] = None):
+    parser = ArgumentParser(description='Convert WAV files to DPCM (.dmc) samples, or validate .dmc files')
+    parser.add_argument('--jobs', type=int, default=None, help='worker processes (default: one per CPU)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    convert_parser = commands.add_parser('convert', help='encode WAV files or directories of them')
+    convert_parser.add_argument('paths', type=Path, nargs='+')
+    convert_parser.add_argument('-o', '--output', type=Path, help='output directory (default: next to the input)')
+    convert_parser.add_argument('--rate', type=float, default=NES_DMC_RATE, help='DPCM bit rate to resample to')
+    validate_parser = commands.add_parser('validate', help='check that decode() matches the reference decoder')
+    validate_parser.add_argument('paths', type=Path, nargs='+')
+    args = parser.parse_args(argv)
+    with ProcessPoolExecutor(args.jobs) as pool:
+        if args.command == 'convert':
+            inputs = _collect(args.paths, '.wav')
+            outputs = [
+                (args.output or wav_path.parent).joinpath(wav_path.with_suffix('.dmc').name) for wav_path in inputs
+            ]
+            if args.output:
+                args.output.mkdir(parents=True, exist_ok=True)
+            for result in pool.map(convert, inputs, outputs, [args.rate] * len(inputs)):
+                print(f'{result["path"]}: {result["bytes"]} bytes, freq {result["freq"]:.3f}, rms error {result["rms_error"]:.1f}')
+        else:
+            failed = 0
+            for result in pool.map(validate, _collect(args.paths, '.dmc')):
+                status = 'OK' if result['mismatches'] == 0 else f'{result["mismatches"]} mismatching samples'
+                print(f'{result["path"]}: {result["samples"]} samples, {status}')
+                failed += result['mismatches'] != 0
+            if failed:
+                raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+from time import perf_counter
+
+import numpy as np
+from numpy import float32, float64, ndarray
+
+from .config import settings
+from .metrics import TIME_BUCKETS_MS, metrics
+
+
+class Effect:
+    # Processes whole (channels, samples) blocks on the bus and keeps its state across blocks.
+    # As a send, an effect hears the strips' send mix and only its wet output goes back to the bus.
+    def __init__(self, config: dict, channels: int, block_size: int, send: bool = False):
+        self.name = config.get('name', config['type'])
+        self.channels = channels
+        self.block_size = block_size
+        self.cpu_ms = 0.0
+        self._histogram = metrics.histogram(f'effect_{self.name}_ms', TIME_BUCKETS_MS)
+
+    def run(self, block: ndarray) -> ndarray:
+        start = perf_counter()
+        result = self.process(block)
+        self.cpu_ms = (perf_counter() - start) * 1000
+        if metrics.enabled:
+            self._histogram.observe(self.cpu_ms)
+        return result
+
+    def process(self, block: ndarray) -> ndarray:
+        raise NotImplementedError
+
+
+class StateSpaceFilter(Effect):
+    # A linear filter s' = A s + B x, y = C s + D x run a whole block at a time.
+    # Over a block of N samples this unrolls to
+    #   y = T x + O s,  s' = A^N s + K x
+    # where T is the lower-triangular Toeplitz matrix of the impulse response, so the recursion
+    # becomes a few matrix products; the matrices are computed once per set of coefficients.
+    def __init__(self, config: dict, channels: int, block_size: int, send: bool = False):
+        super().__init__(config, channels, block_size, send)
+        self.state = np.zeros((channels, 2), float64)
+
+    def set_coefficients(self, a: ndarray, b: ndarray, c: ndarray, d: float):
+        n = self.block_size
+        order = a.shape[0]
+        observe = np.empty((n, order))    # C A^k
+        control = np.empty((n, order))    # A^k B
+        power = np.eye(order)
+        for k in range(n):
+            observe[k] = c @ power
+            control[k] = power @ b
+            power = a @ power
+        response = np.empty(n)
+        response[0] = d
+        response[1:] = observe[:-1] @ b
+        lag = np.arange(n)[:, None] - np.arange(n)
+        toeplitz = np.where(lag >= 0, response[np.maximum(lag, 0)], 0)
+        self._toeplitz_t = np.ascontiguousarray(toeplitz.T, float32)
+        self._observe_t = observe.T.copy()
+        self._power_t = power.T.copy()
+        # Input sample j reaches the next block's state through A^(N - 1 - j) B
+        self._control_t = np.ascontiguousarray(control[::-1], float32)
+
+    def process(self, block: ndarray) -> ndarray:
+        result = block @ self._toeplitz_t
+        result += (self.state @ self._observe_t).astype(float32)
+        self.state = self.state @ self._power_t + block @ self._control_t
+        return result
+
+
+class Biquad(StateSpaceFilter):
+    # RBJ cookbook low-pass, high-pass and band-pass filters, in transposed direct form II:
+    #   y = b0 x + s1,  s1' = (b1 - a1 b0) x - a1 s1 + s2,  s2' = (b2 - a2 b0) x - a2 s1
+    def __init__(self, config: dict, channels: int, block_size: int, send: bool = False):
+        super().__init__(config, channels, block_size, send)
+        self.mode = config['type']
+        self.set_cutoff(config.get('cutoff', 1000.0), config.get('q', 0.7071))
+
+    def set_cutoff(self, cutoff: float, q: float):
+        w = 2 * np.pi * min(cutoff, settings.sample_rate * 0.49) / settings.sample_rate
+        alpha = np.sin(w) / (2 * q)
+        cos = np.cos(w)
+        if self.mode == 'lowpass':
+            b = np.array([(1 - cos) / 2, 1 - cos, (1 - cos) / 2])
+        elif self.mode == 'highpass':
+            b = np.array([(1 + cos) / 2, -(1 + cos), (1 + cos) / 2])
+        else:
+            b = np.array([alpha, 0, -alpha])
+        a0, a1, a2 = 1 + alpha, -2 * cos, 1 - alpha
+        b0, b1, b2 = b / a0
+        a1, a2 = a1 / a0, a2 / a0
+        self.set_coefficients(
+            np.array([[-a1, 1.0], [-a2, 0.0]]),
+            np.array([b1 - a1 * b0, b2 - a2 * b0]),
+            np.array([1.0, 0.0]),
+            b0
+        )
+
+
+class StateVariableFilter(StateSpaceFilter):
+    # Trapezoidal (zero-delay feedback) state-variable filter; mode is low, band, high or notch.
+    # Its two integrator states update linearly, so it runs on the same block matrices as the biquads.
+    def __init__(self, config: dict, channels: int, block_size: int, send: bool = False):
+        super().__init__(config, channels, block_size, send)
+        self.mode = config.get('mode', 'low')
+        self.set_cutoff(config.get('cutoff', 1000.0), config.get('q', 0.7071))
+
+    def set_cutoff(self, cutoff: float, q: float):
+        g = np.tan(np.pi * min(cutoff, settings.sample_rate * 0.49) / settings.sample_rate)
+        k = 1 / q
+        a1 = 1 / (1 + g * (g + k))
+        a2 = g * a1
+        a3 = g * a2
+        # band = a1 s1 - a2 s2 + a2 x,  low = a2 s1 + (1 - a3) s2 + a3 x,  high = x - k band - low
+        band_c, band_d = np.array([a1, -a2]), a2
+        low_c, low_d = np.array([a2, 1 - a3]), a3
+        high_c, high_d = -k * band_c - low_c, 1 - k * band_d - low_d
+        c, d = {
+            'low': (low_c, low_d),
+            'band': (band_c, band_d),
+            'high': (high_c, high_d),
+            'notch': (low_c + high_c, low_d + high_d),
+        }[self.mode]
+        self.set_coefficients(
+            np.array([[2 * a1 - 1, -2 * a2], [2 * a2, 1 - 2 * a3]]),
+            np.array([2 * a2, 2 * a3]),
+            c,
+            d
+        )
+
+
+class FeedbackComb:
+    # v[n] = x[n] + feedback * v[n - delay], computed `delay` samples at a time:
+    # within such a chunk no sample depends on another one of the same chunk
+    def __init__(self, channels: int, block_size: int, delay: int, feedback: float):
+        self.delay = max(int(delay), 1)
+        self.feedback = feedback
+        self._line = np.zeros((channels, self.delay + block_size), float32)
+
+    def process(self, block: ndarray) -> tuple[ndarray, ndarray]:
+        # Returns v and v delayed by `delay` samples, for this block
+        delay, size = self.delay, block.shape[1]
+        line = self._line
+        for start in range(0, size, delay):
+            end = min(start + delay, size)
+            target = line[:, delay + start:delay + end]
+            np.multiply(line[:, start:end], self.feedback, out=target)
+            target += block[:, start:end]
+        value = line[:, delay:delay + size].copy()
+        delayed = line[:, :size].copy()
+        line[:, :delay] = line[:, size:size + delay]
+        return value, delayed
+
+
+class Delay(Effect):
+    # Feedback delay: wet is the line's output, fed back into its input
+    def __init__(self, config: dict, channels: int, block_size: int, send: bool = False):
+        super().__init__(config, channels, block_size, send)
+        self.dry = config.get('dry', 0.0 if send else 1.0)
+        self.wet = config.get('wet', 1.0 if send else 0.5)
+        delay = round(config.get('time', 0.25) * settings.sample_rate)
+        self._comb = FeedbackComb(channels, block_size, delay, config.get('feedback', 0.4))
+
+    def process(self, block: ndarray) -> ndarray:
+        _, delayed = self._comb.process(block)
+        delayed *= self.wet
+        if self.dry:
+            delayed += self.dry * block
+        return delayed
+
+
+class Reverb(Effect):
+    # Schroeder reverb: parallel feedback combs into series all-pass filters.
+    # Delays are Freeverb's, tuned for 44100 Hz and scaled to the sample rate.
+    COMB_DELAYS = (1557, 1617, 1491, 1422)
+    ALLPASS_DELAYS = (556, 225)
+
+    def __init__(self, config: dict, channels: int, block_size: int, send: bool = False):
+        super().__init__(config, channels, block_size, send)
+        self.dry = config.get('dry', 0.0 if send else 1.0)
+        self.wet = config.get('wet', 1.0 if send else 0.3)
+        scale = settings.sample_rate / 44100
+        feedback = config.get('roomSize', 0.84)
+        self.allpass_gain = config.get('allpassGain', 0.5)
+        self._combs = [FeedbackComb(channels, block_size, delay * scale, feedback) for delay in self.COMB_DELAYS]
+        self._allpasses = [
+            FeedbackComb(channels, block_size, delay * scale, self.allpass_gain) for delay in self.ALLPASS_DELAYS
+        ]
+
+    def process(self, block: ndarray) -> ndarray:
+        wet = np.zeros_like(block)
+        for comb in self._combs:
+            wet += comb.process(block)[1]
+        wet *= 1 / len(self._combs)
+        for allpass in self._allpasses:
+            # y = -g v + v[n - delay]
+            value, delayed = allpass.process(wet)
+            wet = delayed - self.allpass_gain * value
+        wet *= self.wet
+        if self.dry:
+            wet += self.dry * block
+        return wet
+
+
+EFFECT_TYPES = {
+    'lowpass': Biquad,
+    'highpass': Biquad,
+    'bandpass': Biquad,
+    'svf': StateVariableFilter,
+    'delay': Delay,
+    'reverb': Reverb,
+}
+
+def create_effect(config: dict, channels: int, block_size: int, send: bool = False) -> Effect:
+    # config: {"type": "lowpass", "cutoff": 8000, "q": 0.7071, "name": "..."} and so on;
+    # see each effect for its parameters
+    try:
+        effect_type = EFFECT_TYPES[config['type']]
+    except KeyError:
+        raise ValueError(f'Unknown effect type {config["type"]!r}') from None
+    return effect_type(config, channels, block_size, send)
@@ -0,0 +1,157 @@
+import numpy as np
+from numpy import float64, ndarray
+
+from .config import settings
+
+
+MAX_SEGMENTS = 8
+
+class Envelope:
+    # A compiled envelope: breakpoints in samples for the note-on stage (ending on the sustain level)
+    # and for the release stage (levels relative to the level at release, ending on 0).
+    # Both are padded to MAX_SEGMENTS segments by repeating the last breakpoint.
+    def __init__(self, on: list[tuple[float, float, float]], initial: float, release: list[tuple[float, float, float]]):
+        self.on_times, self.on_levels, self.on_curves = self._breakpoints(on, initial)
+        self.release_times, self.release_levels, self.release_curves = self._breakpoints(release, 1.0)
+
+    @staticmethod
+    def _breakpoints(segments: list[tuple[float, float, float]], initial: float):
+        # segments: (duration in samples, target level, curve), where curve 0 is linear
+        # and any other value is the steepness of an exponential approach
+        if len(segments) > MAX_SEGMENTS:
+            raise ValueError(f'An envelope stage has at most {MAX_SEGMENTS} segments')
+        times = np.zeros(MAX_SEGMENTS + 1)
+        levels = np.full(MAX_SEGMENTS + 1, float(initial))
+        curves = np.zeros(MAX_SEGMENTS)
+        for index, (duration, level, curve) in enumerate(segments):
+            if duration < 0:
+                raise ValueError('Envelope segments cannot have a negative duration')
+            times[index + 1:] = times[index] + duration
+            levels[index + 1:] = level
+            curves[index] = curve
+        return times, levels, curves
+
+
+def compile_envelope(adsr: dict = None, sample_rate: int = None, control_rate: float = None) -> Envelope:
+    # Times in config.json count control ticks
+    samples_per_tick = (sample_rate or settings.sample_rate) / (control_rate or settings.control_rate)
+    if adsr is None:
+        # Full volume while held, silent as soon as released
+        return Envelope([], 1.0, [(0, 0.0, 0)])
+    if adsr['type'] in ('linear', 'exponential'):
+        # args: [initial volume, attack ticks, decay ticks, sustain volume, release ticks]
+        initial, attack, decay, sustain, release = adsr['args']
+        curve = 0 if adsr['type'] == 'linear' else adsr.get('curve', 5.0)
+        return Envelope(
+            [(attack * samples_per_tick, 1.0, curve), (decay * samples_per_tick, sustain, curve)],
+            initial,
+            [(release * samples_per_tick, 0.0, curve)]
+        )
+    if adsr['type'] == 'segments':
+        # points / release: [[ticks, level, curve], ...]; release levels are relative to the level at release
+        release = [(ticks * samples_per_tick, level, curve) for ticks, level, curve in adsr.get('release', [])]
+        if not release or release[-1][1] != 0:
+            release.append((0, 0.0, 0))
+        return Envelope(
+            [(ticks * samples_per_tick, level, curve) for ticks, level, curve in adsr['points']],
+            adsr.get('initial', 0.0),
+            release
+        )
+    raise ValueError(f'Unknown envelope type {adsr["type"]!r}')
+
+
+class EnvelopeBank:
+    # Per-sample gains for every voice, computed as arrays once per block.
+    # points: the samples of the block to compute gains for, every one by default
+    def __init__(self, capacity: int, block_size: int = None, points: list[float] = None):
+        self.on_times = np.zeros((capacity, MAX_SEGMENTS + 1))
+        self.on_levels = np.zeros((capacity, MAX_SEGMENTS + 1))
+        self.on_curves = np.zeros((capacity, MAX_SEGMENTS))
+        self.release_times = np.zeros((capacity, MAX_SEGMENTS + 1))
+        self.release_levels = np.zeros((capacity, MAX_SEGMENTS + 1))
+        self.release_curves = np.zeros((capacity, MAX_SEGMENTS))
+        # Samples since note on, when the note was released (inf while held), and the level it was released at
+        self.time = np.zeros(capacity)
+        self.released_at = np.full(capacity, np.inf)
+        self.release_level = np.zeros(capacity)
+        self.finished = np.zeros(capacity, bool)
+        # Gain at the end of the last rendered block
+        self.level = np.zeros(capacity)
+        self._block = block_size or settings.block_size
+        self._ramp = np.arange(self._block, dtype=float64) if points is None else np.array(points, float64)
+
+    def start(self, voice: int, envelope: Envelope, offset: int = 0):
+        self.on_times[voice] = envelope.on_times
+        self.on_levels[voice] = envelope.on_levels
+        self.on_curves[voice] = envelope.on_curves
+        self.release_times[voice] = envelope.release_times
+        self.release_levels[voice] = envelope.release_levels
+        self.release_curves[voice] = envelope.release_curves
+        # Negative until the note starts, offset samples into the next block
+        self.time[voice] = -offset
+        self.released_at[voice] = np.inf
+        self.finished[voice] = False
+        self.level[voice] = envelope.on_levels[0]
+
+    def release(self, voice: int, offset: int = 0):
+        # offset: samples into the next block at which the release starts
+        if self.released_at[voice] != np.inf:
+            return
+        at = self.time[voice] + offset
+        self.released_at[voice] = at
+        self.release_level[voice] = self._evaluate(
+            self.on_times[voice, None], self.on_levels[voice, None], self.on_curves[voice, None], np.array([[at]])
+        )[0, 0]
+
+    def render(self, voices: ndarray) -> ndarray:
+        time = self.time[voices, None] + self._ramp
+        gains = self._evaluate(self.on_times[voices], self.on_levels[voices], self.on_curves[voices], time)
+        released_at = self.released_at[voices]
+        released = released_at != np.inf
+        if released.any():
+            since = time[released] - released_at[released, None]
+            release_gains = self.release_level[voices[released], None] * self._evaluate(
+                self.release_times[voices[released]],
+                self.release_levels[voices[released]],
+                self.release_curves[voices[released]],
+                since
+            )
+            gains[released] = np.where(since >= 0, release_gains, gains[released])
+        if self.time[voices].min() < 0:
+            gains[time < 0] = 0
+        end = self.time[voices] + self._block
+        # A voice is done once its release has run out, or once it has decayed to a sustain level of 0
+        self.finished[voices] = np.where(
+            released,
+            end - released_at >= self.release_times[voices, -1],
+            (self.on_levels[voices, -1] == 0) & (end >= self.on_times[voices, -1])
+        )
+        self.time[voices] = end
+        self.level[voices] = gains[:, -1]
+        return gains
+
+    @staticmethod
+    def _evaluate(times: ndarray, levels: ndarray, curves: ndarray, time: ndarray) -> ndarray:
+        # times/levels: (voices, segments + 1), curves: (voices, segments), time: (voices, samples)
+        rows = np.arange(times.shape[0])[:, None]
+        # Most voices stay inside one segment for the whole block; only the others need a per-sample search
+        first = np.minimum((time[:, :1] >= times[:, 1:]).sum(axis=1), MAX_SEGMENTS - 1)
+        last = np.minimum((time[:, -1:] >= times[:, 1:]).sum(axis=1), MAX_SEGMENTS - 1)
+        segment = first[:, None]
+        crossing = first != last
+        if crossing.any():
+            segment = np.repeat(segment, time.shape[1], axis=1)
+            segment[crossing] = np.minimum(
+                (time[crossing, :, None] >= times[crossing, None, 1:]).sum(axis=2), MAX_SEGMENTS - 1
+            )
+        start, end = times[rows, segment], times[rows, segment + 1]
+        duration = np.broadcast_to(end - start, time.shape)
+        progress = np.divide(time - start, duration, out=np.ones_like(time), where=duration > 0)
+        np.clip(progress, 0, 1, out=progress)
+        curved = np.broadcast_to(curves[rows, segment] != 0, time.shape)
+        if curved.any():
+            # Exponential approach normalized to reach the target exactly at the end of the segment
+            k = np.broadcast_to(curves[rows, segment], time.shape)[curved]
+            progress[curved] = -np.expm1(-k * progress[curved]) / -np.expm1(-k)
+        low = levels[rows, segment]
+        return low + (levels[rows, segment + 1] - low) * progress
@@ -0,0 +1,47 @@
+from time import perf_counter
+
+
+class EventRing:
+    # Timestamped input events, from one producer thread (the keyboard listener) to one consumer (the audio thread).
+    # Slots are preallocated; only the producer advances _write and only the consumer advances _read,
+    # so neither side takes a lock.
+    def __init__(self, capacity: int = 256):
+        self.capacity = capacity
+        self._times = [0.0] * capacity
+        self._types = [0] * capacity
+        self._keys = [0] * capacity
+        self._values = [0] * capacity
+        self._write = 0
+        self._read = 0
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return self._write - self._read
+
+    def put(self, type_: int, vk: int, time: float = None, value: int = 0) -> bool:
+        # time defaults to now on the perf_counter clock; events must be put in time order.
+        # value carries the velocity, controller value or pitch bend of MIDI events
+        if self._write - self._read >= self.capacity:
+            # The input thread never blocks; a full ring means the audio thread has stalled
+            self.dropped += 1
+            return False
+        index = self._write % self.capacity
+        self._times[index] = perf_counter() if time is None else time
+        self._types[index] = type_
+        self._keys[index] = vk
+        self._values[index] = value
+        self._write += 1
+        return True
+
+    def pop_before(self, until: float) -> list[tuple[float, int, int, int]]:
+        # (time, type, vk, value) of the events before until, oldest first; later ones stay for the next block
+        events = []
+        read, write = self._read, self._write
+        while read < write:
+            index = read % self.capacity
+            if self._times[index] >= until:
+                break
+            events.append((self._times[index], self._types[index], self._keys[index], self._values[index]))
+            read += 1
+        self._read = read
+        return events
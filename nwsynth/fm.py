@@ -0,0 +1,289 @@
+import numpy as np
+from numpy import float32, float64, int64, ndarray
+
+from .config import settings
+from .envelope import Envelope, EnvelopeBank, compile_envelope
+from .mixer import Strips
+from .modulation import Modulation, ModulationBank
+
+
+MAX_OPERATORS = 6
+# Feedback iterations stop once no sample can be further than FEEDBACK_TOLERANCE (of full scale) from the
+# exact result. Feedback too strong to get there in FEEDBACK_PASSES iterations over the block is solved
+# sample by sample instead, which costs about as much as that many iterations at 32 voices
+FEEDBACK_TOLERANCE = 1e-4
+FEEDBACK_PASSES = 16
+# Named algorithms: (modulator, modulated) connections and the carriers, operators counted from 0.
+# Operators may only modulate lower-numbered ones, so one pass from the last operator down renders them.
+ALGORITHMS = {
+    # 1 -> 0
+    'pair': ([(1, 0)], [0]),
+    # 3 -> 2 -> 1 -> 0
+    'stack': ([(3, 2), (2, 1), (1, 0)], [0]),
+    # 1 -> 0, 3 -> 2
+    'pairs': ([(1, 0), (3, 2)], [0, 2]),
+    # 1, 2 and 3 -> 0
+    'branch': ([(1, 0), (2, 0), (3, 0)], [0]),
+    # 3 -> 0, 1 and 2
+    'chord': ([(3, 0), (3, 1), (3, 2)], [0, 1, 2]),
+    # Additive: every operator is heard
+    'parallel': ([], [0, 1, 2, 3, 4, 5]),
+    # 5 -> 4 -> 3 -> 2 -> 1 -> 0
+    'stack6': ([(5, 4), (4, 3), (3, 2), (2, 1), (1, 0)], [0]),
+    # 2 -> 1 -> 0, 5 -> 4 -> 3
+    'stacks': ([(2, 1), (1, 0), (5, 4), (4, 3)], [0, 3]),
+}
+
+class FmPatch:
+    # A compiled fm instrument.
+    # modulation[i, j]: how much operator j's output (in radians) is added to operator i's phase;
+    # carriers[i]: how much of operator i is heard. Feedback feeds an operator's own previous sample
+    # back into its phase.
+    def __init__(
+        self,
+        ratios: ndarray,
+        detunes: ndarray,
+        fixed: ndarray,
+        levels: ndarray,
+        feedback: ndarray,
+        modulation: ndarray,
+        carriers: ndarray,
+        envelopes: list[Envelope],
+        amplitude: float
+    ):
+        self.operators = ratios.size
+        self.ratios = ratios
+        self.detunes = detunes
+        self.fixed = fixed
+        self.levels = levels
+        self.feedback = feedback
+        self.modulation = modulation
+        self.carriers = carriers
+        self.envelopes = envelopes
+        self.amplitude = amplitude
+
+
+def compile_patch(instrument: dict) -> FmPatch:
+    # instrument: {"type": "fm", "algorithm": "pairs", "amplitude": 2048, "operators": [
+    #     {"ratio": 1, "detune": 0, "freq": null, "level": 1, "feedback": 0, "adsr": {...}}, ...]}
+    # ratio multiplies the note's frequency (detune in cents on top), unless freq fixes it in Hz.
+    # level is the output level of a carrier, and the modulation index (peak phase deviation in
+    # radians) of a modulator. algorithm is a name from ALGORITHMS, or
+    # {"modulation": [[...], ...], "carriers": [...]} with one row and column per operator.
+    operators = instrument['operators']
+    count = len(operators)
+    if not 0 < count <= MAX_OPERATORS:
+        raise ValueError(f'An fm instrument has 1 to {MAX_OPERATORS} operators')
+    algorithm = instrument.get('algorithm', 'stack')
+    if isinstance(algorithm, str):
+        try:
+            connections, heard = ALGORITHMS[algorithm]
+        except KeyError:
+            raise ValueError(f'Unknown fm algorithm {algorithm!r}') from None
+        modulation = np.zeros((count, count))
+        for source, target in connections:
+            if source < count:
+                modulation[target, source] = 1.0
+        carriers = np.zeros(count)
+        carriers[[carrier for carrier in heard if carrier < count]] = 1.0
+    else:
+        modulation = np.array(algorithm['modulation'], float64)
+        carriers = np.array(algorithm['carriers'], float64)
+        if modulation.shape != (count, count) or carriers.shape != (count,):
+            raise ValueError('The fm algorithm needs one row and column of modulation and one carrier per operator')
+    if np.tril(modulation).any():
+        raise ValueError('fm operators can only modulate lower-numbered operators; use feedback for loops')
+    feedback = np.array([operator.get('feedback', 0.0) for operator in operators], float64)
+    if (np.abs(feedback) >= 1).any():
+        raise ValueError('fm feedback must be between -1 and 1')
+    fixed = np.array([operator.get('freq') or 0.0 for operator in operators], float64)
+    return FmPatch(
+        np.array([operator.get('ratio', 1.0) for operator in operators], float64),
+        np.array([operator.get('detune', 0.0) for operator in operators], float64),
+        fixed,
+        np.array([operator.get('level', 1.0) for operator in operators], float64),
+        feedback,
+        modulation,
+        carriers,
+        [compile_envelope(operator.get('adsr', instrument.get('adsr'))) for operator in operators],
+        # Carriers share the amplitude, so that an algorithm with more of them is not louder
+        instrument.get('amplitude', 2048) / max(carriers.sum(), 1.0)
+    )
+
+
+class FmBank:
+    # Struct-of-arrays state for every fm voice, with the same interface as VoiceBank.
+    # Each voice has MAX_OPERATORS sine operators (unused ones have level 0) with their own phase and
+    # envelope; the operator envelopes live in one EnvelopeBank, row voice * MAX_OPERATORS + operator.
+    # A block renders every operator of every sounding voice at once, operator by operator from the
+    # highest-numbered: each one's modulation is then already known for the whole block.
+    # Feedback depends on the previous sample, so within a block it is solved by fixed-point
+    # iteration: y = sin(phase + feedback * y delayed by one sample), starting from the sine without
+    # feedback. The first guess is off by at most |feedback| and every iteration shrinks the error by
+    # that factor again, so how strong the feedback is tells how many iterations it takes; above
+    # FEEDBACK_PASSES the recurrence is run sample by sample across the voices, exactly.
+    def __init__(self, capacity: int = 32, block_size: int = None, strips: Strips = None):
+        self.capacity = capacity
+        self.active = np.zeros(capacity, bool)
+        self.finished = np.zeros(capacity, bool)
+        self.freq = np.zeros(capacity, float64)
+        self.volume = np.zeros(capacity, float64)
+        self.strip = np.zeros(capacity, int64)
+        self.pan = np.zeros(capacity, float64)
+        self.strips = strips if strips is not None else Strips(1, settings.channels)
+        self.amplitude = np.zeros(capacity, float64)
+        self.operators = np.zeros(capacity, int64)
+        # (voices, operators)
+        self.ratio = np.zeros((capacity, MAX_OPERATORS), float64)
+        self.fixed = np.zeros((capacity, MAX_OPERATORS), float64)
+        self.level = np.zeros((capacity, MAX_OPERATORS), float64)
+        self.feedback = np.zeros((capacity, MAX_OPERATORS), float64)
+        self.carriers = np.zeros((capacity, MAX_OPERATORS), float64)
+        # Phase in cycles and its increment per output sample; the last output of each operator, for feedback
+        self.phase = np.zeros((capacity, MAX_OPERATORS), float64)
+        self.increment = np.zeros((capacity, MAX_OPERATORS), float64)
+        self.last = np.zeros((capacity, MAX_OPERATORS), float64)
+        # (voices, modulated operator, modulating operator)
+        self.modulation = np.zeros((capacity, MAX_OPERATORS, MAX_OPERATORS), float64)
+        self.envelopes = EnvelopeBank(capacity * MAX_OPERATORS, block_size)
+        # Duty does not apply to sines
+        self.modulators = ModulationBank(capacity, block_size)
+        self.sample_rate = settings.sample_rate
+        self._ramp = np.arange(block_size or settings.block_size, dtype=float64)
+        self._operators = np.arange(MAX_OPERATORS)
+
+    def levels(self) -> ndarray:
+        # The loudest carrier of every voice
+        carriers = self.envelopes.level.reshape(self.capacity, MAX_OPERATORS) * self.level * self.carriers
+        return carriers.max(axis=1) * self.volume
+
+    def start(
+        self,
+        voice: int,
+        patch: FmPatch,
+        freq: float,
+        volume: float = 1.0,
+        offset: int = 0,
+        strip: int = 0,
+        pan: float = 0.0,
+        modulation: Modulation = None
+    ):
+        count = patch.operators
+        self.freq[voice] = freq
+        self.volume[voice] = volume
+        self.strip[voice] = strip
+        self.pan[voice] = pan
+        self.amplitude[voice] = patch.amplitude
+        self.ratio[voice] = 0
+        self.ratio[voice, :count] = patch.ratios * 2 ** (patch.detunes / 1200)
+        self.fixed[voice] = 0
+        self.fixed[voice, :count] = patch.fixed
+        self.level[voice] = 0
+        self.level[voice, :count] = patch.levels
+        self.feedback[voice] = 0
+        self.feedback[voice, :count] = patch.feedback
+        self.carriers[voice] = 0
+        self.carriers[voice, :count] = patch.carriers
+        self.operators[voice] = count
+        self.modulation[voice] = 0
+        self.modulation[voice, :count, :count] = patch.modulation
+        self.last[voice] = 0
+        self._tune(voice, 1.0)
+        # Wound back like VoiceBank's, so that every operator starts at phase 0 exactly at offset
+        self.phase[voice] = -offset * self.increment[voice]
+        for operator, envelope in enumerate(patch.envelopes):
+            self.envelopes.start(voice * MAX_OPERATORS + operator, envelope, offset)
+        self.modulators.start(voice, modulation)
+        self.finished[voice] = False
+        self.active[voice] = True
+
+    def _tune(self, voice: int, ratio: float):
+        freq = np.where(self.fixed[voice] > 0, self.fixed[voice], self.freq[voice] * ratio * self.ratio[voice])
+        self.increment[voice] = freq / self.sample_rate
+
+    def bend(self, voice: int, ratio: float):
+        # Operators with a fixed frequency are not bent
+        self._tune(voice, ratio)
+
+    def release(self, voice: int, offset: int = 0):
+        for row in range(voice * MAX_OPERATORS, voice * MAX_OPERATORS + self.operators[voice]):
+            self.envelopes.release(row, offset)
+        self.modulators.release(voice, offset)
+
+    def stop(self, voice: int):
+        self.active[voice] = False
+
+    def sounding(self) -> ndarray:
+        return np.flatnonzero(self.active & ~self.finished)
+
+    def render(self, out: ndarray, voices: ndarray = None):
+        if voices is None:
+            voices = self.sounding()
+        if voices.size == 0:
+            return
+        size = self._ramp.size
+        # Operators past a voice's own count have level 0 and are not carriers
+        operators = int(self.operators[voices].max())
+        rows = (voices[:, None] * MAX_OPERATORS + self._operators[:operators]).reshape(-1)
+        # (voices, operators, samples); phases are kept in float64, the sines only need float32
+        gains = self.envelopes.render(rows).reshape(voices.size, operators, size)
+        gains *= self.level[voices, :operators, None]
+        modulated = self.modulators.render(voices)
+        increment = self.increment[voices, :operators]
+        pan = self.pan[voices]
+        if modulated is not None:
+            # Operators with a fixed frequency keep it, as with pitch bend
+            fixed = self.fixed[voices[modulated.rows], :operators] > 0
+            increment = increment.copy()
+            increment[modulated.rows] *= np.where(fixed, 1.0, modulated.ratio[:, None])
+            gains[modulated.rows] *= modulated.gain[:, None]
+            pan = pan.copy()
+            pan[modulated.rows] += modulated.pan
+        phase = self.phase[voices, :operators, None] + increment[:, :, None] * self._ramp
+        angle = np.multiply(phase % 1.0, 2 * np.pi, dtype=float32)
+        outputs = np.zeros((voices.size, operators, size), float32)
+        modulation = self.modulation[voices, :operators, :operators].astype(float32)
+        feedback = self.feedback[voices, :operators].astype(float32)
+        for operator in range(operators - 1, -1, -1):
+            theta = angle[:, operator]
+            if operator < operators - 1:
+                # Every modulator of this operator has a higher number, so it is already rendered
+                theta += np.einsum('vj,vjs->vs', modulation[:, operator, operator + 1:], outputs[:, operator + 1:])
+            sine = np.sin(theta)
+            fed = np.flatnonzero(feedback[:, operator])
+            if fed.size:
+                sine[fed] = self._feedback(
+                    theta[fed], feedback[fed, operator, None], sine[fed], self.last[voices[fed], operator, None]
+                )
+            self.last[voices, operator] = sine[:, -1]
+            np.multiply(sine, gains[:, operator], out=outputs[:, operator], casting='unsafe')
+        wave = np.einsum('vo,vos->vs', self.carriers[voices, :operators].astype(float32), outputs)
+        wave *= self.amplitude[voices, None].astype(float32)
+        matrix = self.strips.matrix(self.strip[voices], self.volume[voices], pan)
+        out += matrix.astype(float32) @ wave
+        self.phase[voices, :operators] = (phase[:, :, -1] + increment) % 1.0
+        # Done once every carrier's envelope is
+        done = self.envelopes.finished[rows].reshape(voices.size, operators)
+        self.finished[voices] = (done | (self.carriers[voices, :operators] == 0)).all(axis=1)
+
+    @staticmethod
+    def _feedback(theta: ndarray, amount: ndarray, sine: ndarray, last: ndarray) -> ndarray:
+        # sine: the operator without feedback, the first guess
+        strength = float(np.abs(amount).max())
+        if strength ** (FEEDBACK_PASSES + 1) > FEEDBACK_TOLERANCE:
+            # Sample-major, so that each step reads and writes contiguous rows
+            rows = np.ascontiguousarray(theta.T)
+            y, amount = last[:, 0], amount[:, 0]
+            for row in rows:
+                y = np.sin(row + amount * y, out=row)
+            return rows.T
+        delayed = np.empty_like(sine)
+        delayed[:, :1] = last
+        # The change an iteration makes, times |feedback| / (1 - |feedback|), bounds the error left
+        tolerance = FEEDBACK_TOLERANCE * (1 - strength) / strength
+        for _ in range(FEEDBACK_PASSES):
+            delayed[:, 1:] = sine[:, :-1]
+            previous, sine = sine, np.sin(theta + amount * delayed)
+            if np.abs(sine - previous).max() <= tolerance:
+                break
+        return sine
@@ -0,0 +1,303 @@
+import json
+from collections.abc import Callable, Mapping
+from pathlib import Path
+from threading import Event, Thread
+from types import MappingProxyType
+from typing import NamedTuple
+
+import numpy as np
+from numpy import ndarray
+
+from .config import config_path, load_config, main_config
+from .constants import *
+from .envelope import Envelope, compile_envelope
+from .fm import FmPatch, compile_patch
+from .metrics import metrics
+from .mixer import STRIP_KEYBOARD, STRIP_PERCUSSION
+from .modulation import Modulation, compile_modulation
+from .stream import streaming_config
+from .waveform import WaveformLibrary, builtin_waveform, waveform_library
+
+
+INSTRUMENT_TYPES = ('builtin', 'custom', 'fm')
+OCTAVES = range(1, len(OCTAVE_SELECTION_KEYS) + 1)
+MIDI_NOTES = 128
+
+def keyboard_freqs(middle_a_freq: float, middle_c_offset: int = 0) -> dict[int, float]:
+    # When middle_a_freq is 440, this is {
+    #     # Low G to low B
+    #     'a': 196.00, 'w': 207.65, 's': 220.00, 'e': 233.08, 'd': 246.94,
+    #     # C to E
+    #     'f': 261.63, 't': 277.18, 'g': 293.66, 'y': 311.13, 'h': 329.63,
+    #     # F to A
+    #     'j': 349.23, 'i': 369.99, 'k': 392.00, 'o': 415.30, 'l': 440.00,
+    #     # B flat to high C
+    #     'p': 466.16, ';': 493.88, '\'': 523.25
+    # }
+    # with keys as the corresponding virtual key code, for octave 4
+
+    # [start] --- [-9 as Middle C] --- [0 as Middle A] --- [stop]
+    # and stop - start == len(TONE_KEYS) - 1
+    rel_freq_list = np.logspace(
+        -9 - MIDDLE_C_INDEX + middle_c_offset,
+        len(TONE_KEYS) - MIDDLE_C_INDEX - 10 + middle_c_offset,
+        num=len(TONE_KEYS),
+        base=pow(2, 1 / 12)
+    )
+    return {vk: float(rel_freq_list[index] * middle_a_freq) for index, vk in enumerate(TONE_KEYS)}
+
+
+class VoiceTemplate(NamedTuple):
+    # Everything a press needs to start a voice, resolved when the config is compiled.
+    # Wavetable voices look their table up by table_key (build makes it on a miss), streamed voices
+    # open the custom waveform named waveform under table_key, and fm voices play patch. Any voice may
+    # have a modulation matrix. Custom waveforms are only loaded on the first press that needs them;
+    # stream is None for a one-shot sample that streams if it is long, which its file tells.
+    freq: float
+    play_once: bool
+    envelope: Envelope
+    pan: float
+    strip: int
+    table_key: tuple = None
+    build: Callable[[], ndarray] = None
+    stream: bool | None = False
+    waveform: str = None
+    patch: FmPatch = None
+    modulation: Modulation = None
+
+
+class CompiledInstrument(NamedTuple):
+    name: str
+    type: str
+    # (vk, octave) of the keyboard, and MIDI note numbers, to the voice they play; missing keys play nothing
+    keys: Mapping[tuple[int, int], VoiceTemplate]
+    notes: tuple[VoiceTemplate | None, ...]
+
+
+class InstrumentIndex:
+    # The instrumentLists, customInstruments and percussionInstrument sections of config.json,
+    # validated and compiled once: every key and MIDI note maps straight to its voice template, with
+    # envelopes and fm patches compiled and waveforms checked. Nothing in it changes after compiling;
+    # a reloaded config is a new index.
+    def __init__(self, config: dict, middle_a_freq: float = MIDDLE_A_FREQ, waveforms: WaveformLibrary = None):
+        self.config = config
+        self.middle_a_freq = middle_a_freq
+        self.middle_c_offset = config['main'].get('middleCOffset', 0)
+        self.waveforms = waveforms if waveforms is not None else waveform_library(config['customWaveforms'])
+        self._freqs = keyboard_freqs(middle_a_freq, self.middle_c_offset)
+        self._envelopes: dict[str, Envelope] = {}
+        self._modulations: dict[str, Modulation | None] = {}
+        self.instruments = tuple(
+            self.compile_instrument(instrument, f'instrumentLists[{index}]')
+            for index, instrument in enumerate(config['instrumentLists'])
+        )
+        if not self.instruments:
+            raise ValueError('instrumentLists: at least one instrument is needed')
+        self.default = config.get('defaultInstrument', 0)
+        if not 0 <= self.default < len(self.instruments):
+            raise ValueError(f'defaultInstrument: no instrument {self.default}')
+        self.selection = MappingProxyType(dict(zip(INSTRUMEMT_SELECTION_KEYS, range(len(self.instruments)))))
+        self.percussion = tuple(
+            self._sample_template(key_info, key_info.get('adsr'), STRIP_PERCUSSION, f'percussionInstrument[{index}]')
+            for index, key_info in enumerate(config['percussionInstrument'])
+        )
+        self.percussion_keys = MappingProxyType(dict(zip(PERCUSSION_INSTRUMENT_KEYS, self.percussion)))
+        # General MIDI drums, from C1 on
+        self.percussion_notes = tuple(
+            self.percussion[note - MIDI_PERCUSSION_BASE_NOTE]
+            if 0 <= note - MIDI_PERCUSSION_BASE_NOTE < len(self.percussion) else None
+            for note in range(MIDI_NOTES)
+        )
+
+    def compile_instrument(self, instrument: dict, path: str = 'instrument') -> CompiledInstrument:
+        type_ = instrument.get('type')
+        if type_ not in INSTRUMENT_TYPES:
+            raise ValueError(f'{path}: unknown instrument type {type_!r}')
+        pan = instrument.get('pan', 0.0)
+        if type_ == 'custom':
+            name = instrument.get('name')
+            notes = self.config['customInstruments'].get(name)
+            if notes is None:
+                raise ValueError(f'{path}: no custom instrument {name!r} in customInstruments')
+            by_note = {}
+            for note, key_info in notes.items():
+                try:
+                    number = int(note)
+                except ValueError:
+                    raise ValueError(f'customInstruments.{name}: {note!r} is not a note number') from None
+                template = self._sample_template(
+                    key_info,
+                    instrument.get('adsr'),
+                    STRIP_KEYBOARD,
+                    f'customInstruments.{name}.{note}',
+                    pan,
+                    instrument.get('modulation')
+                )
+                by_note[number] = template
+            # Notes count semitones from middle C, on the keyboard and in MIDI alike, whatever the octave
+            keys = {
+                (vk, octave): by_note[index - MIDDLE_C_INDEX]
+                for index, vk in enumerate(TONE_KEYS) if index - MIDDLE_C_INDEX in by_note
+                for octave in OCTAVES
+            }
+            midi = tuple(by_note.get(note - MIDI_MIDDLE_C) for note in range(MIDI_NOTES))
+            return CompiledInstrument(name, type_, MappingProxyType(keys), midi)
+        if type_ == 'builtin':
+            make = self._builtin_maker(instrument, path)
+        else:
+            try:
+                patch = compile_patch(instrument)
+            except (KeyError, TypeError, ValueError) as error:
+                raise ValueError(f'{path}: {error}') from None
+            modulation = self._modulation(instrument.get('modulation'), path)
+            make = lambda freq: VoiceTemplate(freq, False, None, pan, STRIP_KEYBOARD, patch=patch, modulation=modulation)
+        keys = {
+            (vk, octave): make(self._freqs[vk] * 2 ** (octave - 4)) for vk in TONE_KEYS for octave in OCTAVES
+        }
+        # Every MIDI note has its own frequency, not only the ones on the keyboard
+        midi = tuple(
+            make(self.middle_a_freq * 2 ** ((note - MIDI_MIDDLE_A + self.middle_c_offset) / 12))
+            for note in range(MIDI_NOTES)
+        )
+        return CompiledInstrument(instrument.get('name', type_), type_, MappingProxyType(keys), midi)
+
+    def _builtin_maker(self, instrument: dict, path: str) -> Callable[[float], VoiceTemplate]:
+        name, args, length = instrument.get('name'), instrument.get('args', []), instrument.get('length')
+        try:
+            builtin_waveform(name, args, length)
+        except (AssertionError, KeyError, TypeError, ValueError):
+            raise ValueError(f'{path}: invalid builtin waveform {name!r} with args {args!r}') from None
+        envelope = self._envelope(instrument.get('adsr'), path)
+        modulation = self._modulation(instrument.get('modulation'), path)
+        pan = instrument.get('pan', 0.0)
+        table_key = ('builtin', name, length, *args)
+        build = lambda: builtin_waveform(name, args, length)
+        return lambda freq: VoiceTemplate(
+            freq, False, envelope, pan, STRIP_KEYBOARD, table_key, build, modulation=modulation
+        )
+
+    def _sample_template(
+        self, key_info: dict, adsr: dict, strip: int, path: str, pan: float = None, modulation: list[dict] = None
+    ) -> VoiceTemplate:
+        # modulation: the instrument's; percussion keys have their own
+        name = key_info.get('waveform')
+        info = self.config['customWaveforms'].get(name)
+        if info is None:
+            raise ValueError(f'{path}: no waveform {name!r} in customWaveforms')
+        freq = key_info.get('freq')
+        if not isinstance(freq, (int, float)) or freq <= 0:
+            raise ValueError(f'{path}: freq must be a positive number')
+        play_once = bool(key_info.get('play_once', False))
+        try:
+            self.waveforms.check(name)
+        except (AssertionError, KeyError, TypeError, ValueError) as error:
+            raise ValueError(f'{path}: cannot load waveform {name!r}: {error}') from None
+        # One-shot samples stream when the waveform says so ("stream": true), or when they are long
+        stream = info.get('stream')
+        if stream is not None:
+            stream = bool(stream)
+        # The waveform's definition is part of the key, so that a reloaded config never plays a stale table
+        table_key = ('custom', name, json.dumps(info, sort_keys=True))
+        return VoiceTemplate(
+            freq,
+            play_once,
+            self._envelope(adsr, path),
+            key_info.get('pan', 0.0) if pan is None else pan,
+            strip,
+            table_key,
+            lambda: self.waveforms[name],
+            play_once and stream,
+            name,
+            modulation=self._modulation(key_info.get('modulation', modulation), path)
+        )
+
+    def _envelope(self, adsr: dict, path: str) -> Envelope:
+        # Shared between the instruments with the same envelope
+        key = json.dumps(adsr, sort_keys=True)
+        envelope = self._envelopes.get(key)
+        if envelope is None:
+            try:
+                envelope = self._envelopes[key] = compile_envelope(adsr)
+            except (KeyError, TypeError, ValueError) as error:
+                raise ValueError(f'{path}: invalid adsr: {error}') from None
+        return envelope
+
+    def _modulation(self, routes: list[dict], path: str) -> Modulation | None:
+        key = json.dumps(routes, sort_keys=True)
+        if key not in self._modulations:
+            try:
+                self._modulations[key] = compile_modulation(routes)
+            except (KeyError, TypeError, ValueError) as error:
+                raise ValueError(f'{path}: invalid modulation: {error}') from None
+        return self._modulations[key]
+
+    def streams(self, template: VoiceTemplate) -> bool:
+        if template.stream is not None:
+            return template.stream
+        return self.waveforms.length(template.waveform) >= streaming_config.get('minSamples', 1 << 16)
+
+    def templates(self) -> list[VoiceTemplate]:
+        # Every distinct template of the index
+        unique = {}
+        for instrument in self.instruments:
+            for template in (*instrument.keys.values(), *instrument.notes):
+                if template is not None:
+                    unique[id(template)] = template
+        for template in self.percussion:
+            unique[id(template)] = template
+        return list(unique.values())
+
+
+class ConfigReloader:
+    # Watches config.json and hands the sound generator a new instrument index whenever it changes.
+    # The index is compiled in this thread and swapped in between two blocks, so the audio never
+    # waits for it, and voices that are sounding keep playing what they were started with. A config
+    # that fails to compile is counted in the metrics, with its error, and the current one stays.
+    # Only the instrument sections are reloaded; the audio settings in main need a restart.
+    def __init__(self, sg, path: Path = config_path, interval: float = None):
+        self._sg = sg
+        self._path = Path(path)
+        self._interval = interval or main_config.get('hotReloadInterval', 1.0)
+        self._stop = Event()
+        self._thread = None
+        self._mtime = self._modified()
+        self.reloads = metrics.counter('config_reloads')
+        self.errors = metrics.counter('config_reload_errors')
+        # The error of the last config that failed, empty once one reloads
+        self.last_error = metrics.gauge('config_reload_error')
+
+    def _modified(self) -> int:
+        try:
+            return self._path.stat().st_mtime_ns
+        except OSError:
+            return 0
+
+    def start(self):
+        self._thread = Thread(target=self._watch, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _watch(self):
+        while not self._stop.wait(self._interval):
+            self.check()
+
+    def check(self) -> bool:
+        # Reloads if the file changed since the last check; True if a new index was handed over
+        mtime = self._modified()
+        if mtime == self._mtime:
+            return False
+        self._mtime = mtime
+        try:
+            self._sg.reload(load_config(self._path))
+        except (OSError, KeyError, TypeError, ValueError) as error:
+            # json.JSONDecodeError is a ValueError
+            self.errors.inc()
+            self.last_error.set(f'{self._path.name} not reloaded: {error}')
+            return False
+        self.reloads.inc()
+        self.last_error.set('')
+        return True
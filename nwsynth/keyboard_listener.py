@@ -1,44 +1,226 @@
-from pynput.keyboard import Listener
-from pynput.keyboard._win32 import Key, KeyCode
+import json
+import sys
+from pathlib import Path
+from threading import Event
+from time import perf_counter
 
 from .constants import *
+from .events import EventRing
 from .sound_generator import SoundGenerator
 
-class KeyboardListener:
-    def __init__(self, sg: SoundGenerator):
-        self._sg = sg
-        self._pressed_keys: set[int] = set()
-        self._listener = Listener(self._on_press, self._on_release)
-
-    def _on_press(self, key):
-        if key is not None:
-            if isinstance(key, KeyCode):
-                if key.char == '\x03':
-                    # Ctrl-C
-                    self._listener.stop()
-                    return
-                vk = key.vk
-            elif isinstance(key, Key):
-                vk = key.value.vk
-            if vk in OCTAVE_SELECTION_KEYS:
-                self._sg.set_octave(vk)
-            elif vk in INSTRUMEMT_SELECTION_KEYS:
-                self._sg.set_instrument(vk)
-            elif vk in TONE_KEYS + PERCUSSION_INSTRUMENT_KEYS and vk not in self._pressed_keys:
-                self._sg.key_events.put((vk, KeyStatus.PRESSED))
-                self._pressed_keys.add(vk)
-
-    def _on_release(self, key):
-        if key is not None:
-            if isinstance(key, KeyCode):
-                vk = key.vk
+
+# Key names that are not a single printable character
+KEY_NAMES = {
+    ';': 186,
+    ',': 188,
+    '\'': 222,
+    **{f'numpad{index}': vk for index, vk in enumerate(PERCUSSION_INSTRUMENT_KEYS)},
+}
+KEY_EVENT_TYPES = ('down', 'up')
+# X11 keysyms of numpad 0 to 9, which pynput reports as vk outside Windows
+X11_NUMPAD_KEYSYMS = range(0xFFB0, 0xFFBA)
+
+def key_to_vk(key) -> int:
+    if isinstance(key, int):
+        return key
+    if key in KEY_NAMES:
+        return KEY_NAMES[key]
+    if len(key) == 1:
+        return ord(key.upper())
+    raise ValueError(f'Unknown key {key!r}')
+
+def vk_to_key(vk: int) -> str | int:
+    # The name key_to_vk reads back, or vk itself for keys without one
+    for name, named_vk in KEY_NAMES.items():
+        if named_vk == vk:
+            return name
+    return chr(vk) if 0x20 < vk < 0x7F else vk
+
+def load_recording(path: Path) -> list[tuple[float, bool, int]]:
+    # A JSON list of {"time": seconds, "type": "down" | "up", "key": "F"}, as Recorder saves it;
+    # returns (time, down, vk) in time order
+    with Path(path).open() as f:
+        events = json.load(f)
+    return parse_recording(events)
+
+def parse_recording(events: list[dict]) -> list[tuple[float, bool, int]]:
+    result = []
+    for index, event in enumerate(events):
+        if event.get('type') not in KEY_EVENT_TYPES:
+            raise ValueError(f'[{index}]: unknown key event type {event.get("type")!r}')
+        result.append((float(event['time']), event['type'] == 'down', key_to_vk(event['key'])))
+    result.sort(key=lambda event: event[0])
+    return result
+
+
+class InputSource:
+    # Where key events come from. run() hands each key down and up to the listener, with its time on
+    # the perf_counter clock, and returns once the source is done or stopped
+    def run(self, listener: 'KeyboardListener'):
+        raise NotImplementedError
+
+    def stop(self):
+        pass
+
+
+class PynputSource(InputSource):
+    # The computer keyboard, through pynput's platform-neutral key objects. pynput is imported only
+    # when the source runs, so that headless hosts can import the package without it. Windows reports
+    # virtual key codes; elsewhere keys are mapped to them by their character, and numpad keys by
+    # their X11 keysym
+    def __init__(self):
+        self._listener = None
+
+    def run(self, listener: 'KeyboardListener'):
+        from pynput.keyboard import Key, KeyCode, Listener
+
+        def vk_of(key) -> int | None:
             if isinstance(key, Key):
-                vk = key.value.vk
-            if vk in self._pressed_keys:
-                if vk in TONE_KEYS:
-                    self._sg.key_events.put((vk, KeyStatus.RELEASED))
-                self._pressed_keys.remove(vk)
-    
-    def listen(self):
+                key = key.value
+            if not isinstance(key, KeyCode):
+                return None
+            if sys.platform == 'win32' and key.vk is not None:
+                return key.vk
+            if key.vk in X11_NUMPAD_KEYSYMS:
+                return PERCUSSION_INSTRUMENT_KEYS[key.vk - X11_NUMPAD_KEYSYMS.start]
+            if key.char:
+                try:
+                    return key_to_vk(key.char)
+                except ValueError:
+                    return None
+            return key.vk
+
+        def on_press(key):
+            if isinstance(key, KeyCode) and key.char == '\x03':
+                # Ctrl-C
+                self.stop()
+                return
+            vk = vk_of(key)
+            if vk is not None:
+                listener.key_down(vk)
+
+        def on_release(key):
+            vk = vk_of(key)
+            if vk is not None:
+                listener.key_up(vk)
+
+        self._listener = Listener(on_press, on_release)
         self._listener.start()
         self._listener.join()
+
+    def stop(self):
+        if self._listener is not None:
+            self._listener.stop()
+
+
+class ReplaySource(InputSource):
+    # Plays a recording back: each key event is handed over at its recorded time after run() starts,
+    # stamped with exactly that time, so the sound generator places it on the same sample however late
+    # this thread wakes up. Offline, feed() hands over the events before a time on the recording's own
+    # timeline instead, block by block
+    def __init__(self, events: list[tuple[float, bool, int]]):
+        self.events = events
+        # How long after its time run() handed each event over, in seconds
+        self.late = []
+        self._next = 0
+        self._stop = Event()
+
+    @property
+    def done(self) -> bool:
+        return self._next >= len(self.events)
+
+    def run(self, listener: 'KeyboardListener', start: float = None):
+        start = perf_counter() if start is None else start
+        while not self.done:
+            time, down, vk = self.events[self._next]
+            if self._stop.wait(max(start + time - perf_counter(), 0)):
+                return
+            self.late.append(perf_counter() - start - time)
+            self._hand_over(listener, start + time, down, vk)
+
+    def feed(self, listener: 'KeyboardListener', until: float, start: float = 0.0) -> int:
+        # Hands over the events before until, and returns how many
+        count = 0
+        while not self.done and start + self.events[self._next][0] < until:
+            time, down, vk = self.events[self._next]
+            self._hand_over(listener, start + time, down, vk)
+            count += 1
+        return count
+
+    def _hand_over(self, listener: 'KeyboardListener', time: float, down: bool, vk: int):
+        self._next += 1
+        if down:
+            listener.key_down(vk, time)
+        else:
+            listener.key_up(vk, time)
+
+    def stop(self):
+        self._stop.set()
+
+
+class Recorder:
+    # Keeps the key events a listener receives, with their times from the first one, to save as a recording
+    def __init__(self):
+        self.events: list[tuple[float, bool, int]] = []
+        self._start = None
+
+    def record(self, vk: int, down: bool, time: float = None):
+        time = perf_counter() if time is None else time
+        if self._start is None:
+            self._start = time
+        self.events.append((time - self._start, down, vk))
+
+    def save(self, path: Path):
+        with Path(path).open('w') as f:
+            json.dump([
+                {'time': round(time, 6), 'type': 'down' if down else 'up', 'key': vk_to_key(vk)}
+                for time, down, vk in self.events
+            ], f, indent=1)
+
+
+class KeyboardListener:
+    # Turns key downs and ups into sound generator events: number keys pick the octave, the bottom
+    # row the instrument, and the tone and numpad keys play, each once until it is let go.
+    # events: the ring to put them in, the sound generator's keyboard ring by default; give a
+    # source running next to the keyboard its own ring from sg.open_events()
+    def __init__(
+        self, sg: SoundGenerator, source: InputSource = None, recorder: Recorder = None, events: EventRing = None
+    ):
+        self._events = events if events is not None else sg.events
+        self.source = source if source is not None else PynputSource()
+        self.recorder = recorder
+        self._pressed_keys: set[int] = set()
+
+    def key_down(self, vk: int, time: float = None):
+        if self.recorder is not None:
+            self.recorder.record(vk, True, time)
+        if vk in OCTAVE_SELECTION_KEYS:
+            self._events.put(EventType.OCTAVE, vk, time)
+        elif vk in INSTRUMEMT_SELECTION_KEYS:
+            self._events.put(EventType.INSTRUMENT, vk, time)
+        elif vk in TONE_KEYS + PERCUSSION_INSTRUMENT_KEYS and vk not in self._pressed_keys:
+            self._events.put(EventType.PRESS, vk, time)
+            self._pressed_keys.add(vk)
+
+    def key_up(self, vk: int, time: float = None):
+        if self.recorder is not None:
+            self.recorder.record(vk, False, time)
+        if vk in self._pressed_keys:
+            if vk in TONE_KEYS:
+                self._events.put(EventType.RELEASE, vk, time)
+            self._pressed_keys.remove(vk)
+
+    def listen(self):
+        # Blocks until the source is done
+        self.source.run(self)
+
+    def stop(self):
+        self.source.stop()
+
+
+def recording_events(recording: list[tuple[float, bool, int]]) -> list[tuple[float, int, int, int]]:
+    # The sound generator events a recording turns into, on the recording's timeline, for offline rendering
+    ring = EventRing(len(recording) + 1)
+    listener = KeyboardListener(None, ReplaySource(recording), events=ring)
+    listener.source.feed(listener, float('inf'))
+    return ring.pop_before(float('inf'))
@@ -0,0 +1,149 @@
+import json
+from bisect import bisect_left
+from collections.abc import Callable
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from threading import Event, Thread
+from time import time
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    def __init__(self, function: Callable[[], float] = None):
+        # A gauge either holds the last value set, or asks function for it at snapshot time
+        self.value = 0
+        self._function = function
+
+    def set(self, value: float):
+        self.value = value
+
+    def snapshot(self):
+        return self._function() if self._function is not None else self.value
+
+
+class Histogram:
+    # Fixed buckets, so that observing a value costs one bisect and no allocation
+    def __init__(self, bounds: list[float]):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket the quantile falls in
+        target = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count:
+                return self.bounds[index] if index < len(self.bounds) else self.max
+        return 0.0
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'max': self.max,
+            'buckets': dict(zip([*map(str, self.bounds), 'inf'], self.counts)),
+        }
+
+
+# Tick render time in milliseconds, roughly logarithmic up to several ticks
+TIME_BUCKETS_MS = [0.1, 0.2, 0.5, 1, 2, 3, 5, 8, 12, 16.7, 25, 33, 50, 100]
+DEPTH_BUCKETS = [0, 1, 2, 4, 8, 16, 32, 64]
+
+class Metrics:
+    # Instrumentation points check `metrics.enabled` first, so collection costs one attribute lookup when off
+    def __init__(self):
+        self.enabled = False
+        self._metrics: dict[str, Counter | Gauge | Histogram] = {}
+        self._stop = Event()
+        self._server = None
+        self.tick_render_ms = self.histogram('tick_render_ms', TIME_BUCKETS_MS)
+        self.key_events_depth = self.histogram('key_events_depth', DEPTH_BUCKETS)
+        self.event_latency_ms = self.histogram('event_latency_ms', TIME_BUCKETS_MS)
+        self.active_voices = self.gauge('active_voices')
+        self.clipped_samples = self.counter('clipped_samples')
+        self.output_peak = self.gauge('output_peak')
+        self.output_rms = self.gauge('output_rms')
+
+    def counter(self, name: str) -> Counter:
+        return self._metrics.setdefault(name, Counter())
+
+    def gauge(self, name: str, function: Callable[[], float] = None) -> Gauge:
+        if function is not None:
+            self._metrics[name] = Gauge(function)
+        return self._metrics.setdefault(name, Gauge())
+
+    def histogram(self, name: str, bounds: list[float]) -> Histogram:
+        return self._metrics.setdefault(name, Histogram(bounds))
+
+    def snapshot(self) -> dict:
+        return {
+            'time': time(),
+            **{name: metric.snapshot() for name, metric in self._metrics.items()},
+        }
+
+    def configure(self, config: dict):
+        # config is the "metrics" object of config.json's main section
+        self.enabled = config.get('enabled', False)
+        if not self.enabled:
+            return
+        interval = config.get('interval', 1.0)
+        if config.get('file'):
+            Thread(target=self._dump, args=(Path(config['file']), interval), daemon=True).start()
+        if config.get('port'):
+            self._serve(config['port'])
+
+    def stop(self):
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+
+    def _dump(self, path: Path, interval: float):
+        while not self._stop.wait(interval):
+            temporary = path.with_suffix(path.suffix + '.tmp')
+            temporary.write_text(json.dumps(self.snapshot(), indent=4))
+            temporary.replace(path)
+
+    def _serve(self, port: int):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(metrics.snapshot()).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        # Bound to localhost only
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        Thread(target=self._server.serve_forever, daemon=True).start()
+
+
+metrics = Metrics()
@@ -0,0 +1,226 @@
+import struct
+from argparse import ArgumentParser
+from pathlib import Path
+from threading import Event, Thread
+from time import perf_counter
+
+from .config import main_config
+from .constants import *
+from .sound_generator import SoundGenerator
+
+
+midi_config = main_config.get('midi', {})
+# Stands in for the status byte of tempo changes while the tracks of a file are merged
+_TEMPO = 0x51
+DEFAULT_TEMPO = 500000  # microseconds per quarter note, 120 BPM
+
+def message_event(status: int, data1: int = 0, data2: int = 0) -> tuple[int, int, int] | None:
+    # (type, vk, value) for the event ring, or None for messages the synthesizer ignores
+    kind, channel = status & 0xF0, status & 0x0F
+    if kind == 0x90 and data2:
+        return EventType.NOTE_ON, channel << 7 | data1, data2
+    if kind in (0x80, 0x90):
+        # Note on with velocity 0 is a note off
+        return EventType.NOTE_OFF, channel << 7 | data1, 0
+    if kind == 0xB0:
+        return EventType.CONTROL_CHANGE, channel << 7 | data1, data2
+    if kind == 0xC0:
+        return EventType.PROGRAM_CHANGE, channel << 7, data1
+    if kind == 0xE0:
+        return EventType.PITCH_BEND, channel << 7, data2 << 7 | data1
+    return None
+
+def _read_varlen(data: bytes, position: int) -> tuple[int, int]:
+    value = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value = value << 7 | byte & 0x7F
+        if not byte & 0x80:
+            return value, position
+
+def _read_track(data: bytes, position: int, end: int) -> list[tuple[int, int, int, int]]:
+    # (tick, status, data1, data2) of the channel messages and tempo changes of one MTrk chunk
+    messages = []
+    tick = 0
+    running = 0
+    while position < end:
+        delta, position = _read_varlen(data, position)
+        tick += delta
+        status = data[position]
+        if status == 0xFF:
+            meta_type = data[position + 1]
+            length, position = _read_varlen(data, position + 2)
+            if meta_type == 0x51:
+                messages.append((tick, _TEMPO, int.from_bytes(data[position:position + 3], 'big'), 0))
+            elif meta_type == 0x2F:
+                # End of track
+                break
+            position += length
+        elif status in (0xF0, 0xF7):
+            # System exclusive
+            length, position = _read_varlen(data, position + 1)
+            position += length
+        else:
+            if status & 0x80:
+                running = status
+                position += 1
+            elif not running:
+                raise ValueError(f'Data byte without a status byte at offset {position}')
+            if running & 0xF0 in (0xC0, 0xD0):
+                messages.append((tick, running, data[position], 0))
+                position += 1
+            else:
+                messages.append((tick, running, data[position], data[position + 1]))
+                position += 2
+    return messages
+
+def read_midi_file(path: Path) -> list[tuple[float, int, int, int]]:
+    # (seconds, status, data1, data2) of every channel message of a format 0 or 1 standard MIDI file, in time order
+    data = Path(path).read_bytes()
+    if data[:4] != b'MThd':
+        raise ValueError(f'{path}: not a standard MIDI file')
+    header_length, = struct.unpack('>I', data[4:8])
+    format_, track_count, division = struct.unpack('>HHh', data[8:14])
+    if format_ == 2:
+        raise ValueError(f'{path}: format 2 (independent sequences) is not supported')
+    messages = []
+    position = 8 + header_length
+    for _ in range(track_count):
+        chunk, length = struct.unpack('>4sI', data[position:position + 8])
+        position += 8
+        if chunk == b'MTrk':
+            messages.extend(_read_track(data, position, position + length))
+        position += length
+    # Stable, so that simultaneous messages keep their track order, and tempo changes in track 0 come first
+    messages.sort(key=lambda message: message[0])
+    result = []
+    seconds = 0.0
+    last_tick = 0
+    tempo = DEFAULT_TEMPO
+    for tick, status, data1, data2 in messages:
+        if division > 0:
+            seconds += (tick - last_tick) * tempo / 1e6 / division
+        else:
+            # SMPTE time: the upper byte is minus the frame rate, the lower one ticks per frame
+            seconds = tick / (-(division >> 8) * (division & 0xFF))
+        last_tick = tick
+        if status == _TEMPO:
+            tempo = data1
+        else:
+            result.append((seconds, status, data1, data2))
+    return result
+
+def load_events(path: Path) -> list[tuple[float, int, int, int]]:
+    # (time, type, vk, value) of a MIDI file, as render() takes them
+    events = []
+    for time, status, data1, data2 in read_midi_file(path):
+        event = message_event(status, data1, data2)
+        if event is not None:
+            events.append((time, *event))
+    return events
+
+
+class MidiPort:
+    # A virtual MIDI port: messages sent to it are played by the SoundGenerator, as if a hardware
+    # port were looped back into the synthesizer. Each port has its own event ring, so that it can be
+    # fed from its own thread alongside the keyboard.
+    def __init__(self, sg: SoundGenerator, queue_size: int = None):
+        self.events = sg.open_events(queue_size or midi_config.get('queueSize', 4096))
+
+    def send(self, status: int, data1: int = 0, data2: int = 0, time: float = None) -> bool:
+        event = message_event(status, data1, data2)
+        if event is None:
+            return False
+        type_, vk, value = event
+        return self.events.put(type_, vk, time, value)
+
+    def note_on(self, note: int, velocity: int = 100, channel: int = 0, time: float = None) -> bool:
+        return self.send(0x90 | channel, note, velocity, time)
+
+    def note_off(self, note: int, channel: int = 0, time: float = None) -> bool:
+        return self.send(0x80 | channel, note, 0, time)
+
+    def control_change(self, control: int, value: int, channel: int = 0, time: float = None) -> bool:
+        return self.send(0xB0 | channel, control, value, time)
+
+    def program_change(self, program: int, channel: int = 0, time: float = None) -> bool:
+        return self.send(0xC0 | channel, program, 0, time)
+
+    def pitch_bend(self, value: int, channel: int = 0, time: float = None) -> bool:
+        # value from -8192 to 8191, 0 being no bend
+        value += MIDI_PITCH_BEND_CENTER
+        return self.send(0xE0 | channel, value & 0x7F, value >> 7, time)
+
+
+class MidiInput(MidiPort):
+    # A hardware or software MIDI input port, through the optional mido package
+    def __init__(self, sg: SoundGenerator, name: str = None, queue_size: int = None):
+        super().__init__(sg, queue_size)
+        mido = _import_mido()
+        self._port = mido.open_input(name, callback=self._on_message)
+
+    def _on_message(self, message):
+        if not message.is_meta:
+            data = message.bytes()
+            if 1 < len(data) <= 3:
+                self.send(*data)
+
+    def close(self):
+        self._port.close()
+
+
+class MidiFilePlayer(MidiPort):
+    # Plays a MIDI file in real time. Every message is timestamped with its scheduled time rather than
+    # the time it was sent, so thread wake-up jitter does not reach the output.
+    def __init__(self, sg: SoundGenerator, path: Path, queue_size: int = None):
+        super().__init__(sg, queue_size)
+        self.messages = read_midi_file(path)
+        self._stop = Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self._play, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _play(self):
+        start = perf_counter()
+        for time, status, data1, data2 in self.messages:
+            at = start + time
+            delay = at - perf_counter()
+            if delay > 0 and self._stop.wait(delay):
+                return
+            # A full ring drains within a block
+            while not self.send(status, data1, data2, at):
+                if message_event(status, data1, data2) is None or self._stop.wait(0.001):
+                    break
+
+
+def _import_mido():
+    try:
+        import mido
+    except ImportError as error:
+        raise RuntimeError('MIDI input needs the mido package, and a backend such as python-rtmidi') from error
+    return mido
+
+def input_names() -> list[str]:
+    return _import_mido().get_input_names()
+
+def main(argv: list[str] = None):
+    parser = ArgumentParser(description='List MIDI input ports, or dump the messages of a MIDI file')
+    parser.add_argument('file', type=Path, nargs='?', help='MIDI file to dump')
+    args = parser.parse_args(argv)
+    if args.file is None:
+        for name in input_names():
+            print(name)
+        return
+    for time, status, data1, data2 in read_midi_file(args.file):
+        print(f'{time:10.4f}  {status:02X} {data1:3d} {data2:3d}')
+
+if __name__ == '__main__':
+    main()
@@ -1,39 +1,137 @@
-from queue import SimpleQueue
-
 import numpy as np
-from numpy import int16, int32
-from pyaudio import PyAudio
+from numpy import float32, float64, int16, ndarray
 
-from .constants import *
+from .config import main_config, settings
+from .effects import create_effect
+from .metrics import metrics
+from .output import OutputEngine
 
 
 i16_info = np.iinfo(int16)
+mixer_config = main_config.get('mixer', {})
+
+PAN_LAWS = ('balance', 'constant_power')
+CLIPPERS = ('hard', 'soft', 'limiter')
+# Every voice is routed to one channel strip: keyboard notes, percussion keys, or one strip per MIDI channel
+STRIP_NAMES = ['keyboard', 'percussion', *(f'midi{channel}' for channel in range(1, 17))]
+STRIP_KEYBOARD = 0
+STRIP_PERCUSSION = 1
+STRIP_MIDI = 2
+
+def db_to_gain(db: float) -> float:
+    return 10 ** (db / 20)
+
+class Strips:
+    # Gain, pan (-1 left to 1 right) and send levels of the mixer's channel strips.
+    # balance keeps the centre at full level and turns the other side down;
+    # constant_power keeps the loudness while panning, at -3 dB in the centre.
+    def __init__(self, count: int, channels: int, pan_law: str = 'balance', sends: int = 0):
+        assert pan_law in PAN_LAWS
+        self.gain = np.ones(count, float64)
+        self.pan = np.zeros(count, float64)
+        self.sends = np.zeros((sends, count), float64)
+        self.channels = channels
+        self.pan_law = pan_law
+
+    @property
+    def rows(self) -> int:
+        # Rows of the bus: the main mix, then one group of channels per send
+        return self.channels * (1 + self.sends.shape[0])
+
+    def matrix(self, strip: ndarray, volume: ndarray, pan: ndarray) -> ndarray:
+        # (rows, voices) gains of voices routed to strip, with their own volume and pan on top of the strip's
+        gain = self.gain[strip] * volume
+        if self.channels == 1:
+            main = gain[None]
+        else:
+            pan = np.clip(self.pan[strip] + pan, -1, 1)
+            if self.pan_law == 'balance':
+                left, right = np.minimum(1 - pan, 1), np.minimum(1 + pan, 1)
+            else:
+                angle = (pan + 1) * (np.pi / 4)
+                left, right = np.cos(angle), np.sin(angle)
+            main = np.stack([gain * left, gain * right])
+        if not self.sends.shape[0]:
+            return main
+        # Sends are post-fader
+        return np.concatenate([main, *(main * level[strip] for level in self.sends)])
+
 
 class Mixer:
-    def __init__(self):
-        self.input_channels: dict[int, SimpleQueue[np.ndarray]] = {vk: SimpleQueue() for vk in TONE_KEYS + PERCUSSION_INSTRUMENT_KEYS}
-        self._audio = PyAudio()
-        self._stream = self._audio.open(
-            SAMPLE_RATE,
-            1,
-            self._audio.get_format_from_width(2),
-            output=True
-        )
+    def __init__(self, output: OutputEngine = None, block_size: int = None):
+        self.channels = settings.channels
+        self.block_size = block_size or settings.block_size
+        effects = mixer_config.get('effects', {})
+        # Inserts process the main mix in order; sends each get their own mix from the strips' send levels
+        self.inserts = [create_effect(config, self.channels, self.block_size) for config in effects.get('inserts', [])]
+        self.sends = [create_effect(config, self.channels, self.block_size, True) for config in effects.get('sends', [])]
+        self.strips = Strips(len(STRIP_NAMES), self.channels, mixer_config.get('panLaw', 'balance'), len(self.sends))
+        for name, strip in mixer_config.get('strips', {}).items():
+            index = STRIP_NAMES.index(name)
+            self.strips.gain[index] = db_to_gain(strip.get('gain', 0.0))
+            self.strips.pan[index] = strip.get('pan', 0.0)
+            for send, level in enumerate(strip.get('sends', [])[:len(self.sends)]):
+                self.strips.sends[send, index] = level
+        # Voices are mixed straight into this bus by the sound generator: the main mix, one row per output
+        # channel, followed by the send mixes. On the int16 scale; float32 leaves the clipper all the headroom it needs
+        self.buffer = np.zeros((self.strips.rows, self.block_size), float32)
+        self.gain = db_to_gain(mixer_config.get('gain', 0.0))
+        self.clipper = mixer_config.get('clipper', 'soft')
+        assert self.clipper in CLIPPERS
+        # soft: samples above knee (a fraction of full scale) are bent smoothly towards full scale
+        self.knee = mixer_config.get('knee', 0.9) * i16_info.max
+        # limiter: the gain drops at once to keep each block's peak at full scale, and recovers
+        # with this time constant
+        self._release = np.exp(-settings.block_duration / mixer_config.get('limiterRelease', 0.2))
+        self.limiter_gain = 1.0
+        self._magnitude = np.zeros((self.channels, self.block_size), float32)
+        self._ramp = np.arange(1, self.block_size + 1, dtype=float32) / self.block_size
+        # Interleaved frames handed to the output
+        self._frames = np.zeros((self.block_size, self.channels), int16)
+        if output is None:
+            output = OutputEngine(ticks_ahead=main_config.get('bufferTicks', 4))
+        self.output = output
 
     def __del__(self):
-        self._stream.close()
-        self._audio.terminate()
+        self.output.close()
 
     def mix(self):
-        # Use int32 to prevent overflow on int16 adding
-        wave = np.zeros(SAMPLE_COUNT_IN_A_TICK, int32)
-        for channel in self.input_channels.values():
-            if not channel.empty():
-                channel_wave = channel.get()
-                wave += channel_wave
-        # Convert to int16
-        wave.clip(i16_info.min, i16_info.max)
-        wave = wave.astype(int16)
-        print(np.std(wave).astype(int))
-        self._stream.write(wave.tobytes())
-            
\ No newline at end of file
+        bus = self.buffer[:self.channels]
+        for index, effect in enumerate(self.sends, 1):
+            bus += effect.run(self.buffer[index * self.channels:(index + 1) * self.channels])
+        for effect in self.inserts:
+            bus[:] = effect.run(bus)
+        if self.gain != 1:
+            bus *= self.gain
+        magnitude = np.abs(bus, out=self._magnitude)
+        if metrics.enabled:
+            metrics.clipped_samples.inc(int(np.count_nonzero(magnitude > i16_info.max)))
+            metrics.output_peak.set(float(magnitude.max()))
+            metrics.output_rms.set(float(np.sqrt(np.mean(np.square(bus, dtype=float64)))))
+        if self.clipper == 'soft':
+            self._soft_clip(bus, magnitude)
+        elif self.clipper == 'limiter':
+            self._limit(bus, magnitude)
+        # Whatever is left over full scale is cut, never wrapped around
+        np.clip(bus, i16_info.min, i16_info.max, out=bus)
+        np.copyto(self._frames, bus.T, casting='unsafe')
+        self.output.write(self._frames.reshape(-1))
+        self.buffer[:] = 0
+
+    def _soft_clip(self, bus: ndarray, magnitude: ndarray):
+        over = magnitude > self.knee
+        if over.any():
+            room = i16_info.max - self.knee
+            bent = self.knee + room * np.tanh((magnitude[over] - self.knee) / room)
+            bus[over] = np.copysign(bent, bus[over])
+
+    def _limit(self, bus: ndarray, magnitude: ndarray):
+        peak = magnitude.max()
+        target = min(1.0, i16_info.max / peak) if peak > 0 else 1.0
+        previous = self.limiter_gain
+        self.limiter_gain = min(target, 1 - (1 - previous) * self._release)
+        if self.limiter_gain < previous:
+            # Attack within the block, so that the peak is never over
+            bus *= self.limiter_gain
+        elif previous < 1:
+            bus *= previous + (self.limiter_gain - previous) * self._ramp
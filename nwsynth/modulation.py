@@ -0,0 +1,233 @@
+from typing import NamedTuple
+
+import numpy as np
+from numpy import float64, int64, ndarray
+
+from .config import settings
+from .envelope import Envelope, EnvelopeBank, compile_envelope
+
+
+MAX_ROUTES = 8
+MAX_STEPS = 16
+# Targets, and the unit of their amounts: semitones, dB, fraction of a cycle, and pan (-1 left to 1 right)
+MODULATION_TARGETS = ('pitch', 'volume', 'duty', 'pan')
+PITCH, VOLUME, DUTY, PAN = range(len(MODULATION_TARGETS))
+LFO_SHAPES = ('sine', 'triangle', 'square', 'saw', 'steps')
+SINE, TRIANGLE, SQUARE, SAW, STEPS = range(len(LFO_SHAPES))
+# How far duty modulation may move the middle of the cycle towards either end
+MIN_DUTY = 0.02
+
+class Modulation:
+    # A compiled modulation matrix: routes from an LFO or an envelope to a target, by an amount.
+    # Every array has MAX_ROUTES entries, the unused ones with an amount of 0.
+    # LFOs swing from -1 to 1 (steps play their own values), starting delay samples after the note
+    # and fading in over fade samples; envelopes go from 0 to 1 and follow the note's release.
+    def __init__(
+        self,
+        routes: int,
+        lfo: ndarray,
+        shapes: ndarray,
+        rates: ndarray,
+        phases: ndarray,
+        delays: ndarray,
+        fades: ndarray,
+        steps: ndarray,
+        step_counts: ndarray,
+        weights: ndarray,
+        envelopes: list[Envelope | None]
+    ):
+        self.routes = routes
+        self.lfo = lfo
+        self.shapes = shapes
+        # Cycles per sample
+        self.rates = rates
+        self.phases = phases
+        self.delays = delays
+        self.fades = fades
+        self.steps = steps
+        self.step_counts = step_counts
+        # (routes, targets): the amount of each route, in the column of its target
+        self.weights = weights
+        self.envelopes = envelopes
+
+
+def compile_modulation(routes: list[dict] = None, sample_rate: int = None, control_rate: float = None) -> Modulation | None:
+    # routes: [{"source": "lfo", "shape": "sine", "rate": 6, "target": "pitch", "amount": 0.3}, ...]
+    #   lfo: shape (sine, triangle, square, saw or steps), rate in cycles a second, phase in cycles,
+    #   delay and fade in control ticks; steps: the values a steps LFO goes through in a cycle,
+    #   such as [0, 4, 7] for an arpeggio with an amount of 1 semitone
+    #   envelope: adsr, as for instruments
+    # None if there are no routes
+    if not routes:
+        return None
+    if len(routes) > MAX_ROUTES:
+        raise ValueError(f'at most {MAX_ROUTES} modulation routes')
+    sample_rate = sample_rate or settings.sample_rate
+    samples_per_tick = sample_rate / (control_rate or settings.control_rate)
+    lfo = np.zeros(MAX_ROUTES, bool)
+    shapes = np.zeros(MAX_ROUTES, int64)
+    rates = np.zeros(MAX_ROUTES, float64)
+    phases = np.zeros(MAX_ROUTES, float64)
+    delays = np.zeros(MAX_ROUTES, float64)
+    fades = np.zeros(MAX_ROUTES, float64)
+    steps = np.zeros((MAX_ROUTES, MAX_STEPS), float64)
+    step_counts = np.ones(MAX_ROUTES, int64)
+    weights = np.zeros((MAX_ROUTES, len(MODULATION_TARGETS)), float64)
+    envelopes = [None] * MAX_ROUTES
+    for index, route in enumerate(routes):
+        target = route.get('target')
+        if target not in MODULATION_TARGETS:
+            raise ValueError(f'modulation[{index}]: unknown target {target!r}')
+        weights[index, MODULATION_TARGETS.index(target)] = route.get('amount', 1.0)
+        source = route.get('source', 'lfo')
+        if source == 'envelope':
+            envelopes[index] = compile_envelope(route['adsr'], sample_rate, control_rate)
+        elif source == 'lfo':
+            shape = route.get('shape', 'sine')
+            if shape not in LFO_SHAPES:
+                raise ValueError(f'modulation[{index}]: unknown LFO shape {shape!r}')
+            lfo[index] = True
+            shapes[index] = LFO_SHAPES.index(shape)
+            rates[index] = route.get('rate', 5.0) / sample_rate
+            phases[index] = route.get('phase', 0.0)
+            delays[index] = route.get('delay', 0) * samples_per_tick
+            fades[index] = route.get('fade', 0) * samples_per_tick
+            if shape == 'steps':
+                values = route.get('steps', [])
+                if not 0 < len(values) <= MAX_STEPS:
+                    raise ValueError(f'modulation[{index}]: from 1 to {MAX_STEPS} steps')
+                steps[index, :len(values)] = values
+                step_counts[index] = len(values)
+        else:
+            raise ValueError(f'modulation[{index}]: unknown source {source!r}')
+    return Modulation(len(routes), lfo, shapes, rates, phases, delays, fades, steps, step_counts, weights, envelopes)
+
+def lfo_values(
+    shapes: ndarray,
+    rates: ndarray,
+    phases: ndarray,
+    delays: ndarray,
+    fades: ndarray,
+    steps: ndarray,
+    step_counts: ndarray,
+    time: ndarray
+) -> ndarray:
+    # Parameters: (voices, routes), steps: (voices, routes, MAX_STEPS); time: samples since the note
+    # started, (voices, routes, points). Returns the LFOs' values at those times
+    since = time - delays[..., None]
+    cycle = (phases[..., None] + rates[..., None] * np.maximum(since, 0)) % 1.0
+    shape = shapes[..., None]
+    values = np.select(
+        [shape == SINE, shape == TRIANGLE, shape == SQUARE, shape == SAW],
+        [
+            np.sin(2 * np.pi * cycle),
+            4 * np.abs((cycle - 0.25) % 1.0 - 0.5) - 1,
+            np.where(cycle < 0.5, 1.0, -1.0),
+            2 * cycle - 1,
+        ],
+        np.take_along_axis(steps, (cycle * step_counts[..., None]).astype(int64), axis=-1)
+    )
+    fade = fades[..., None]
+    amplitude = np.where(fade > 0, np.clip(since / np.maximum(fade, 1), 0, 1), since >= 0)
+    return values * amplitude
+
+def warp(cycle: ndarray, duty: ndarray) -> ndarray:
+    # Moves the middle of every cycle to 0.5 + duty, squeezing one half and stretching the other:
+    # a square table's pulse width, and a skew for any other shape. cycle: (voices, samples)
+    middle = np.clip(0.5 + duty, MIN_DUTY, 1 - MIN_DUTY)[:, None]
+    warped = (cycle - middle) * (0.5 / (1 - middle)) + 0.5
+    np.multiply(cycle, 0.5 / middle, out=warped, where=cycle < middle)
+    return warped
+
+
+class ModulationBlock(NamedTuple):
+    # The modulation of a block, for the voices that have any
+    rows: ndarray  # their rows in the voices being rendered
+    ratio: ndarray  # pitch, as a ratio
+    duty: ndarray
+    gain: ndarray  # (rows, samples), ramped across the block
+    pan: ndarray
+
+class ModulationBank:
+    # The modulation matrix of every voice, evaluated as arrays once per block, at the start of the
+    # block and at the start of the next one. Pitch, duty and pan hold the value of the start of the
+    # block, as the pitch effects of old sound chips step once a frame; volume ramps between the two,
+    # so tremolo does not click. Route envelopes live in one EnvelopeBank, row voice * MAX_ROUTES + route.
+    # A voice's modulation runs from the start of the block its note starts in.
+    def __init__(self, capacity: int, block_size: int = None):
+        self.capacity = capacity
+        self.routes = np.zeros(capacity, int64)
+        self.lfo = np.zeros((capacity, MAX_ROUTES), bool)
+        self.shapes = np.zeros((capacity, MAX_ROUTES), int64)
+        self.rates = np.zeros((capacity, MAX_ROUTES), float64)
+        self.phases = np.zeros((capacity, MAX_ROUTES), float64)
+        self.delays = np.zeros((capacity, MAX_ROUTES), float64)
+        self.fades = np.zeros((capacity, MAX_ROUTES), float64)
+        self.steps = np.zeros((capacity, MAX_ROUTES, MAX_STEPS), float64)
+        self.step_counts = np.ones((capacity, MAX_ROUTES), int64)
+        self.weights = np.zeros((capacity, MAX_ROUTES, len(MODULATION_TARGETS)), float64)
+        # Samples since the note started, at the start of the next block
+        self.time = np.zeros(capacity, float64)
+        self._block = block_size or settings.block_size
+        self._points = np.array([0, self._block], float64)
+        self._ramp = np.arange(self._block, dtype=float64) / self._block
+        self._route_numbers = np.arange(MAX_ROUTES)
+        self.envelopes = EnvelopeBank(capacity * MAX_ROUTES, self._block, self._points)
+
+    def start(self, voice: int, modulation: Modulation = None):
+        if modulation is None:
+            self.routes[voice] = 0
+            return
+        self.routes[voice] = modulation.routes
+        self.lfo[voice] = modulation.lfo
+        self.shapes[voice] = modulation.shapes
+        self.rates[voice] = modulation.rates
+        self.phases[voice] = modulation.phases
+        self.delays[voice] = modulation.delays
+        self.fades[voice] = modulation.fades
+        self.steps[voice] = modulation.steps
+        self.step_counts[voice] = modulation.step_counts
+        self.weights[voice] = modulation.weights
+        self.time[voice] = 0
+        for route, envelope in enumerate(modulation.envelopes):
+            if envelope is not None:
+                self.envelopes.start(voice * MAX_ROUTES + route, envelope)
+
+    def release(self, voice: int, offset: int = 0):
+        for route in range(self.routes[voice]):
+            if not self.lfo[voice, route]:
+                self.envelopes.release(voice * MAX_ROUTES + route, offset)
+
+    def render(self, voices: ndarray) -> ModulationBlock | None:
+        # None when none of voices has any modulation
+        rows = np.flatnonzero(self.routes[voices])
+        if rows.size == 0:
+            return None
+        modulated = voices[rows]
+        routes = int(self.routes[modulated].max())
+        time = np.broadcast_to(self.time[modulated, None, None] + self._points, (rows.size, routes, 2))
+        values = lfo_values(
+            self.shapes[modulated, :routes],
+            self.rates[modulated, :routes],
+            self.phases[modulated, :routes],
+            self.delays[modulated, :routes],
+            self.fades[modulated, :routes],
+            self.steps[modulated, :routes],
+            self.step_counts[modulated, :routes],
+            time
+        )
+        envelope = ~self.lfo[modulated, :routes] & (self._route_numbers[:routes] < self.routes[modulated, None])
+        if envelope.any():
+            voice, route = np.nonzero(envelope)
+            values[voice, route] = self.envelopes.render(modulated[voice] * MAX_ROUTES + route)
+        # (voices, targets, points)
+        targets = np.einsum('vrp,vrt->vtp', values, self.weights[modulated, :routes])
+        self.time[modulated] += self._block
+        gain = 10 ** (targets[:, VOLUME] / 20)
+        return ModulationBlock(
+            rows,
+            2 ** (targets[:, PITCH, 0] / 12),
+            targets[:, DUTY, 0],
+            gain[:, :1] + (gain[:, 1:] - gain[:, :1]) * self._ramp,
+            targets[:, PAN, 0]
+        )
@@ -0,0 +1,297 @@
+import wave
+from pathlib import Path
+from threading import Thread
+from time import perf_counter, sleep
+
+import numpy as np
+from numpy import int16, ndarray
+
+from .config import settings
+from .metrics import metrics
+
+
+class RingBuffer:
+    # Single-producer/single-consumer ring of int16 samples.
+    # The producer only ever advances _write and the consumer only ever advances _read,
+    # so no lock is needed: both counters grow monotonically and are read atomically under the GIL.
+    def __init__(self, capacity: int):
+        assert capacity > 0
+        self.capacity = capacity
+        self._buffer = np.zeros(capacity, int16)
+        self._write = 0
+        self._read = 0
+
+    @property
+    def readable(self) -> int:
+        return self._write - self._read
+
+    @property
+    def writable(self) -> int:
+        return self.capacity - (self._write - self._read)
+
+    def write(self, data: ndarray) -> int:
+        count = min(data.size, self.writable)
+        start = self._write % self.capacity
+        first = min(count, self.capacity - start)
+        self._buffer[start:start + first] = data[:first]
+        self._buffer[:count - first] = data[first:count]
+        self._write += count
+        return count
+
+    def read_into(self, out: ndarray) -> int:
+        count = min(out.size, self.readable)
+        start = self._read % self.capacity
+        first = min(count, self.capacity - start)
+        out[:first] = self._buffer[start:start + first]
+        out[first:count] = self._buffer[:count - first]
+        self._read += count
+        return count
+
+
+class Backend:
+    # An audio sink that pulls samples from an OutputEngine at its own pace.
+    def start(self, engine: 'OutputEngine'):
+        raise NotImplementedError
+
+    def stop(self):
+        pass
+
+
+class PyAudioBackend(Backend):
+    def __init__(self):
+        self._audio = None
+        self._stream = None
+
+    def start(self, engine: 'OutputEngine'):
+        # Imported here so that headless sinks work without PyAudio installed
+        from pyaudio import PyAudio, paContinue
+
+        def callback(in_data, frame_count, time_info, status):
+            return engine.pull(frame_count).tobytes(), paContinue
+
+        self._audio = PyAudio()
+        self._stream = self._audio.open(
+            settings.sample_rate,
+            settings.channels,
+            self._audio.get_format_from_width(2),
+            output=True,
+            frames_per_buffer=settings.block_size,
+            stream_callback=callback
+        )
+        self._stream.start_stream()
+
+    def stop(self):
+        if self._stream is not None:
+            self._stream.stop_stream()
+            self._stream.close()
+            self._audio.terminate()
+            self._stream = None
+
+
+class NullBackend(Backend):
+    # Consumes samples on a thread of its own and throws them away.
+    # realtime=True paces the pulls like a sound card would; otherwise the sink waits for
+    # whole blocks and drains the ring as fast as the producer fills it.
+    def __init__(self, realtime: bool = True, block_size: int = None):
+        self.realtime = realtime
+        self.block_size = block_size or settings.block_size
+        self._running = False
+        self._thread = None
+
+    def start(self, engine: 'OutputEngine'):
+        self._running = True
+        self._thread = Thread(target=self._run, args=(engine,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def consume(self, block: ndarray):
+        pass
+
+    def _run(self, engine: 'OutputEngine'):
+        interval = self.block_size / settings.sample_rate
+        deadline = perf_counter()
+        while self._running:
+            if self.realtime:
+                deadline += interval
+                delay = deadline - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+            elif not engine.wait_readable(self.block_size, lambda: self._running):
+                break
+            self.consume(engine.pull(self.block_size))
+        if not self.realtime:
+            # Flush what is left so that a file sink does not lose the tail
+            remaining = engine.ring.readable // engine.channels
+            if remaining:
+                self.consume(engine.pull(remaining))
+
+
+class WaveFileBackend(NullBackend):
+    def __init__(self, path: Path, realtime: bool = False, block_size: int = None):
+        super().__init__(realtime, block_size)
+        self.path = Path(path)
+        self._file = None
+
+    def start(self, engine: 'OutputEngine'):
+        self._file = wave.open(str(self.path), 'wb')
+        self._file.setnchannels(engine.channels)
+        self._file.setsampwidth(2)
+        self._file.setframerate(settings.sample_rate)
+        super().start(engine)
+
+    def stop(self):
+        super().stop()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def consume(self, block: ndarray):
+        self._file.writeframes(block.tobytes())
+
+
+def open_backend(sink: str) -> Backend:
+    # "device" for the sound card through PyAudio, "null" to discard the samples, or the path of a
+    # WAV file; the last two are paced like a sound card, so they stand in for it on headless hosts
+    if sink == 'device':
+        return PyAudioBackend()
+    if sink == 'null':
+        return NullBackend()
+    return WaveFileBackend(Path(sink), realtime=True)
+
+
+class OutputEngine:
+    def __init__(self, backend: Backend = None, ticks_ahead: int = 4):
+        assert ticks_ahead > 0
+        self.backend = backend if backend is not None else PyAudioBackend()
+        self.ticks_ahead = ticks_ahead
+        # The ring holds interleaved samples; pulls and waits count frames of one sample per channel
+        self.channels = settings.channels
+        self.ring = RingBuffer(settings.block_size * self.channels * ticks_ahead)
+        # Preallocated so that the consumer never allocates in the audio callback
+        self._pull_buffer = np.zeros(settings.block_size * self.channels * ticks_ahead, int16)
+        self._poll_interval = settings.block_duration / 4
+        self.underruns = 0
+        self.overruns = 0
+        self._started = False
+        metrics.gauge('underruns', lambda: self.underruns)
+        metrics.gauge('overruns', lambda: self.overruns)
+        metrics.gauge('buffered_samples', lambda: self.ring.readable)
+
+    def start(self):
+        if not self._started:
+            self._started = True
+            self.backend.start(self)
+
+    def close(self):
+        if self._started:
+            self._started = False
+            self.backend.stop()
+
+    def write(self, data: ndarray, block: bool = True):
+        # Called by the generator thread.
+        # Blocking writes wait for room, so synthesis runs at most ticks_ahead ticks ahead of the device.
+        self.start()
+        written = self.ring.write(data)
+        while block and written < data.size:
+            sleep(self._poll_interval)
+            written += self.ring.write(data[written:])
+        if written < data.size:
+            self.overruns += 1
+
+    def pull(self, frame_count: int) -> ndarray:
+        # Called by the backend; never blocks, pads with silence on underrun
+        sample_count = frame_count * self.channels
+        if sample_count > self._pull_buffer.size:
+            self._pull_buffer = np.zeros(sample_count, int16)
+        out = self._pull_buffer[:sample_count]
+        count = self.ring.read_into(out)
+        if count < sample_count:
+            out[count:] = 0
+            if self._started:
+                self.underruns += 1
+        return out
+
+    def wait_readable(self, frame_count: int, running) -> bool:
+        while self.ring.readable < frame_count * self.channels:
+            if not running():
+                return False
+            sleep(self._poll_interval)
+        return True
+
+
+class WaveWriter:
+    # Writes blocks straight to a WAV file without a ring buffer or a consumer thread,
+    # for offline rendering. Blocks are gathered into large chunks before hitting the disk.
+    def __init__(self, path: Path, chunk_size: int = 1 << 18):
+        self.path = Path(path)
+        self._chunk = np.zeros(chunk_size, int16)
+        self._filled = 0
+        self.samples_written = 0
+        self._file = wave.open(str(self.path), 'wb')
+        self._file.setnchannels(settings.channels)
+        self._file.setsampwidth(2)
+        self._file.setframerate(settings.sample_rate)
+
+    def write(self, data: ndarray, block: bool = True):
+        while data.size:
+            count = min(data.size, self._chunk.size - self._filled)
+            self._chunk[self._filled:self._filled + count] = data[:count]
+            self._filled += count
+            data = data[count:]
+            if self._filled == self._chunk.size:
+                self._flush()
+
+    def _flush(self):
+        self._consume(self._chunk[:self._filled])
+        self.samples_written += self._filled
+        self._filled = 0
+
+    def _consume(self, chunk: ndarray):
+        self._file.writeframes(chunk.tobytes())
+
+    def close(self):
+        if self._file is not None:
+            self._flush()
+            self._file.close()
+            self._file = None
+
+
+class NpyWriter(WaveWriter):
+    # Same as WaveWriter, but into a memory-mapped .npy file of a known length in frames,
+    # shaped (length,) for mono and (length, channels) otherwise
+    def __init__(self, path: Path, length: int, chunk_size: int = 1 << 18):
+        self.path = Path(path)
+        self._chunk = np.zeros(chunk_size, int16)
+        self._filled = 0
+        self.samples_written = 0
+        shape = (length,) if settings.channels == 1 else (length, settings.channels)
+        self._array = np.lib.format.open_memmap(self.path, 'w+', int16, shape)
+        self._file = self._array.reshape(-1)
+
+    def _consume(self, chunk: ndarray):
+        count = min(chunk.size, self._file.size - self.samples_written)
+        self._file[self.samples_written:self.samples_written + count] = chunk[:count]
+
+    def close(self):
+        if self._file is not None:
+            self._flush()
+            self._array.flush()
+            self._file = None
+            self._array = None
+
+
+class NullWriter:
+    # Discards every block; for benchmarks and dry runs
+    def __init__(self):
+        self.samples_written = 0
+
+    def write(self, data: ndarray, block: bool = True):
+        self.samples_written += data.size
+
+    def close(self):
+        pass
@@ -0,0 +1,228 @@
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+from time import perf_counter
+
+import numpy as np
+from numpy import float32, ndarray
+
+from .config import main_config, settings
+from .metrics import metrics
+from .mixer import Strips
+from .voice import VoiceBank
+from .wavetable import WavetableBank
+
+
+# State that workers read (tables, parameters) or advance for their own voices (phase, envelope time)
+VOICE_ARRAYS = (
+    'active', 'table_id', 'freq', 'volume', 'strip', 'pan', 'play_once', 'finished', 'period', 'position', 'phase',
+    'increment'
+)
+ENVELOPE_ARRAYS = (
+    'on_times', 'on_levels', 'on_curves', 'release_times', 'release_levels', 'release_curves',
+    'time', 'released_at', 'release_level', 'finished', 'level'
+)
+MODULATION_ARRAYS = (
+    'routes', 'lfo', 'shapes', 'rates', 'phases', 'delays', 'fades', 'steps', 'step_counts', 'weights', 'time'
+)
+WAVETABLE_ARRAYS = ('arena', 'offsets', 'lengths')
+STRIP_ARRAYS = ('gain', 'pan', 'sends')
+
+parallel_config = main_config.get('parallel', {})
+
+class SharedArrays:
+    # NumPy arrays laid out in one shared memory block, which other processes attach to by name
+    def __init__(self, shm: SharedMemory, layout: dict[str, tuple[int, tuple, str]], owner: bool):
+        self.shm = shm
+        self.layout = layout
+        self._owner = owner
+        self.arrays = {
+            name: np.ndarray(shape, dtype, shm.buf, offset) for name, (offset, shape, dtype) in layout.items()
+        }
+
+    @classmethod
+    def create(cls, arrays: dict[str, ndarray]) -> 'SharedArrays':
+        layout = {}
+        size = 0
+        for name, array in arrays.items():
+            size = -(-size // 64) * 64
+            layout[name] = (size, array.shape, array.dtype.str)
+            size += array.nbytes
+        shared = cls(SharedMemory(create=True, size=max(size, 1)), layout, True)
+        for name, array in arrays.items():
+            shared.arrays[name][...] = array
+        return shared
+
+    @classmethod
+    def attach(cls, name: str, layout: dict[str, tuple[int, tuple, str]]) -> 'SharedArrays':
+        return cls(SharedMemory(name), layout, False)
+
+    def close(self):
+        self.arrays.clear()
+        self.shm.close()
+        if self._owner:
+            self.shm.unlink()
+
+
+def _bank_arrays(voices: VoiceBank) -> dict[str, ndarray]:
+    return {
+        **{f'voice.{name}': getattr(voices, name) for name in VOICE_ARRAYS},
+        **{f'envelope.{name}': getattr(voices.envelopes, name) for name in ENVELOPE_ARRAYS},
+        **{f'modulators.{name}': getattr(voices.modulators, name) for name in MODULATION_ARRAYS},
+        **{f'modulator_envelope.{name}': getattr(voices.modulators.envelopes, name) for name in ENVELOPE_ARRAYS},
+        **{f'wavetable.{name}': getattr(voices.wavetables, name) for name in WAVETABLE_ARRAYS},
+        **{f'strips.{name}': getattr(voices.strips, name) for name in STRIP_ARRAYS},
+    }
+
+def _bind(voices: VoiceBank, arrays: dict[str, ndarray]):
+    # Points the bank at the shared arrays; everything writes them in place, so no other reference goes stale
+    targets = {
+        'voice': voices,
+        'envelope': voices.envelopes,
+        'modulators': voices.modulators,
+        'modulator_envelope': voices.modulators.envelopes,
+        'wavetable': voices.wavetables,
+        'strips': voices.strips,
+    }
+    for name, array in arrays.items():
+        owner, attribute = name.split('.')
+        if owner in targets:
+            setattr(targets[owner], attribute, array)
+
+def _worker(connection, name: str, layout: dict, spec: dict, index: int, count: int):
+    shared = SharedArrays.attach(name, layout)
+    settings.update(**spec['settings'])
+    voices = VoiceBank(
+        WavetableBank(2, 1),
+        spec['capacity'],
+        spec['oscillator'],
+        spec['interpolation'],
+        spec['block_size'],
+        Strips(spec['strips'], settings.channels, spec['pan_law'], spec['sends'])
+    )
+    _bind(voices, shared.arrays)
+    partial = shared.arrays[f'partial.{index}']
+    sounding = shared.arrays['tick.sounding']
+    try:
+        while (size := connection.recv()) is not None:
+            partial[:] = 0
+            voices.render(partial, sounding[index:size:count])
+            connection.send(True)
+    finally:
+        del voices, partial
+        shared.close()
+
+
+class ParallelRenderer:
+    # Renders a VoiceBank with a pool of worker processes. The bank's arrays move into shared memory,
+    # and every tick the active voices are dealt out across the workers and this process. Each
+    # process adds its voices into its own partial buffer and this process sums them.
+    # A tick that misses its deadline is still waited for, since the workers own their voices'
+    # state until they answer; after maxMisses late ticks the renderer falls back to rendering
+    # in this process alone for retryTicks ticks.
+    def __init__(self, voices: VoiceBank, workers: int):
+        self.voices = voices
+        self.workers = workers
+        self.min_voices = parallel_config.get('minVoices', 16)
+        self.deadline = parallel_config.get('deadline', 0.75) * settings.block_duration
+        self.max_misses = parallel_config.get('maxMisses', 3)
+        self.retry_ticks = parallel_config.get('retryTicks', 600)
+        self.parallel_ticks = metrics.counter('parallel_ticks')
+        self.deadline_misses = metrics.counter('parallel_deadline_misses')
+        metrics.gauge('parallel_fallback', lambda: self._fallback)
+        self._misses = 0
+        self._fallback = 0
+        self._broken = False
+        block_size = voices._ramp.size
+        rows = voices.strips.rows
+        arrays = _bank_arrays(voices)
+        # The voices of this tick, picked once here: the processes update finished flags as they go,
+        # so they could not agree on the list themselves
+        arrays['tick.sounding'] = np.zeros(voices.capacity, np.int64)
+        for index in range(1, workers + 1):
+            arrays[f'partial.{index}'] = np.zeros((rows, block_size), float32)
+        self._shared = SharedArrays.create(arrays)
+        _bind(voices, self._shared.arrays)
+        self._sounding = self._shared.arrays['tick.sounding']
+        self._partials = [self._shared.arrays[f'partial.{index}'] for index in range(1, workers + 1)]
+        spec = {
+            'capacity': voices.capacity,
+            'oscillator': voices.oscillator,
+            'interpolation': voices.interpolation,
+            'block_size': block_size,
+            'strips': voices.strips.gain.size,
+            'sends': voices.strips.sends.shape[0],
+            'pan_law': voices.strips.pan_law,
+            'settings': {
+                'sample_rate': settings.sample_rate,
+                'block_size': settings.block_size,
+                'control_rate': settings.control_rate,
+                'channels': voices.strips.channels,
+            },
+        }
+        context = multiprocessing.get_context(parallel_config.get('startMethod'))
+        self._connections = []
+        self._processes = []
+        for index in range(1, workers + 1):
+            connection, child = context.Pipe()
+            process = context.Process(
+                target=_worker,
+                args=(child, self._shared.shm.name, self._shared.layout, spec, index, workers + 1),
+                daemon=True
+            )
+            process.start()
+            self._connections.append(connection)
+            self._processes.append(process)
+
+    def render(self, out: ndarray):
+        if self._broken or self._fallback:
+            self._fallback = max(self._fallback - 1, 0)
+            self.voices.render(out)
+            return
+        voices = self.voices.sounding()
+        if voices.size < self.min_voices:
+            # Not worth a round trip to the workers
+            self.voices.render(out, voices)
+            return
+        deadline = perf_counter() + self.deadline
+        self._sounding[:voices.size] = voices
+        try:
+            for connection in self._connections:
+                connection.send(voices.size)
+            self.voices.render(out, voices[::self.workers + 1])
+            late = False
+            for connection in self._connections:
+                if not connection.poll(max(deadline - perf_counter(), 0)):
+                    late = True
+                    connection.poll(None)
+                connection.recv()
+        except (BrokenPipeError, EOFError, ConnectionResetError):
+            # A worker died; its voices may be half rendered for this tick, but later ticks are complete
+            self._broken = True
+            return
+        for partial in self._partials:
+            out += partial
+        self.parallel_ticks.inc()
+        if late:
+            self.deadline_misses.inc()
+            self._misses += 1
+            if self._misses >= self.max_misses:
+                self._misses = 0
+                self._fallback = self.retry_ticks
+        else:
+            self._misses = 0
+
+    def close(self):
+        for connection in self._connections:
+            try:
+                connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for process in self._processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()
+        # Keep the bank usable in this process after the shared block is gone
+        _bind(self.voices, {name: array.copy() for name, array in _bank_arrays(self.voices).items()})
+        self._partials.clear()
+        del self._sounding
+        self._shared.close()
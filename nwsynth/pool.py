@@ -0,0 +1,118 @@
+import numpy as np
+from numpy import float64, int64, ndarray
+
+from .config import main_config
+from .metrics import metrics
+from .mixer import STRIP_NAMES
+
+
+STEALING_POLICIES = ('none', 'oldest', 'quietest', 'same-note')
+pool_config = main_config.get('voicePool', {})
+
+class VoicePool:
+    # The voices of every bank (wavetable, fm, streamed) as one fixed set of slots, slot = the bank's
+    # offset + its voice. Free voices come off a preallocated stack per bank, and everything about the
+    # slots in use is kept in arrays, so a press costs the same however dense the input is.
+    # A press that finds its bank full, max_voices sounding or its strip at its limit steals a voice
+    # that frees all of them at once:
+    #   oldest: the voice pressed first
+    #   quietest: the voice with the lowest envelope level times volume
+    #   same-note: a voice playing the same note on the same strip, otherwise the oldest
+    #   none: nothing is stolen and the press is dropped
+    # Released voices are stolen before held ones.
+    def __init__(self, banks: list, policy: str = 'oldest', max_voices: int = None, strip_limits: dict = None):
+        assert policy in STEALING_POLICIES
+        self.banks = banks
+        self.policy = policy
+        capacities = [bank.capacity for bank in banks]
+        self.capacity = sum(capacities)
+        self.max_voices = max_voices or self.capacity
+        self.limits = np.full(len(STRIP_NAMES), self.capacity, int64)
+        for name, limit in (strip_limits or {}).items():
+            self.limits[STRIP_NAMES.index(name)] = limit
+        self.offsets = np.cumsum([0, *capacities[:-1]])
+        self.bank = np.repeat(np.arange(len(banks)), capacities)
+        self.voice = np.concatenate([np.arange(capacity) for capacity in capacities])
+        self._free = [list(range(capacity - 1, -1, -1)) for capacity in capacities]
+        self.used = np.zeros(self.capacity, bool)
+        self.released = np.zeros(self.capacity, bool)
+        self.strip = np.zeros(self.capacity, int64)
+        self.note = np.zeros(self.capacity, float64)
+        # Press number of the voice's latest (re)start, and the key it plays
+        self.order = np.zeros(self.capacity, int64)
+        self.owner = np.zeros(self.capacity, int64)
+        self.strip_voices = np.zeros(len(STRIP_NAMES), int64)
+        self.count = 0
+        self.steals = metrics.counter('voice_steals')
+        self.dropped = metrics.counter('dropped_notes')
+        self._presses = 0
+
+    @classmethod
+    def from_config(cls, banks: list, polyphony: int) -> 'VoicePool':
+        # maxVoices defaults to the polyphony, which each bank also has as its own capacity
+        return cls(
+            banks,
+            pool_config.get('policy', 'oldest'),
+            pool_config.get('maxVoices') or polyphony,
+            pool_config.get('stripLimits', {})
+        )
+
+    def full(self, bank: int, strip: int) -> bool:
+        return not self._free[bank] or self.count >= self.max_voices or self.strip_voices[strip] >= self.limits[strip]
+
+    def victim(self, bank: int, strip: int, note: float) -> int:
+        # The slot to steal to make room for a press, or -1 if there is none
+        if self.policy == 'none':
+            self.dropped.inc()
+            return -1
+        candidates = self.used.copy()
+        if not self._free[bank]:
+            candidates &= self.bank == bank
+        if self.strip_voices[strip] >= self.limits[strip]:
+            candidates &= self.strip == strip
+        if self.policy == 'same-note':
+            same = candidates & (self.note == note) & (self.strip == strip)
+            if same.any():
+                candidates = same
+        released = candidates & self.released
+        if released.any():
+            candidates = released
+        if not candidates.any():
+            self.dropped.inc()
+            return -1
+        self.steals.inc()
+        if self.policy == 'quietest':
+            levels = np.concatenate([bank.levels() for bank in self.banks])
+            return int(np.flatnonzero(candidates)[levels[candidates].argmin()])
+        return int(np.flatnonzero(candidates)[self.order[candidates].argmin()])
+
+    def acquire(self, bank: int, owner: int, strip: int, note: float) -> int:
+        # A free slot of bank for the key owner; call only when full() is False
+        slot = self.offsets[bank] + self._free[bank].pop()
+        self.used[slot] = True
+        self.owner[slot] = owner
+        self.strip[slot] = strip
+        self.strip_voices[strip] += 1
+        self.count += 1
+        self.restart(slot, note)
+        return slot
+
+    def restart(self, slot: int, note: float):
+        self._presses += 1
+        self.order[slot] = self._presses
+        self.note[slot] = note
+        self.released[slot] = False
+
+    def release(self, slot: int):
+        self.released[slot] = True
+
+    def free(self, slot: int):
+        self.used[slot] = False
+        self.strip_voices[self.strip[slot]] -= 1
+        self.count -= 1
+        self._free[self.bank[slot]].append(int(self.voice[slot]))
+
+    def finished(self) -> ndarray:
+        # Slots in use whose voice has finished sounding
+        finished = np.concatenate([bank.finished for bank in self.banks])
+        return np.flatnonzero(self.used & finished)
@@ -0,0 +1,108 @@
+import json
+from argparse import ArgumentParser
+from pathlib import Path
+from time import perf_counter
+
+from .config import Settings, settings
+from .constants import *
+from . import midi, tracker
+from .apu import ENGINES
+from .keyboard_listener import KEY_EVENT_TYPES, key_to_vk, parse_recording, recording_events
+from .mixer import Mixer
+from .output import NpyWriter, WaveWriter
+from .sound_generator import SoundGenerator
+
+
+EVENT_TYPES = {
+    'press': EventType.PRESS,
+    'release': EventType.RELEASE,
+    'octave': EventType.OCTAVE,
+    'instrument': EventType.INSTRUMENT,
+}
+
+def load_events(path: Path) -> list[tuple[float, int, int, int]]:
+    # A JSON list of {"time": seconds, "type": "press" | "release" | "octave" | "instrument", "key": "F"},
+    # a recording of key downs and ups (see keyboard_listener.Recorder), a tracker module (a JSON
+    # object, see tracker.parse_song), or a standard MIDI file (.mid)
+    path = Path(path)
+    if path.suffix.lower() in ('.mid', '.midi'):
+        return midi.load_events(path)
+    with path.open() as f:
+        events = json.load(f)
+    if isinstance(events, dict):
+        return tracker.Sequencer(tracker.parse_song(events)).schedule()
+    if events and events[0].get('type') in KEY_EVENT_TYPES:
+        # Through the keyboard listener, as if the keys were played
+        return recording_events(parse_recording(events))
+    result = []
+    for event in events:
+        if event['type'] not in EVENT_TYPES:
+            raise ValueError(f'Unknown event type {event["type"]!r}')
+        result.append((float(event['time']), EVENT_TYPES[event['type']], key_to_vk(event['key']), 0))
+    result.sort(key=lambda event: event[0])
+    return result
+
+def render(
+    events: list[tuple[float, int, int, int]], output, duration: float = None, tail: float = 1.0, engine: str = None
+) -> dict:
+    # Runs the SoundGenerator and Mixer pipeline without a device, as fast as the CPU allows.
+    # output is anything with write(block) and close(), such as WaveWriter or NpyWriter.
+    if duration is None:
+        duration = (events[-1][0] if events else 0) + tail
+    ticks = int(duration / settings.block_duration)
+    mixer = Mixer(output)
+    sg = SoundGenerator(mixer, engine=engine)
+    next_event = 0
+    start = perf_counter()
+    try:
+        for tick in range(ticks):
+            # Events are timestamped on the score's timeline, and the generator places them inside the block
+            until = (tick + 1) * settings.block_duration
+            while next_event < len(events) and events[next_event][0] < until:
+                time, type_, vk, value = events[next_event]
+                if not sg.events.put(type_, vk, time, value):
+                    break
+                next_event += 1
+            sg.tick(until)
+    finally:
+        # Render processes, their shared memory and the stream reader go with it, and a file gets its
+        # header even when the render fails
+        sg.close()
+        output.close()
+    elapsed = perf_counter() - start
+    seconds = ticks * settings.block_duration
+    return {
+        'ticks': ticks,
+        'seconds': seconds,
+        'elapsed': elapsed,
+        'realtime_factor': seconds / elapsed if elapsed else float('inf'),
+    }
+
+def open_writer(path: Path, duration: float):
+    path = Path(path)
+    if path.suffix == '.npy':
+        return NpyWriter(path, int(duration / settings.block_duration) * settings.block_size)
+    return WaveWriter(path)
+
+def main(argv: list[str] = None):
+    parser = ArgumentParser(description='Render a scripted event list, tracker module or MIDI file to a WAV or .npy file')
+    parser.add_argument('events', type=Path, help='JSON event list, key recording or tracker module, or MIDI file')
+    parser.add_argument('output', type=Path, help='output file, .wav or .npy')
+    parser.add_argument('--duration', type=float, help='length in seconds (default: last event plus --tail)')
+    parser.add_argument('--tail', type=float, default=1.0, help='seconds rendered after the last event')
+    parser.add_argument('--engine', choices=ENGINES, help='sound engine (default: main.engine in config.json)')
+    Settings.add_arguments(parser)
+    args = parser.parse_args(argv)
+    settings.apply_arguments(args)
+    events = load_events(args.events)
+    duration = args.duration
+    if duration is None:
+        duration = (events[-1][0] if events else 0) + args.tail
+    stats = render(events, open_writer(args.output, duration), duration, engine=args.engine)
+    print(
+        f'Rendered {stats["seconds"]:.2f} s in {stats["elapsed"]:.2f} s '
+        f'({stats["realtime_factor"]:.1f}x real time) to {args.output}'
+    )
+
+if __name__ == '__main__':
+    main()
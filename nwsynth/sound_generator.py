@@ -1,185 +1,380 @@
-from queue import SimpleQueue
-from types import FunctionType
-
-import numpy as np
-from numpy import ndarray
+from operator import itemgetter
+from threading import Lock
+from time import perf_counter
 
+from .apu import ENGINES, ApuBank, ApuEngine, ApuVoice
 from .config import *
 from .constants import *
-from .mixer import Mixer
+from .envelope import Envelope
+from .events import EventRing
+from .fm import FmBank, FmPatch
+from .instruments import InstrumentIndex, VoiceTemplate
+from .metrics import metrics
+from .modulation import Modulation
+from .mixer import STRIP_KEYBOARD, STRIP_MIDI, Mixer
+from .parallel import ParallelRenderer
+from .pool import VoicePool
+from .stream import StreamBank
+from .voice import VoiceBank
 from .waveform import *
+from .wavetable import WavetableBank
 
 
 
 class Key:
-    def __init__(self, instrument: list, freq: float, play_once: bool, volume_adsr: FunctionType):
+    def __init__(self, table_id: int, freq: float, play_once: bool, envelope: Envelope):
         self.status = KeyStatus.PRESSED
-        self.ticks = 0
-        self.ticks_since_released = 0
-        self.instrument = np.array(instrument, np.int16)
+        self.table_id = table_id
+        # Voice in the key's bank, and its slot in the voice pool
+        self.voice = -1
+        self.slot = -1
         self.freq = freq
         self.play_once = play_once
-        self.volume = 0
-        self.volume_adsr = volume_adsr
-        self.playback_place = 0.0
+        self.envelope = envelope
+        # Mixer channel strip and pan of the voice
+        self.strip = STRIP_KEYBOARD
+        self.pan = 0.0
+        # MIDI notes only
+        self.channel = -1
+        self.volume = 1.0
+        # fm instruments only; their voices are in the fm bank, and table_id is unused
+        self.patch: FmPatch | None = None
+        # Streamed samples only; their voices are in the stream bank, and table_id is unused
+        self.source = -1
+        # APU engine only: the channel the voice plays on; its voices are in the APU's banks
+        self.apu: ApuVoice | None = None
+        self.modulation: Modulation | None = None
 
 class SoundGenerator:
-    @classmethod
-    def _get_freq_table(cls, middle_a_freq: float):
-        # When middle_a_freq is 440,
-        # freq_table is {
-        #     # Low G to low B
-        #     'a': 196.00, 'w': 207.65, 's': 220.00, 'e': 233.08, 'd': 246.94,
-        #     # C to E
-        #     'f': 261.63, 't': 277.18, 'g': 293.66, 'y': 311.13, 'h': 329.63,
-        #     # F to A
-        #     'j': 349.23, 'i': 369.99, 'k': 392.00, 'o': 415.30, 'l': 440.00,
-        #     # B flat to high C
-        #     'p': 466.16, ';': 493.88, '\'': 523.25
-        # }
-        # with keys as the corresponding virtual key code
-
-        # [start] --- [-9 as Middle C] --- [0 as Middle A] --- [stop]
-        # and stop - start == len(TONE_KEYS) - 1
-        rel_freq_list = np.logspace(
-            -9 - MIDDLE_C_INDEX + main_config['middleCOffset'],
-            len(TONE_KEYS) - MIDDLE_C_INDEX - 10 + main_config['middleCOffset'],
-            num=len(TONE_KEYS),
-            base=pow(2, 1 / 12)
-        )
-        freq_table = {}
-        for index, vk in enumerate(TONE_KEYS):
-            freq_table[vk] = rel_freq_list[index] * middle_a_freq
-        return freq_table
-
-    def __init__(self, mixer: Mixer, middle_a_freq: float = 440):
+    def __init__(
+        self, mixer: Mixer, middle_a_freq: float = 440, polyphony: int = None, workers: int = None, engine: str = None
+    ):
         self._mixer = mixer
-        self._freq_table = self._get_freq_table(middle_a_freq)
-        self.key_events: SimpleQueue[int, int] = SimpleQueue()
+        self._middle_a_freq = middle_a_freq
+        # Compiled instruments; a reloaded config waits in _next_index for the next block, handed
+        # over under _index_lock
+        self.index = InstrumentIndex(config, middle_a_freq, custom)
+        self._next_index: InstrumentIndex | None = None
+        self._index_lock = Lock()
+        # One ring per producer thread; self.events is the keyboard's
+        self.events = EventRing(main_config.get('eventQueueSize', 256))
+        self._event_rings = [self.events]
+        metrics.gauge('dropped_events', lambda: sum(ring.dropped for ring in self._event_rings))
+        # Per MIDI channel: instrument number (None follows the keyboard's), pitch bend ratio and detune
+        # ratio (the tracker's arpeggio and vibrato); volume and pan belong to the channel's mixer strip
+        self._programs: list[int | None] = [None] * 16
+        self._bends = [1.0] * 16
+        self._detunes = [1.0] * 16
+        self._bend_range = main_config.get('midi', {}).get('pitchBendRange', 2)
+        # End of the last rendered block, on the clock of the event timestamps
+        self._block_end = None
         self._activated_keys: dict[int, Key] = {}
+        self._wavetables = WavetableBank(main_config.get('wavetableCacheSize', 16 << 20))
+        oscillator = main_config.get('oscillator', {})
+        polyphony = polyphony or main_config.get('polyphony', 32)
+        self._voices = VoiceBank(
+            self._wavetables,
+            polyphony,
+            oscillator.get('mode', 'accumulator'),
+            oscillator.get('interpolation', 'linear'),
+            mixer.block_size,
+            mixer.strips
+        )
+        self._fm = FmBank(polyphony, mixer.block_size, mixer.strips)
+        self._streams = StreamBank(polyphony, mixer.block_size, mixer.strips)
+        self._generating = True
+        # The APU engine plays what it has channels for, and leaves the rest to the banks above
+        engine = engine or main_config.get('engine', 'wavetable')
+        if engine not in ENGINES:
+            raise ValueError(f'main.engine: unknown engine {engine!r}')
+        self._apu = ApuEngine(mixer.block_size, mixer.strips) if engine == 'apu' else None
+        banks = [self._voices, self._fm, self._streams, *(self._apu.banks if self._apu is not None else [])]
+        self._pool = VoicePool.from_config(banks, polyphony)
+        # Worker processes sharing the voices, 0 to render in this thread only
+        if workers is None:
+            workers = main_config.get('parallel', {}).get('workers', 0)
+        self._renderer = ParallelRenderer(self._voices, workers) if workers > 0 else self._voices
         self.octave = 4
-        self.instrument = instrument_lists[default_instrument]
-
-    def _get_all_items(self, queue: SimpleQueue) -> set[int]:
-        set_ = set()
-        for _ in range(queue.qsize()):
-            set_.add(queue.get())
-        return set_
-    
-    def _get_key(self, vk: int) -> Key:
-        if self.instrument['type'] == 'builtin':
-            waveform = builtin[self.instrument['name']](*self.instrument['args'])
-            freq = self._freq_table[vk] * 2 ** (self.octave - 4)
-            play_once = False
-        elif self.instrument['type'] == 'custom':
-            try:
-                key_info = custom_instruments[self.instrument['name']][str(TONE_KEYS.index(vk) - MIDDLE_C_INDEX)]
-            except KeyError:
-                return
-            waveform = custom[key_info['waveform']]
-            freq = key_info['freq']
-            play_once = key_info['play_once']
-        adsr = self.instrument['adsr']
-        if adsr['type'] == 'linear':
-            volume_function = linear_adsr(adsr['args'])
+        self._instrument_number = self.index.default
+        self.instrument = self.index.instruments[self.index.default]
+        if main_config.get('prebuildWavetables', False):
+            self.prebuild_wavetables()
+
+    def _table(self, key: tuple, build, freq: float, play_once: bool) -> int:
+        if self._voices.oscillator == 'legacy':
+            return self._wavetables.resampled(key, build, max(int(settings.sample_rate / freq), 1))
+        if self._voices.interpolation == 'bandlimited' and not play_once:
+            # Keep only the harmonics below the Nyquist frequency of this note
+            return self._wavetables.bandlimited(key, build, int(settings.sample_rate / 2 / freq))
+        return self._wavetables.original(key, build)
+
+    def prebuild_wavetables(self):
+        # Build the table of every key, octave and MIDI note up front,
+        # so that key presses never have to build one
+        for template in self.index.templates():
+            if template.patch is None and not self.index.streams(template):
+                self._table(template.table_key, template.build, template.freq, template.play_once)
+
+    def reload(self, config: dict):
+        # Compiles the instrument sections of config here, in the caller's thread, and switches to them
+        # at the start of the next block. Raises ValueError if the config is invalid
+        index = InstrumentIndex(config, self._middle_a_freq)
+        with self._index_lock:
+            self._next_index = index
+
+    def _switch_index(self):
+        with self._index_lock:
+            index, self._next_index = self._next_index, None
+        if index is None:
+            return
+        self.index = index
+        instruments = self.index.instruments
+        self._instrument_number = min(self._instrument_number, len(instruments) - 1)
+        self.instrument = instruments[self._instrument_number]
+
+    def _key(self, template: VoiceTemplate) -> Key:
+        key = Key(-1, template.freq, template.play_once, template.envelope)
+        key.strip = template.strip
+        key.pan = template.pan
+        key.modulation = template.modulation
+        if self._apu is not None:
+            key.apu = self._apu.voice(template.table_key, template.play_once)
+            if key.apu is not None:
+                # Played from the APU's registers, with no table
+                return key
+        if template.patch is not None:
+            key.patch = template.patch
+        elif self.index.streams(template):
+            key.source = self._streams.open(template.table_key, self.index.waveforms[template.waveform])
         else:
-            volume_function = lambda *_: 1
-        return Key(
-            waveform,
-            freq,
-            play_once,
-            volume_function
-        )
-    
+            key.table_id = self._table(template.table_key, template.build, template.freq, template.play_once)
+        return key
+
+    def _get_key(self, vk: int) -> Key:
+        template = self.instrument.keys.get((vk, self.octave))
+        return None if template is None else self._key(template)
+
     def _get_percussion_key(self, vk: int) -> Key:
-        try:
-            key_info = percussion_instrument[PERCUSSION_INSTRUMENT_KEYS.index(vk)]
-        except IndexError:
+        template = self.index.percussion_keys.get(vk)
+        return None if template is None else self._key(template)
+
+    def _get_midi_key(self, channel: int, note: int, velocity: int) -> Key:
+        if channel == MIDI_PERCUSSION_CHANNEL:
+            template = self.index.percussion_notes[note]
+        else:
+            program = self._programs[channel]
+            instruments = self.index.instruments
+            instrument = self.instrument if program is None else instruments[program % len(instruments)]
+            template = instrument.notes[note]
+        if template is None:
             return
-        waveform = custom[key_info['waveform']]
-        freq = key_info['freq']
-        play_once = key_info['play_once']
-        volume_function = lambda *_: 1
-        adsr = key_info.get('adsr')
-        if adsr:
-            if adsr['type'] == 'linear':
-                volume_function = linear_adsr(adsr['args'])
-        return Key(
-            waveform,
-            freq,
-            play_once,
-            volume_function
-        )
-    
-    def _get_wave(self, key: Key, volume: float, freq: float) -> ndarray:
-        # 调整音调：将采样（乐器）数组拉长/收缩，以符合目标频率
-        new_sample_length = int(SAMPLE_RATE / freq)
-        new_sample_indices = np.linspace(0, key.instrument.size, new_sample_length, endpoint=False).astype(int)
-        new_sample = key.instrument[new_sample_indices]
-        # 生成1帧（1/60秒）的音频流：将调整好的采样 以一个偏移量（上次的采样回放位置），进行如下操作
-        sample_offset = int(key.playback_place * new_sample_length)
-        tick_sample_indices = np.arange(sample_offset, SAMPLE_COUNT_IN_A_TICK + sample_offset) % new_sample_length
-        if key.play_once:
-            # 仅将第一次播放的数据放置在1帧音频数组里
-            playback_times = np.arange(sample_offset, SAMPLE_COUNT_IN_A_TICK + sample_offset) // new_sample_length
-            is_first_playback = np.logical_not(playback_times)
-            tick_sample = np.zeros(SAMPLE_COUNT_IN_A_TICK, np.int16)
-            tick_sample[is_first_playback] = new_sample[tick_sample_indices][is_first_playback]
-            if new_sample_length == SAMPLE_COUNT_IN_A_TICK or not np.all(is_first_playback):
-                # 第一次播放完毕，标记为结束
-                key.status = KeyStatus.FINISHED
+        key = self._key(template)
+        key.channel = channel
+        key.strip = STRIP_MIDI + channel
+        key.volume = velocity / 127
+        return key
+
+    def _bank(self, key: Key) -> VoiceBank | FmBank | StreamBank | ApuBank:
+        if key.apu is not None:
+            return self._apu.bank(key.apu)
+        if key.patch is not None:
+            return self._fm
+        if key.source >= 0:
+            return self._streams
+        return self._voices
+
+    def _press(self, vk: int, key: Key, offset: int = 0):
+        bank = self._bank(key)
+        previous = self._activated_keys.get(vk)
+        if previous is not None and self._bank(previous) is bank:
+            # Pressing a key that is still sounding restarts it on the same voice
+            key.voice = previous.voice
+            key.slot = previous.slot
+            self._pool.restart(key.slot, key.freq)
         else:
-            # 首尾相连铺满至1帧音频数组里
-            tick_sample = new_sample[tick_sample_indices]
-        # 保存本次的采样回放位置
-        key.playback_place = (tick_sample_indices[-1] + 1) / new_sample_length
-        # 应用音量
-        wave = np.multiply(tick_sample, volume, casting='unsafe').astype(np.int16)
-        return wave
-
-    def _process_key(self, vk: int):
-        key = self._activated_keys[vk]
-        channel = self._mixer.input_channels[vk]
-        status = key.status
-        if status != KeyStatus.FINISHED:
-            volume = key.volume_adsr(
-                key.status,
-                key.ticks,
-                key.ticks_since_released
+            if previous is not None:
+                self._stop_key(vk)
+            index = self._pool.banks.index(bank)
+            if self._pool.full(index, key.strip):
+                victim = self._pool.victim(index, key.strip, key.freq)
+                if victim < 0:
+                    return
+                self._stop_key(int(self._pool.owner[victim]))
+            key.slot = self._pool.acquire(index, vk, key.strip, key.freq)
+            key.voice = int(self._pool.voice[key.slot])
+        if key.apu is not None:
+            bank.start(
+                key.voice, key.apu, key.freq, key.envelope, key.volume, offset, key.strip, key.modulation
             )
-            if status == KeyStatus.RELEASED and volume == 0:
-                self._activated_keys[vk].status = KeyStatus.FINISHED
-            else:
-                wave = self._get_wave(key, volume, key.freq)
-                key.ticks += 1
-                if status == KeyStatus.RELEASED:
-                    key.ticks_since_released += 1
-                channel.put(wave)
-        
-    def generate(self):
-        while True:
-            for _ in range(self.key_events.qsize()):
-                vk, event = self.key_events.get()
-                if event == KeyStatus.PRESSED:
-                    if vk in TONE_KEYS:
-                        key = self._get_key(vk)
-                    elif vk in PERCUSSION_INSTRUMENT_KEYS:
-                        key = self._get_percussion_key(vk)
-                    if key is None:
+        elif key.patch is not None:
+            self._fm.start(key.voice, key.patch, key.freq, key.volume, offset, key.strip, key.pan, key.modulation)
+        elif key.source >= 0:
+            self._streams.start(
+                key.voice, key.source, key.freq, key.envelope, key.volume, offset, key.strip, key.pan, key.modulation
+            )
+        else:
+            self._voices.start(
+                key.voice,
+                key.table_id,
+                key.freq,
+                key.play_once,
+                key.envelope,
+                key.volume,
+                offset,
+                key.strip,
+                key.pan,
+                key.modulation
+            )
+        if key.channel >= 0 and self._pitch(key.channel) != 1.0:
+            bank.bend(key.voice, self._pitch(key.channel))
+        self._activated_keys[vk] = key
+
+    def _stop_key(self, vk: int):
+        key = self._activated_keys.pop(vk)
+        self._bank(key).stop(key.voice)
+        self._pool.free(key.slot)
+
+    def _release_key(self, key: Key, offset: int):
+        key.status = KeyStatus.RELEASED
+        self._bank(key).release(key.voice, offset)
+        self._pool.release(key.slot)
+
+    def _release_finished_keys(self):
+        for slot in self._pool.finished():
+            self._stop_key(int(self._pool.owner[slot]))
+
+    def _apply(self, type_: int, vk: int, value: int, offset: int):
+        if type_ == EventType.PRESS:
+            key = self._get_key(vk) or self._get_percussion_key(vk)
+            if key is not None:
+                self._press(vk, key, offset)
+        elif type_ == EventType.RELEASE:
+            if vk in self._activated_keys:
+                self._release_key(self._activated_keys[vk], offset)
+        elif type_ == EventType.OCTAVE:
+            self.set_octave(vk)
+        elif type_ == EventType.INSTRUMENT:
+            self.set_instrument(vk)
+        elif type_ == EventType.NOTE_ON:
+            key = self._get_midi_key(vk >> 7, vk & 0x7F, value)
+            if key is not None:
+                self._press(MIDI_KEY_BASE + vk, key, offset)
+        elif type_ == EventType.NOTE_OFF:
+            key = self._activated_keys.get(MIDI_KEY_BASE + vk)
+            if key is not None:
+                self._release_key(key, offset)
+        else:
+            self._apply_midi_channel(type_, vk >> 7, vk & 0x7F, value, offset)
+
+    def _pitch(self, channel: int) -> float:
+        return self._bends[channel] * self._detunes[channel]
+
+    def _channel_keys(self, channel: int) -> list[Key]:
+        return [key for key in self._activated_keys.values() if key.channel == channel]
+
+    def _apply_midi_channel(self, type_: int, channel: int, control: int, value: int, offset: int):
+        if type_ == EventType.PITCH_BEND:
+            semitones = (value - MIDI_PITCH_BEND_CENTER) / MIDI_PITCH_BEND_CENTER * self._bend_range
+            self._bends[channel] = 2 ** (semitones / 12)
+            for key in self._channel_keys(channel):
+                self._bank(key).bend(key.voice, self._pitch(channel))
+        elif type_ == EventType.DETUNE:
+            # value in cents, and signed
+            self._detunes[channel] = 2 ** (value / 1200)
+            for key in self._channel_keys(channel):
+                self._bank(key).bend(key.voice, self._pitch(channel))
+        elif type_ == EventType.PROGRAM_CHANGE:
+            self._programs[channel] = value
+        elif type_ == EventType.CONTROL_CHANGE:
+            if control == 7:
+                # Channel volume
+                self._mixer.strips.gain[STRIP_MIDI + channel] = value / 127
+            elif control == 10:
+                # Pan, 64 in the centre
+                self._mixer.strips.pan[STRIP_MIDI + channel] = max((value - 64) / 63, -1.0)
+            elif control == 121:
+                # Reset all controllers, which leaves volume and pan alone
+                self._bends[channel] = 1.0
+                for key in self._channel_keys(channel):
+                    self._bank(key).bend(key.voice, self._pitch(channel))
+            elif control in (120, 123):
+                # All sound off stops the voices at once, all notes off releases them
+                for vk, key in list(self._activated_keys.items()):
+                    if key.channel != channel:
                         continue
-                    self._activated_keys[vk] = key
-                elif event == KeyStatus.RELEASED:
-                    if vk in self._activated_keys:
-                        self._activated_keys[vk].status = KeyStatus.RELEASED
-            for vk in self._activated_keys:
-                self._process_key(vk)
-            self._mixer.mix()
+                    if control == 120:
+                        self._stop_key(vk)
+                    else:
+                        self._release_key(key, offset)
+
+    def tick(self, until: float = None):
+        # Renders the block that ends at until (perf_counter time by default, or the timeline of
+        # the event timestamps when rendering offline). Every event is placed at the sample of the
+        # block matching its timestamp, so the delay from input to sound stays constant instead of
+        # jumping with the tick boundaries.
+        now = perf_counter()
+        if self._next_index is not None:
+            self._switch_index()
+        if metrics.enabled:
+            metrics.key_events_depth.observe(sum(len(ring) for ring in self._event_rings))
+        realtime = until is None
+        if realtime:
+            until = now
+        block_start = until - settings.block_duration if self._block_end is None else self._block_end
+        self._block_end = until
+        span = until - block_start
+        size = self._mixer.block_size
+        events = self.events.pop_before(until)
+        if len(self._event_rings) > 1:
+            for ring in self._event_rings[1:]:
+                events += ring.pop_before(until)
+            # By time only: events of a ring at the same time keep their order, such as a program change
+            # before the note it is for
+            events.sort(key=itemgetter(0))
+        for time, type_, vk, value in events:
+            offset = min(max(int((time - block_start) / span * size), 0), size - 1) if span > 0 else 0
+            if realtime and metrics.enabled:
+                # From the input timestamp to the event's sample in this block, output buffering not included
+                metrics.event_latency_ms.observe((now - time) * 1000 + offset / settings.sample_rate * 1000)
+            self._apply(type_, vk, value, offset)
+        self._release_finished_keys()
+        # 所有发声的按键一次性渲染、混合至mixer的缓冲区
+        self._renderer.render(self._mixer.buffer)
+        # fm and streamed voices are rendered in this process only
+        self._fm.render(self._mixer.buffer)
+        self._streams.render(self._mixer.buffer)
+        if self._apu is not None:
+            self._apu.render(self._mixer.buffer)
+        if metrics.enabled:
+            metrics.active_voices.set(self._pool.count)
+            metrics.tick_render_ms.observe((perf_counter() - now) * 1000)
+        self._mixer.mix()
+
+    def open_events(self, capacity: int = None) -> EventRing:
+        # An event ring for another producer thread, such as a MIDI port; call before generate() starts
+        ring = EventRing(capacity or main_config.get('eventQueueSize', 256))
+        self._event_rings.append(ring)
+        return ring
+
+    def close(self):
+        self._streams.close()
+        if self._renderer is not self._voices:
+            self._renderer.close()
+            self._renderer = self._voices
+
+    def generate(self):
+        # Ticks until stop(), from a thread of its own
+        while self._generating:
+            self.tick()
+
+    def stop(self):
+        self._generating = False
 
     def set_octave(self, vk: int):
         self.octave = vk - OCTAVE_SELECTION_KEYS[0] + 1
 
     def set_instrument(self, vk: int):
-        try:
-            self.instrument = instrument_lists[INSTRUMEMT_SELECTION_KEYS.index(vk)]
-        except IndexError:
-            pass
+        number = self.index.selection.get(vk)
+        if number is not None:
+            self._instrument_number = number
+            self.instrument = self.index.instruments[number]
@@ -0,0 +1,198 @@
+from queue import SimpleQueue
+from threading import Thread
+
+import numpy as np
+from numpy import float32, float64, int16, int64, ndarray
+
+from .config import main_config, settings
+from .envelope import Envelope, EnvelopeBank
+from .metrics import metrics
+from .mixer import Strips
+from .modulation import Modulation, ModulationBank
+
+
+streaming_config = main_config.get('streaming', {})
+
+class StreamBank:
+    # One-shot samples played straight from their decoded PCM (usually a memory-mapped .npy file),
+    # instead of being copied whole into the wavetable arena.
+    # Each voice holds a window of two chunks of its sample. As soon as a window is loaded, a reader
+    # thread fetches the chunk after it into the voice's pending buffer; when playback runs past the
+    # window, it slides forward by a chunk and takes the pending one in. So the render thread never waits
+    # for the disk unless the reader falls behind, and each voice holds three chunks whatever the
+    # sample's length. The first window of every sample is kept in memory, so that a note starts, or
+    # restarts, without reading anything.
+    def __init__(self, capacity: int = 32, block_size: int = None, strips: Strips = None, chunk: int = None):
+        self.capacity = capacity
+        self.chunk = chunk or streaming_config.get('chunkSamples', 16384)
+        block_size = block_size or settings.block_size
+        self.active = np.zeros(capacity, bool)
+        self.finished = np.zeros(capacity, bool)
+        self.source = np.zeros(capacity, int64)
+        self.length = np.zeros(capacity, int64)
+        self.freq = np.zeros(capacity, float64)
+        self.volume = np.zeros(capacity, float64)
+        self.strip = np.zeros(capacity, int64)
+        self.pan = np.zeros(capacity, float64)
+        self.strips = strips if strips is not None else Strips(1, settings.channels)
+        # Playback position in samples of the source, and its increment per output sample
+        self.position = np.zeros(capacity, float64)
+        self.increment = np.zeros(capacity, float64)
+        # Source sample at the start of the window
+        self.base = np.zeros(capacity, int64)
+        self.windows = np.zeros((capacity, 2 * self.chunk), int16)
+        self.pending = np.zeros((capacity, self.chunk), int16)
+        # Read-ahead requests: the one the voice waits for, and the last one the reader finished
+        self._requested = np.zeros(capacity, int64)
+        self._done = np.zeros(capacity, int64)
+        self._request_count = 0
+        self.envelopes = EnvelopeBank(capacity, block_size)
+        # Duty does not apply to samples
+        self.modulators = ModulationBank(capacity, block_size)
+        self.sample_rate = settings.sample_rate
+        self._ramp = np.arange(block_size, dtype=float64)
+        self._sources: list[ndarray] = []
+        self._heads: list[ndarray] = []
+        self._source_ids: dict[tuple, int] = {}
+        self.underruns = metrics.counter('stream_underruns')
+        self._queue = SimpleQueue()
+        self._reader = Thread(target=self._read, daemon=True)
+        self._reader.start()
+
+    def open(self, key: tuple, data: ndarray) -> int:
+        # Registers a sample under key once, keeping only its first window in memory
+        source_id = self._source_ids.get(key)
+        if source_id is None:
+            assert data.ndim == 1 and data.size > 0
+            source_id = self._source_ids[key] = len(self._sources)
+            self._sources.append(data)
+            self._heads.append(np.array(data[:2 * self.chunk], int16))
+        return source_id
+
+    def levels(self) -> ndarray:
+        return self.envelopes.level * self.volume
+
+    def start(
+        self,
+        voice: int,
+        source: int,
+        freq: float,
+        envelope: Envelope,
+        volume: float = 1.0,
+        offset: int = 0,
+        strip: int = 0,
+        pan: float = 0.0,
+        modulation: Modulation = None
+    ):
+        # freq: how many times a second the whole sample would play, as for one-shot wavetables
+        length = self._sources[source].size
+        head = self._heads[source]
+        self.source[voice] = source
+        self.length[voice] = length
+        self.freq[voice] = freq
+        self.increment[voice] = freq * length / self.sample_rate
+        self.position[voice] = -offset * self.increment[voice]
+        self.base[voice] = 0
+        self.windows[voice, :head.size] = head
+        self.windows[voice, head.size:] = 0
+        self.volume[voice] = volume
+        self.strip[voice] = strip
+        self.pan[voice] = pan
+        self.finished[voice] = False
+        self.active[voice] = True
+        self.envelopes.start(voice, envelope, offset)
+        self.modulators.start(voice, modulation)
+        self._request(voice)
+
+    def bend(self, voice: int, ratio: float):
+        self.increment[voice] = self.freq[voice] * ratio * self.length[voice] / self.sample_rate
+
+    def release(self, voice: int, offset: int = 0):
+        self.envelopes.release(voice, offset)
+        self.modulators.release(voice, offset)
+
+    def stop(self, voice: int):
+        self.active[voice] = False
+        # Whatever the reader still has queued for this voice is stale now
+        self._request_count += 1
+        self._requested[voice] = self._request_count
+
+    def close(self):
+        self._queue.put(None)
+        self._reader.join()
+
+    def sounding(self) -> ndarray:
+        return np.flatnonzero(self.active & ~self.finished)
+
+    def _request(self, voice: int):
+        # Asks the reader for the chunk after the window
+        self._request_count += 1
+        self._requested[voice] = self._request_count
+        self._queue.put((voice, self._request_count, self.source[voice], self.base[voice] + 2 * self.chunk))
+
+    def _read(self):
+        while (request := self._queue.get()) is not None:
+            voice, request_id, source, start = request
+            if self._requested[voice] != request_id:
+                continue
+            self._fill(self.pending[voice], source, start)
+            self._done[voice] = request_id
+
+    def _fill(self, buffer: ndarray, source: int, start: int):
+        # Copies the sample from start into buffer, zero past its end; this is where the pages are read
+        data = self._sources[source][start:start + buffer.size]
+        buffer[:data.size] = data
+        buffer[data.size:] = 0
+
+    def _advance(self, voice: int, end: float):
+        # Slides the window until it holds the sample up to end
+        chunk = self.chunk
+        while end >= self.base[voice] + 2 * chunk:
+            self.windows[voice, :chunk] = self.windows[voice, chunk:]
+            if self._done[voice] != self._requested[voice]:
+                # The reader is late: read the chunk here, and drop its request
+                self.underruns.inc()
+                self._request_count += 1
+                self._requested[voice] = self._request_count
+                self._fill(self.pending[voice], self.source[voice], self.base[voice] + 2 * chunk)
+            self.windows[voice, chunk:] = self.pending[voice]
+            self.base[voice] += chunk
+            self._request(voice)
+
+    def render(self, out: ndarray, voices: ndarray = None):
+        if voices is None:
+            voices = self.sounding()
+        if voices.size == 0:
+            return
+        modulation = self.modulators.render(voices)
+        increment = self.increment[voices, None]
+        if modulation is not None:
+            increment = increment.copy()
+            increment[modulation.rows, 0] *= modulation.ratio
+        position = self.position[voices, None] + increment * self._ramp
+        # The last sample needed, and the one after it for interpolation
+        end = position[:, -1] + 1
+        for index in np.flatnonzero(end >= self.base[voices] + 2 * self.chunk):
+            self._advance(voices[index], end[index])
+        local = position - self.base[voices, None]
+        np.clip(local, 0, 2 * self.chunk - 1, out=local)
+        index = local.astype(int64)
+        length = self.length[voices]
+        # Like one-shot wavetables, the sample holds its last value rather than fading to the zeros after it
+        following = np.minimum(index + 1, np.minimum(length - self.base[voices], 2 * self.chunk)[:, None] - 1)
+        # Gathered straight from the windows, without copying each voice's whole window first
+        rows = voices[:, None]
+        current = self.windows[rows, index]
+        samples = current + (self.windows[rows, following] - current.astype(float64)) * (local - index)
+        samples[position >= length[:, None]] = 0
+        gains = self.envelopes.render(voices)
+        pan = self.pan[voices]
+        if modulation is not None:
+            gains[modulation.rows] *= modulation.gain
+            pan = pan.copy()
+            pan[modulation.rows] += modulation.pan
+        wave = np.multiply(samples, gains, dtype=float32)
+        matrix = self.strips.matrix(self.strip[voices], self.volume[voices], pan)
+        out += matrix.astype(float32) @ wave
+        self.position[voices] = position[:, -1] + increment[:, 0]
+        self.finished[voices] = (self.position[voices] >= length) | self.envelopes.finished[voices]
@@ -0,0 +1,287 @@
+import json
+import math
+from argparse import ArgumentParser
+from collections.abc import Iterator
+from pathlib import Path
+from threading import Event, Thread
+from time import perf_counter
+from typing import NamedTuple
+
+from .config import main_config, settings
+from .constants import *
+from .sound_generator import SoundGenerator
+
+
+tracker_config = main_config.get('tracker', {})
+NOTE_NAMES = {'C-': 0, 'C#': 1, 'D-': 2, 'D#': 3, 'E-': 4, 'F-': 5, 'F#': 6, 'G-': 7, 'G#': 8, 'A-': 9, 'A#': 10, 'B-': 11}
+# Note column values besides MIDI note numbers
+NO_NOTE = -1
+NOTE_OFF = -2
+NOTE_CUT = -3
+MAX_CHANNELS = 16
+MAX_VOLUME = 0x40
+# Effects, by their command digit
+ARPEGGIO = 0x0
+VIBRATO = 0x4
+EXTENDED = 0xE
+SET_SPEED = 0xF
+NOTE_CUT_EFFECT = 0xC  # ECx, an extended effect
+VIBRATO_STEPS = 64
+
+class Cell(NamedTuple):
+    # One channel of one row, written as "C#4 01 40 047": note, instrument, volume and effect, each
+    # column filled with dots when empty. Trailing columns may be left out.
+    #   note: C-4 is middle C, === releases the channel's note and ^^^ cuts it
+    #   instrument: hexadecimal, 01 being the first instrument of instrumentLists
+    #   volume: hexadecimal, 00 to 40, the channel's volume until the next note
+    #   effect: hexadecimal command and parameter xy
+    #     0xy: arpeggio, the note, x semitones above it and y semitones above it, a tick each
+    #     4xy: vibrato, x/64 of a cycle a tick, y/16 of a semitone deep; 0 keeps the last speed or depth
+    #     ECx: cuts the note at tick x of the row
+    #     Fxx: below 20, xx ticks a row; from 20 on, xx is the tempo
+    note: int = NO_NOTE
+    instrument: int = 0
+    volume: int = -1
+    effect: int = -1
+    param: int = 0
+
+EMPTY_CELL = Cell()
+
+class Song(NamedTuple):
+    channels: int
+    # A tick lasts 2.5 / tempo seconds, as in the trackers of old; a row lasts speed ticks
+    tempo: float
+    speed: int
+    patterns: dict[str, tuple[tuple[Cell, ...], ...]]
+    order: tuple[str, ...]
+    # Position in order that the song loops back to; played live, a song with a restart loops forever
+    restart: int | None = None
+
+def parse_cell(text: str) -> Cell:
+    columns = text.split()
+    if len(columns) > 4:
+        raise ValueError(f'{text!r}: too many columns')
+    columns += ['.'] * (4 - len(columns))
+    note_text, instrument_text, volume_text, effect_text = columns
+    if note_text.strip('.') == '':
+        note = NO_NOTE
+    elif note_text == '===':
+        note = NOTE_OFF
+    elif note_text == '^^^':
+        note = NOTE_CUT
+    elif len(note_text) == 3 and note_text[:2] in NOTE_NAMES and note_text[2].isdigit():
+        # C-4 is MIDI note 60
+        note = (int(note_text[2]) + 1) * 12 + NOTE_NAMES[note_text[:2]]
+    else:
+        raise ValueError(f'{text!r}: invalid note {note_text!r}')
+    try:
+        instrument = 0 if instrument_text.strip('.') == '' else int(instrument_text, 16)
+        volume = -1 if volume_text.strip('.') == '' else int(volume_text, 16)
+        if effect_text.strip('.') == '':
+            effect, param = -1, 0
+        elif len(effect_text) == 3:
+            effect, param = int(effect_text[0], 16), int(effect_text[1:], 16)
+        else:
+            raise ValueError
+    except ValueError:
+        raise ValueError(f'{text!r}: invalid instrument, volume or effect') from None
+    if volume > MAX_VOLUME:
+        raise ValueError(f'{text!r}: volume above {MAX_VOLUME:02X}')
+    return Cell(note, instrument, volume, effect, param)
+
+def parse_song(data: dict) -> Song:
+    # A tracker module: {"channels": 4, "tempo": 125, "speed": 6, "patterns": {"name": [row, ...]},
+    # "order": ["name", ...], "restart": 0}, where a row is a list of cells, one per channel
+    channels = data.get('channels', 4)
+    if not 1 <= channels <= MAX_CHANNELS:
+        raise ValueError(f'channels: from 1 to {MAX_CHANNELS}')
+    tempo, speed = data.get('tempo', 125), data.get('speed', 6)
+    if not isinstance(tempo, (int, float)) or tempo <= 0:
+        raise ValueError('tempo must be a positive number')
+    if not isinstance(speed, int) or speed <= 0:
+        raise ValueError('speed must be a positive integer')
+    patterns = {}
+    for name, rows in data.get('patterns', {}).items():
+        compiled = []
+        for index, row in enumerate(rows):
+            if len(row) > channels:
+                raise ValueError(f'patterns.{name}[{index}]: more cells than the {channels} channels')
+            try:
+                cells = [parse_cell(text) if text else EMPTY_CELL for text in row]
+            except ValueError as error:
+                raise ValueError(f'patterns.{name}[{index}]: {error}') from None
+            compiled.append(tuple(cells) + (EMPTY_CELL,) * (channels - len(cells)))
+        patterns[name] = tuple(compiled)
+    order = tuple(data.get('order', list(patterns)))
+    for name in order:
+        if name not in patterns:
+            raise ValueError(f'order: no pattern {name!r}')
+    restart = data.get('restart')
+    if restart is not None and not 0 <= restart < len(order):
+        raise ValueError(f'restart: no position {restart} in order')
+    return Song(channels, tempo, speed, patterns, order, restart)
+
+def load_song(path: Path) -> Song:
+    with Path(path).open(encoding='utf-8') as f:
+        return parse_song(json.load(f))
+
+
+class _Channel:
+    def __init__(self):
+        # Sounding note, or -1
+        self.note = -1
+        self.volume = MAX_VOLUME
+        # Detune in cents last sent to the synthesizer
+        self.detune = 0
+        self.vibrato_speed = 0
+        self.vibrato_depth = 0
+        self.vibrato_position = 0
+
+class Sequencer:
+    # Turns a song into the (time, type, vk, value) events that the SoundGenerator plays, tracker channel
+    # n playing on MIDI channel n (so channel 10 plays the percussion, as in General MIDI). Each event
+    # is timed at the middle of its sample: the generator places it at exactly that sample of its
+    # block, wherever the block boundaries fall. Events are made one row at a time, as they are
+    # needed, so a looping song costs nothing up front.
+    def __init__(self, song: Song, sample_rate: int = None):
+        self.song = song
+        self.sample_rate = sample_rate or settings.sample_rate
+
+    def events(self, loop: bool = False) -> Iterator[tuple[float, int, int, int]]:
+        # In time order, from 0 at the start of the song; loop: forever, from the restart position on
+        song = self.song
+        channels = [_Channel() for _ in range(song.channels)]
+        tempo, speed = song.tempo, song.speed
+        time = 0.0
+        position = 0
+        while position < len(song.order):
+            for row in song.patterns[song.order[position]]:
+                for cell in row:
+                    if cell.effect == SET_SPEED and cell.param:
+                        if cell.param < 0x20:
+                            speed = cell.param
+                        else:
+                            tempo = cell.param
+                tick = 2.5 / tempo
+                for tick_index in range(speed):
+                    # Rounded to the sample the event falls on
+                    at = (round((time + tick_index * tick) * self.sample_rate) + 0.5) / self.sample_rate
+                    for number, cell in enumerate(row):
+                        # After the first tick of the row, only the effects have anything to do
+                        if tick_index == 0 or cell.effect >= 0:
+                            yield from self._tick(at, number, channels[number], cell, tick_index)
+                time += speed * tick
+            position += 1
+            if position == len(song.order) and loop:
+                position = song.restart or 0
+        # Releases what is still sounding at the end of the song
+        at = (round(time * self.sample_rate) + 0.5) / self.sample_rate
+        for number, channel in enumerate(channels):
+            if channel.note >= 0:
+                yield at, EventType.NOTE_OFF, number << 7 | channel.note, 0
+
+    def schedule(self) -> list[tuple[float, int, int, int]]:
+        # Every event of the song played once, as render() takes them
+        return list(self.events())
+
+    def _tick(self, at: float, number: int, channel: _Channel, cell: Cell, tick_index: int):
+        if tick_index == 0:
+            yield from self._row(at, number, channel, cell)
+        if cell.effect == ARPEGGIO and cell.param:
+            semitones = (0, cell.param >> 4, cell.param & 0x0F)[tick_index % 3]
+            yield from self._detune(at, number, channel, semitones * 100)
+        elif cell.effect == VIBRATO:
+            if cell.param >> 4:
+                channel.vibrato_speed = cell.param >> 4
+            if cell.param & 0x0F:
+                channel.vibrato_depth = cell.param & 0x0F
+            angle = 2 * math.pi * channel.vibrato_position / VIBRATO_STEPS
+            channel.vibrato_position = (channel.vibrato_position + channel.vibrato_speed) % VIBRATO_STEPS
+            yield from self._detune(at, number, channel, round(channel.vibrato_depth * 100 / 16 * math.sin(angle)))
+        elif tick_index == 0:
+            # Pitch effects last only as long as their rows; the detune reaches the new note before it sounds
+            yield from self._detune(at, number, channel, 0)
+        if cell.effect == EXTENDED and cell.param >> 4 == NOTE_CUT_EFFECT and cell.param & 0x0F == tick_index:
+            yield from self._cut(at, number, channel)
+
+    def _row(self, at: float, number: int, channel: _Channel, cell: Cell):
+        vk = number << 7
+        if cell.instrument:
+            yield at, EventType.PROGRAM_CHANGE, vk, cell.instrument - 1
+        if cell.note >= 0:
+            # A new note releases the one before it, and starts at the cell's volume or full volume
+            if channel.note >= 0:
+                yield at, EventType.NOTE_OFF, vk | channel.note, 0
+            yield from self._volume(at, number, channel, MAX_VOLUME if cell.volume < 0 else cell.volume)
+            channel.vibrato_position = 0
+            yield at, EventType.NOTE_ON, vk | cell.note, 127
+            channel.note = cell.note
+            return
+        if cell.volume >= 0:
+            yield from self._volume(at, number, channel, cell.volume)
+        if cell.note == NOTE_OFF and channel.note >= 0:
+            yield at, EventType.NOTE_OFF, vk | channel.note, 0
+            channel.note = -1
+        elif cell.note == NOTE_CUT:
+            yield from self._cut(at, number, channel)
+
+    def _volume(self, at: float, number: int, channel: _Channel, volume: int):
+        if volume != channel.volume:
+            channel.volume = volume
+            # Channel volume
+            yield at, EventType.CONTROL_CHANGE, number << 7 | 7, round(volume * 127 / MAX_VOLUME)
+
+    def _detune(self, at: float, number: int, channel: _Channel, cents: int):
+        if cents != channel.detune:
+            channel.detune = cents
+            yield at, EventType.DETUNE, number << 7, cents
+
+    def _cut(self, at: float, number: int, channel: _Channel):
+        # All sound off, which stops the channel's voices at once, released ones included
+        yield at, EventType.CONTROL_CHANGE, number << 7 | 120, 0
+        channel.note = -1
+
+
+class TrackerPlayer:
+    # Plays a song live. Events are put in the player's own event ring up to lookahead seconds
+    # before they are due, timestamped with when they are due, so the generator places every one at
+    # its sample however late this thread wakes up, as long as it is less than lookahead late.
+    def __init__(self, sg: SoundGenerator, song: Song, loop: bool = None, lookahead: float = None, queue_size: int = None):
+        self.sequencer = Sequencer(song)
+        self.events = sg.open_events(queue_size or tracker_config.get('queueSize', 4096))
+        self.loop = song.restart is not None if loop is None else loop
+        self.lookahead = lookahead or tracker_config.get('lookahead', 0.05)
+        self._stop = Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = Thread(target=self._play, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _play(self):
+        start = perf_counter() + self.lookahead
+        for time, type_, vk, value in self.sequencer.events(self.loop):
+            at = start + time
+            delay = at - self.lookahead - perf_counter()
+            if delay > 0 and self._stop.wait(delay):
+                return
+            # A full ring drains within a block
+            while not self.events.put(type_, vk, at, value):
+                if self._stop.wait(0.001):
+                    return
+
+
+def main(argv: list[str] = None):
+    parser = ArgumentParser(description='Dump the events of a tracker module')
+    parser.add_argument('song', type=Path)
+    args = parser.parse_args(argv)
+    for time, type_, vk, value in Sequencer(load_song(args.song)).schedule():
+        print(f'{time:10.4f}  {EventType(type_).name:<14} {vk >> 7:2d} {vk & 0x7F:3d} {value:5d}')
+
+if __name__ == '__main__':
+    main()
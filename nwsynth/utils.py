@@ -1,22 +1,5 @@
 from time import sleep
 
-def linear_adsr(adsr: tuple[float, int, int, float, int]):
-    def get_volume(status: int, ticks: int, ticks_since_released: int) -> float:
-        if status == 1:
-            if ticks < adsr[1]:
-                volume = adsr[0] + (1 - adsr[0]) * ticks / adsr[1]
-            elif ticks < adsr[2]:
-                volume = 1 - (1 - adsr[3]) * (ticks - adsr[1]) / adsr[2]
-            else:
-                volume = adsr[3]
-        else:
-            if ticks_since_released < adsr[4]:
-                volume = adsr[3] - ticks_since_released * adsr[3] / adsr[4]
-            else:
-                volume = 0
-        return volume
-    return get_volume
-
 def whoami():
     def bytes_to_bool_matrix(data: bytes) -> list[list[bool]]:
         # Long live the Game Boy! Long live retrogaming!
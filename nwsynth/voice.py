@@ -0,0 +1,185 @@
+import numpy as np
+from numpy import float32, float64, int64, ndarray
+
+from .config import settings
+from .envelope import Envelope, EnvelopeBank
+from .mixer import Strips
+from .modulation import Modulation, ModulationBank, ModulationBlock, warp
+from .wavetable import WavetableBank
+
+
+OSCILLATOR_MODES = ('legacy', 'accumulator')
+INTERPOLATIONS = ('nearest', 'linear', 'bandlimited')
+
+class VoiceBank:
+    # Struct-of-arrays state for every voice, rendered together in one NumPy pass per tick.
+    # legacy: tables are resampled to a whole number of output samples per period,
+    # and each voice steps through its table one sample at a time.
+    # accumulator: tables keep their own length, and each voice reads them at a
+    # float64 phase that advances by freq / sample_rate cycles per sample.
+    def __init__(
+        self,
+        wavetables: WavetableBank,
+        capacity: int = 32,
+        oscillator: str = 'accumulator',
+        interpolation: str = 'linear',
+        block_size: int = None,
+        strips: Strips = None
+    ):
+        assert oscillator in OSCILLATOR_MODES
+        assert interpolation in INTERPOLATIONS
+        self.wavetables = wavetables
+        self.capacity = capacity
+        self.oscillator = oscillator
+        self.interpolation = interpolation
+        self.active = np.zeros(capacity, bool)
+        self.table_id = np.zeros(capacity, int64)
+        self.freq = np.zeros(capacity, float64)
+        self.volume = np.zeros(capacity, float64)
+        # Mixer channel strip of each voice, and its pan relative to the strip's
+        self.strip = np.zeros(capacity, int64)
+        self.pan = np.zeros(capacity, float64)
+        self.strips = strips if strips is not None else Strips(1, settings.channels)
+        self.play_once = np.zeros(capacity, bool)
+        self.finished = np.zeros(capacity, bool)
+        # legacy: length of one cycle in output samples, and the playback position inside it
+        self.period = np.ones(capacity, int64)
+        self.position = np.zeros(capacity, int64)
+        # accumulator: phase in cycles, and its increment per output sample
+        self.phase = np.zeros(capacity, float64)
+        self.increment = np.zeros(capacity, float64)
+        self.envelopes = EnvelopeBank(capacity, block_size)
+        self.modulators = ModulationBank(capacity, block_size)
+        self.sample_rate = settings.sample_rate
+        self._ramp = np.arange(block_size or settings.block_size, dtype=int64)
+
+    def levels(self) -> ndarray:
+        # Current gain of every voice, for voice stealing
+        return self.envelopes.level * self.volume
+
+    def start(
+        self,
+        voice: int,
+        table_id: int,
+        freq: float,
+        play_once: bool,
+        envelope: Envelope,
+        volume: float = 1.0,
+        offset: int = 0,
+        strip: int = 0,
+        pan: float = 0.0,
+        modulation: Modulation = None
+    ):
+        # offset: samples into the next block at which the note starts
+        if self.active[voice]:
+            self.wavetables.release(self.table_id[voice])
+        self.wavetables.acquire(table_id)
+        self.table_id[voice] = table_id
+        self.freq[voice] = freq
+        self.period[voice] = self.wavetables.lengths[table_id]
+        # Both wind back so that the note begins exactly at offset; the envelope keeps it silent until then
+        self.position[voice] = -offset
+        self.phase[voice] = -offset * freq / self.sample_rate
+        self.increment[voice] = freq / self.sample_rate
+        self.volume[voice] = volume
+        self.strip[voice] = strip
+        self.pan[voice] = pan
+        self.play_once[voice] = play_once
+        self.finished[voice] = False
+        self.active[voice] = True
+        self.envelopes.start(voice, envelope, offset)
+        self.modulators.start(voice, modulation)
+
+    def bend(self, voice: int, ratio: float):
+        # Pitch bend relative to the note's frequency; legacy tables are resampled to the note
+        # and cannot be bent
+        self.increment[voice] = self.freq[voice] * ratio / self.sample_rate
+
+    def release(self, voice: int, offset: int = 0):
+        self.envelopes.release(voice, offset)
+        self.modulators.release(voice, offset)
+
+    def stop(self, voice: int):
+        if self.active[voice]:
+            self.wavetables.release(self.table_id[voice])
+        self.active[voice] = False
+
+    def sounding(self) -> ndarray:
+        return np.flatnonzero(self.active & ~self.finished)
+
+    def render(self, out: ndarray, voices: ndarray = None):
+        # voices: the voices to render, all sounding ones by default
+        if voices is None:
+            voices = self.sounding()
+        if voices.size == 0:
+            return
+        modulation = self.modulators.render(voices)
+        if self.oscillator == 'legacy':
+            # Tables resampled to the note cannot change pitch or duty
+            samples = self._render_legacy(voices)
+        else:
+            samples = self._render_accumulator(voices, modulation)
+        # 应用音量（包络），再混合所有通道
+        # out: (channels, samples); one matrix product pans and sums every voice into every channel
+        gains = self.envelopes.render(voices)
+        pan = self.pan[voices]
+        if modulation is not None:
+            gains[modulation.rows] *= modulation.gain
+            pan = pan.copy()
+            pan[modulation.rows] += modulation.pan
+        wave = np.multiply(samples, gains, dtype=float32)
+        matrix = self.strips.matrix(self.strip[voices], self.volume[voices], pan)
+        out += matrix.astype(float32) @ wave
+        self.finished[voices] |= self.envelopes.finished[voices]
+
+    def _render_legacy(self, voices: ndarray) -> ndarray:
+        # The table is already resampled to one period of the note
+        period = self.period[voices, None]
+        positions = self.position[voices, None] + self._ramp
+        indices = self.wavetables.offsets[self.table_id[voices], None] + positions % period
+        samples = self.wavetables.arena[indices]
+        play_once = self.play_once[voices]
+        if play_once.any():
+            # 仅将第一次播放的数据放置在1帧音频数组里
+            samples[play_once[:, None] & (positions >= period)] = 0
+            self.finished[voices] = play_once & (positions[:, -1] + 1 >= period[:, 0])
+        self.position[voices] = (positions[:, -1] + 1) % period[:, 0]
+        return samples
+
+    def _render_accumulator(self, voices: ndarray, modulation: ModulationBlock = None) -> ndarray:
+        table_id = self.table_id[voices]
+        offset = self.wavetables.offsets[table_id, None]
+        length = self.wavetables.lengths[table_id, None]
+        increment = self.increment[voices, None]
+        play_once = self.play_once[voices, None]
+        if modulation is not None:
+            increment = increment.copy()
+            increment[modulation.rows, 0] *= modulation.ratio
+        # Phase of every output sample in this tick, computed from the start of the tick
+        # so that rounding errors never accumulate across samples
+        phase = self.phase[voices, None] + increment * self._ramp
+        cycle = np.where(play_once, phase, phase % 1.0)
+        if modulation is not None:
+            # Duty applies to looping tables only
+            warped = (modulation.duty != 0) & ~play_once[modulation.rows, 0]
+            if warped.all() and warped.size == voices.size:
+                cycle = warp(cycle, modulation.duty)
+            elif warped.any():
+                rows = modulation.rows[warped]
+                cycle[rows] = warp(cycle[rows], modulation.duty[warped])
+        place = cycle * length
+        index = np.clip(place.astype(int64), 0, length - 1)
+        if self.interpolation == 'nearest':
+            samples = self.wavetables.arena[offset + index]
+        else:
+            following = index + 1
+            # Looping tables wrap around, one-shot samples hold their last value
+            following = np.where(play_once, np.minimum(following, length - 1), following % length)
+            current = self.wavetables.arena[offset + index]
+            samples = current + (self.wavetables.arena[offset + following] - current.astype(float64)) * (place - index)
+        if play_once.any():
+            samples[play_once & (phase >= 1.0)] = 0
+        end = self.phase[voices] + increment[:, 0] * self._ramp.size
+        self.finished[voices] = play_once[:, 0] & (end >= 1.0)
+        self.phase[voices] = np.where(play_once[:, 0], end, end % 1.0)
+        return samples
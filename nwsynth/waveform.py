@@ -1,109 +1,238 @@
-from math import pi, sin
+from collections.abc import Mapping
+from functools import lru_cache
+from hashlib import sha1
+from math import pi
 from pathlib import Path
+import wave
 
-from .config import custom_waveforms
-from .utils import linear_adsr
+import numpy as np
+
+from . import dpcm
+from .config import custom_waveforms, main_config
 
 class Waveform16:
+    # Every get_* method returns a cached, read-only int16 array,
+    # so asking for the same waveform again costs a dictionary lookup
     def __init__(self, sample_length: int = 64):
         assert sample_length > 0
         self.sample_length = sample_length
     
-    def get_square_wave(self, amplitude: int, duty_cycle: float):
+    def get_square_wave(self, amplitude: int, duty_cycle: float) -> np.ndarray:
         assert 0 < amplitude < 32768
         assert 0 < duty_cycle < 1
-        wave = []
-        for i in range(self.sample_length):
-            if i < self.sample_length * duty_cycle:
-                wave.append(amplitude)
-            else:
-                wave.append(-amplitude)
-        return wave
+        return _square_wave(self.sample_length, amplitude, duty_cycle)
 
-    def get_triangle_wave(self, amplitude: int):
+    def get_triangle_wave(self, amplitude: int) -> np.ndarray:
         assert 0 < amplitude < 32768
-        wave = []
-        quarter_length = self.sample_length // 4
-        for i in range(self.sample_length):
-            if i < self.sample_length / 4:
-                wave.append(amplitude * i // quarter_length)
-            elif i < self.sample_length * 3 / 4:
-                wave.append(amplitude * (self.sample_length // 2 - i) // quarter_length)
-            else:
-                wave.append(amplitude * (i - self.sample_length) // quarter_length)
-        return wave
+        return _triangle_wave(self.sample_length, amplitude)
 
-    def get_sawtooth_wave(self, amplitude: int):
+    def get_sawtooth_wave(self, amplitude: int) -> np.ndarray:
         assert 0 < amplitude < 32768
-        wave = []
-        half_length = self.sample_length // 2
-        for i in range(self.sample_length):
-            wave.append(amplitude * (half_length - i) // half_length)
-        return wave
+        return _sawtooth_wave(self.sample_length, amplitude)
 
-    def get_sine_wave(self, amplitude: int):
+    def get_sine_wave(self, amplitude: int) -> np.ndarray:
         assert 0 < amplitude < 32768
-        half_length = self.sample_length // 2
-        return [int(amplitude * sin(i * pi / half_length)) for i in range(self.sample_length)]
+        return _sine_wave(self.sample_length, amplitude)
     
-    def get_noise_wave(self, amplitude: int, short_period=False):
+    def get_noise_wave(self, amplitude: int, short_period=False) -> np.ndarray:
+        # One full period of the LFSR, whatever the sample length
         assert 0 < amplitude < 32768
-        # On power-up, the shift register is loaded with the value 1.
-        lfsr = 1
-        wave = []
-        while True:
-            bit0 = bool(lfsr & 1)
-            # Current sample frame
-            wave.append(amplitude if bit0 else -amplitude)
-            # Feedback is calculated as the exclusive-OR of bit 0 and one other bit:
-            # bit 6 if Mode flag is set, otherwise bit 1.
-            xor_bit = 6 if short_period else 1
-            bit1 = bool(lfsr & 1 << xor_bit)
-            feedback_value = bit0 ^ bit1
-            # The shift register is shifted right by one bit.
-            lfsr >>= 1
-            # Bit 14, the leftmost bit, is set to the feedback calculated earlier.
-            lfsr |= feedback_value << 14
-            if lfsr == 1:
-                # 一个周期结束
-                break
-        return wave
+        return _noise_wave(amplitude, bool(short_period))
+
+def _frozen(wave: np.ndarray) -> np.ndarray:
+    wave = wave.astype(np.int16)
+    wave.flags.writeable = False
+    return wave
+
+@lru_cache(maxsize=None)
+def _square_wave(sample_length: int, amplitude: int, duty_cycle: float) -> np.ndarray:
+    i = np.arange(sample_length)
+    return _frozen(np.where(i < sample_length * duty_cycle, amplitude, -amplitude))
+
+@lru_cache(maxsize=None)
+def _triangle_wave(sample_length: int, amplitude: int) -> np.ndarray:
+    i = np.arange(sample_length, dtype=np.int64)
+    quarter_length = sample_length // 4
+    wave = np.select(
+        [i < sample_length / 4, i < sample_length * 3 / 4],
+        [amplitude * i // quarter_length, amplitude * (sample_length // 2 - i) // quarter_length],
+        amplitude * (i - sample_length) // quarter_length
+    )
+    # Lengths that are not a multiple of 4 would overshoot the peak
+    return _frozen(np.clip(wave, -amplitude, amplitude))
+
+@lru_cache(maxsize=None)
+def _sawtooth_wave(sample_length: int, amplitude: int) -> np.ndarray:
+    i = np.arange(sample_length, dtype=np.int64)
+    half_length = sample_length // 2
+    return _frozen(np.clip(amplitude * (half_length - i) // half_length, -amplitude, amplitude))
+
+@lru_cache(maxsize=None)
+def _sine_wave(sample_length: int, amplitude: int) -> np.ndarray:
+    half_length = sample_length // 2
+    return _frozen(np.trunc(amplitude * np.sin(np.arange(sample_length) * pi / half_length)))
+
+@lru_cache(maxsize=None)
+def _noise_wave(amplitude: int, short_period: bool) -> np.ndarray:
+    return _frozen(np.where(lfsr_sequence(short_period), amplitude, -amplitude))
+
+@lru_cache(maxsize=None)
+def lfsr_sequence(short_period: bool = False) -> np.ndarray:
+    # Bit 0 of the noise channel's shift register over one full period, computed once per mode
+    # On power-up, the shift register is loaded with the value 1.
+    lfsr = 1
+    # Feedback is calculated as the exclusive-OR of bit 0 and one other bit:
+    # bit 6 if Mode flag is set, otherwise bit 1.
+    xor_bit = 6 if short_period else 1
+    bits = bytearray()
+    while True:
+        bit0 = lfsr & 1
+        # Current sample frame
+        bits.append(bit0)
+        feedback_value = bit0 ^ (lfsr >> xor_bit & 1)
+        # The shift register is shifted right by one bit.
+        # Bit 14, the leftmost bit, is set to the feedback calculated earlier.
+        lfsr = lfsr >> 1 | feedback_value << 14
+        if lfsr == 1:
+            # 一个周期结束
+            break
+    sequence = np.frombuffer(bytes(bits), np.uint8).astype(bool)
+    sequence.flags.writeable = False
+    return sequence
+
+def builtin_waveform(name: str, args: list, length: int = None) -> np.ndarray:
+    # A builtin waveform of config.json, e.g. {"name": "squarewave", "args": [2048, 0.5], "length": 4096}
+    return builtin[name](*args) if length is None else getattr(Waveform16(length), _BUILTIN_METHODS[name])(*args)
     
-def dpcm_loader(path: Path):
-    data = path.read_bytes()
-    sample = []
-    frame = 0
-    for byte in data:
-        for bit_position in range(8):
-            value = byte & 1 << bit_position
-            # If the bit is 1, add 2; otherwise, subtract 2.
-            # But if adding or subtracting 2 would cause the output level to leave the 0-127 range,
-            # （注：此处初始值是0，那么范围为-64 ~ 63）
-            # leave the output level unchanged.
-            # This means subtract 2 only if the current level is at least 2,（也就是-62）
-            # or add 2 only if the current level is at most 125.（也就是61）
-            if value:
-                if frame <= 61:
-                    frame += 2
-            else:
-                if frame >= -62:
-                    frame -= 2
-            sample.append(frame * 256)
-    return sample
+# Bump whenever dpcm_loader's output changes, so that stale cached decodes are not used
+DPCM_DECODER_VERSION = 1
 
-_wf16 = Waveform16()
-builtin = {
-    'squarewave': _wf16.get_square_wave,
-    'trianglewave': _wf16.get_triangle_wave,
-    'sawtoothwave': _wf16.get_sawtooth_wave,
-    'sinewave': _wf16.get_sine_wave,
-    'noisewave': _wf16.get_noise_wave,
+def dpcm_loader(path: Path) -> np.ndarray:
+    return dpcm.decode(path.read_bytes())
+
+WAV_CHUNK_FRAMES = 1 << 16
+
+_BUILTIN_METHODS = {
+    'squarewave': 'get_square_wave',
+    'trianglewave': 'get_triangle_wave',
+    'sawtoothwave': 'get_sawtooth_wave',
+    'sinewave': 'get_sine_wave',
+    'noisewave': 'get_noise_wave',
 }
-custom = {}
-for name, info in custom_waveforms.items():
-    if info['type'] == 'dpcm':
-        path = Path(__file__).parent.parent.joinpath('samples').joinpath(info['path'])
-        waveform = dpcm_loader(path)
-    elif info['type'] == 'builtin':
-        waveform = builtin[info['name']](*info['args'])
-    custom[name] = waveform
+_wf16 = Waveform16()
+builtin = {name: getattr(_wf16, method) for name, method in _BUILTIN_METHODS.items()}
+
+
+class WaveformLibrary(Mapping):
+    # The waveforms of config.json's customWaveforms, each loaded on first use.
+    # Decoded DPCM samples are kept in an on-disk cache of .npy files keyed by the file's hash
+    # and the decoder version, and memory-mapped from there on later starts.
+    def __init__(self, infos: dict, samples_dir: Path, cache_dir: Path):
+        self._infos = infos
+        self._samples_dir = samples_dir
+        self._cache_dir = cache_dir
+        self._loaded = {}
+
+    def __getitem__(self, name: str):
+        waveform = self._loaded.get(name)
+        if waveform is None:
+            info = self._infos[name]
+            if info['type'] == 'dpcm':
+                waveform = self._load_dpcm(self._samples_dir.joinpath(info['path']))
+            elif info['type'] == 'wav':
+                waveform = self._load_wav(self._samples_dir.joinpath(info['path']))
+            elif info['type'] == 'builtin':
+                waveform = builtin_waveform(info['name'], info['args'], info.get('length'))
+            else:
+                raise ValueError(f'Unknown waveform type {info["type"]!r} of {name!r}')
+            self._loaded[name] = waveform
+        return waveform
+
+    def check(self, name: str):
+        # Raises what loading name would for a bad entry or a missing file, without loading it
+        info = self._infos[name]
+        if info['type'] in ('dpcm', 'wav'):
+            path = self._samples_dir.joinpath(info['path'])
+            if not path.is_file():
+                raise ValueError(f'no file {path}')
+        elif info['type'] == 'builtin':
+            builtin_waveform(info['name'], info['args'], info.get('length'))
+        else:
+            raise ValueError(f'Unknown waveform type {info["type"]!r} of {name!r}')
+
+    def length(self, name: str) -> int:
+        # Samples in name, from the file's size or header when it is not loaded yet: DPCM has one
+        # sample a bit, and WAV files give their frame count
+        waveform = self._loaded.get(name)
+        if waveform is not None:
+            return len(waveform)
+        info = self._infos[name]
+        if info['type'] == 'dpcm':
+            return self._samples_dir.joinpath(info['path']).stat().st_size * 8
+        if info['type'] == 'wav':
+            with wave.open(str(self._samples_dir.joinpath(info['path'])), 'rb') as f:
+                return f.getnframes()
+        return len(self[name])
+
+    def __iter__(self):
+        return iter(self._infos)
+
+    def __len__(self):
+        return len(self._infos)
+
+    def _load_dpcm(self, path: Path) -> np.ndarray:
+        data = path.read_bytes()
+        digest = sha1(data).hexdigest()
+        cache_path = self._cache_dir.joinpath(f'{path.stem}-{digest}-v{DPCM_DECODER_VERSION}.npy')
+        if not cache_path.exists():
+            self._cache_dir.mkdir(parents=True, exist_ok=True)
+            temporary = cache_path.with_suffix('.tmp')
+            with temporary.open('wb') as f:
+                np.save(f, dpcm_loader(path))
+            temporary.replace(cache_path)
+        return np.load(cache_path, mmap_mode='r')
+
+    def _load_wav(self, path: Path) -> np.ndarray:
+        # 8-bit or 16-bit PCM, mixed down to mono. The file is hashed and decoded a chunk at a time
+        # straight into the memory-mapped cache file, so a long sample never has to fit in memory
+        digest = sha1()
+        with path.open('rb') as f:
+            while data := f.read(1 << 20):
+                digest.update(data)
+        cache_path = self._cache_dir.joinpath(f'{path.stem}-{digest.hexdigest()}-wav.npy')
+        if not cache_path.exists():
+            self._cache_dir.mkdir(parents=True, exist_ok=True)
+            temporary = cache_path.with_suffix('.tmp')
+            with wave.open(str(path), 'rb') as f:
+                width, channels = f.getsampwidth(), f.getnchannels()
+                if width not in (1, 2):
+                    raise ValueError(f'{path}: only 8-bit and 16-bit PCM WAV files are supported')
+                decoded = np.lib.format.open_memmap(temporary, 'w+', np.int16, (f.getnframes(),))
+                position = 0
+                while frames := f.readframes(WAV_CHUNK_FRAMES):
+                    if width == 1:
+                        chunk = (np.frombuffer(frames, np.uint8).astype(np.int32) - 128) * 256
+                    else:
+                        chunk = np.frombuffer(frames, '<i2').astype(np.int32)
+                    chunk = chunk.reshape(-1, channels).mean(axis=1)
+                    decoded[position:position + chunk.size] = chunk
+                    position += chunk.size
+                decoded.flush()
+                del decoded
+            temporary.replace(cache_path)
+        return np.load(cache_path, mmap_mode='r')
+
+
+_root = Path(__file__).parent.parent
+# Where the paths of dpcm and wav waveforms are relative to
+samples_dir = _root.joinpath('samples')
+
+def waveform_library(infos: dict) -> WaveformLibrary:
+    # A library of customWaveforms entries, sharing the samples directory and the on-disk cache
+    return WaveformLibrary(
+        infos,
+        samples_dir,
+        _root.joinpath(main_config.get('waveformCacheDir', '.cache/waveforms'))
+    )
+
+custom = waveform_library(custom_waveforms)
@@ -0,0 +1,117 @@
+from collections import OrderedDict
+from collections.abc import Callable
+
+import numpy as np
+from numpy import int16, int64, ndarray
+
+
+BANDLIMITED_TABLE_LENGTH = 2048
+i16_info = np.iinfo(int16)
+
+class WavetableBank:
+    # All wavetables live back to back in one flat int16 arena of fixed size,
+    # so that voices using different tables can be rendered with a single gather.
+    # Tables are built once per waveform (and pitch, where the oscillator needs it) and then only looked up;
+    # the least recently used ones that no voice is playing are evicted when the arena is full,
+    # and with them the int16 sources of waveforms that no longer have a table in it.
+    def __init__(self, max_bytes: int = 16 << 20, max_tables: int = 4096):
+        self.arena = np.zeros(max_bytes // 2, int16)
+        self.offsets = np.zeros(max_tables, int64)
+        self.lengths = np.zeros(max_tables, int64)
+        self.refs = np.zeros(max_tables, int64)
+        self._sources: dict[tuple, ndarray] = {}
+        self._tables: OrderedDict[tuple, int] = OrderedDict()
+        self._free_ids = list(range(max_tables - 1, -1, -1))
+        self._used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def source(self, key: tuple, build: Callable[[], list]) -> ndarray:
+        # The original (not resampled) waveform, converted to int16 only once
+        table = self._sources.get(key)
+        if table is None:
+            table = np.asarray(build(), int16)
+            assert table.ndim == 1 and table.size > 0
+            table.flags.writeable = False
+            self._sources[key] = table
+        return table
+
+    def original(self, key: tuple, build: Callable[[], list]) -> int:
+        return self._cached((key,), lambda: self.source(key, build))
+
+    def resampled(self, key: tuple, build: Callable[[], list], period: int) -> int:
+        def make():
+            source = self.source(key, build)
+            # 调整音调：将采样（乐器）数组拉长/收缩至一个周期的长度
+            return source[np.arange(period, dtype=int64) * source.size // period]
+        return self._cached((key, 'period', period), make)
+
+    def bandlimited(self, key: tuple, build: Callable[[], list], harmonics: int) -> int:
+        # The waveform with every harmonic above the given one removed,
+        # resynthesized at no fewer than BANDLIMITED_TABLE_LENGTH samples so that
+        # linear interpolation between its samples adds little aliasing of its own
+        source = self.source(key, build)
+        harmonics = min(harmonics, (source.size - 1) // 2)
+        length = max(source.size, BANDLIMITED_TABLE_LENGTH)
+        def make():
+            spectrum = np.fft.rfft(source)
+            spectrum[harmonics + 1:] = 0
+            table = np.fft.irfft(spectrum, length) * (length / source.size)
+            return np.clip(np.rint(table), i16_info.min, i16_info.max)
+        return self._cached((key, 'harmonics', harmonics), make)
+
+    def acquire(self, table_id: int):
+        self.refs[table_id] += 1
+
+    def release(self, table_id: int):
+        self.refs[table_id] -= 1
+
+    def _cached(self, table_key: tuple, make: Callable[[], ndarray]) -> int:
+        table_id = self._tables.get(table_key)
+        if table_id is not None:
+            self._tables.move_to_end(table_key)
+            self.hits += 1
+            return table_id
+        self.misses += 1
+        return self._store(table_key, make())
+
+    def _store(self, table_key: tuple, table: ndarray) -> int:
+        if table.size > self.arena.size:
+            raise ValueError(f'Wavetable of {table.size} samples does not fit in the wavetable cache')
+        if self._used + table.size > self.arena.size or not self._free_ids:
+            self._evict(table.size, table_key[0])
+        table_id = self._free_ids.pop()
+        self.arena[self._used:self._used + table.size] = table
+        self.offsets[table_id] = self._used
+        self.lengths[table_id] = table.size
+        self._used += table.size
+        self._tables[table_key] = table_id
+        return table_id
+
+    def _evict(self, size: int, keep: tuple):
+        # keep: the source of the table being stored
+        live = self._used
+        for table_key, table_id in list(self._tables.items()):
+            if live + size <= self.arena.size and self._free_ids:
+                break
+            if self.refs[table_id] == 0:
+                del self._tables[table_key]
+                self._free_ids.append(table_id)
+                live -= self.lengths[table_id]
+                self.evictions += 1
+        if live + size > self.arena.size or not self._free_ids:
+            raise MemoryError('Wavetable cache is full of tables in use')
+        used_sources = {table_key[0] for table_key in self._tables}
+        used_sources.add(keep)
+        for key in [key for key in self._sources if key not in used_sources]:
+            del self._sources[key]
+        # Compact the remaining tables to the front of the arena
+        position = 0
+        for table_id in sorted(self._tables.values(), key=lambda table_id: self.offsets[table_id]):
+            offset, length = self.offsets[table_id], self.lengths[table_id]
+            if offset != position:
+                self.arena[position:position + length] = self.arena[offset:offset + length]
+                self.offsets[table_id] = position
+            position += length
+        self._used = position